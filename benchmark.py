@@ -0,0 +1,397 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+# 基准测试的阶段，按依赖顺序排列（detect 之后的阶段依赖 actual_file_type）
+STAGES = ["scan", "rescan", "detect", "fingerprint", "stats", "slices", "samples", "dataset"]
+MANIFEST_NAME = ".benchmark_manifest.json"
+
+
+def _write_dicom(path, study_uid, series_uid, instance_number, z, pixels):
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"  # CT Image Storage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.InstanceNumber = instance_number
+    ds.Modality = "CT"
+    ds.ImagePositionPatient = [0.0, 0.0, z]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [0.5, 0.5]
+    ds.SliceThickness = 1.0
+    ds.Rows, ds.Columns = pixels.shape
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.RescaleSlope = 1
+    ds.RescaleIntercept = -1024
+    ds.KVP = 120
+    ds.AcquisitionTime = "101010"
+    ds.PixelData = pixels.astype(np.int16).tobytes()
+    if int(pydicom.__version__.split(".")[0]) >= 3:
+        ds.save_as(path, enforce_file_format=True)
+    else:
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.save_as(path, write_like_original=False)
+
+
+def generate_dataset(root, patients=20, series_per_patient=2, slices_per_series=16, nifti_per_patient=1,
+                     image_size=64, other_files=1, seed=0):
+    """
+    生成与 ICONIC CCTAS 结构相似的合成数据集：
+
+        root/<患者>/<检查>/<序列>/IM0001 ...   （DICOM 切片，无扩展名）
+        root/<患者>/nifti/volume_<n>.nii / .nii.gz（交替生成）
+        root/<患者>/notes_<n>.txt
+
+    参数相同且数据集已存在时直接复用，返回数据集的清单（参数和文件统计）。
+    """
+    import SimpleITK as sitk
+    from pydicom.uid import generate_uid
+
+    config = {"patients": patients, "series_per_patient": series_per_patient,
+              "slices_per_series": slices_per_series, "nifti_per_patient": nifti_per_patient,
+              "image_size": image_size, "other_files": other_files, "seed": seed}
+    manifest_path = os.path.join(root, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["config"] == config:
+            return manifest
+        shutil.rmtree(root)
+
+    rng = np.random.default_rng(seed)
+    files = 0
+    total_bytes = 0
+    os.makedirs(root, exist_ok=True)
+    for p in range(patients):
+        patient_dir = os.path.join(root, f"BENCH{p:05d}")
+        study_uid = generate_uid()
+        study_dir = os.path.join(patient_dir, f"ST{p:05d}")
+        for s in range(series_per_patient):
+            series_uid = generate_uid()
+            series_dir = os.path.join(study_dir, f"SE{s:03d}")
+            os.makedirs(series_dir, exist_ok=True)
+            for k in range(slices_per_series):
+                path = os.path.join(series_dir, f"IM{k + 1:04d}")
+                pixels = rng.integers(0, 2000, (image_size, image_size))
+                _write_dicom(path, study_uid, series_uid, k + 1, float(k), pixels)
+                files += 1
+                total_bytes += os.path.getsize(path)
+
+        nifti_dir = os.path.join(patient_dir, "nifti")
+        os.makedirs(nifti_dir, exist_ok=True)
+        for n in range(nifti_per_patient):
+            volume = rng.normal(100, 50, (slices_per_series, image_size, image_size)).astype(np.float32)
+            image = sitk.GetImageFromArray(volume)
+            image.SetSpacing((0.5, 0.5, 1.0))
+            path = os.path.join(nifti_dir, f"volume_{n}.nii" + (".gz" if n % 2 else ""))
+            sitk.WriteImage(image, path)
+            files += 1
+            total_bytes += os.path.getsize(path)
+
+        for n in range(other_files):
+            path = os.path.join(patient_dir, f"notes_{n}.txt")
+            with open(path, "w") as f:
+                f.write(f"benchmark patient {p}\n")
+            files += 1
+            total_bytes += os.path.getsize(path)
+
+    manifest = {"config": config, "files": files, "bytes": total_bytes}
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _nifti_records(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(
+            "SELECT id, file_path FROM patient_data WHERE actual_file_type LIKE 'NIfTI%' ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+
+def _file_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def _reset_columns(db_path, columns):
+    # 清空上一次运行的结果，保证每次测量的工作量相同
+    conn = sqlite3.connect(db_path)
+    try:
+        existing = [col[1] for col in conn.execute("PRAGMA table_info(patient_data);")]
+        columns = [column for column in columns if column in existing]
+        if columns:
+            conn.execute("UPDATE patient_data SET " + ", ".join(f"{column} = NULL" for column in columns))
+            conn.commit()
+    finally:
+        conn.close()
+
+
+def _count(db_path, where="1"):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM patient_data WHERE {where}").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def run_stage(stage, db_path, root, workdir, workers=None, volume_cache=None):
+    """
+    执行一个阶段，返回 (处理的文件数, 读取的字节数或 None)。
+    volume_cache 为体数据缓存目录，给出时 stats / samples 阶段通过缓存读取体数据。
+    """
+    from dbmgr import DBManager
+
+    db = DBManager(db_path, root)
+    if stage == "scan":
+        db.initialize_database()
+        db.scan_and_add_patients()
+        return _count(db_path), None
+    if stage == "rescan":
+        db.scan_and_add_missing_patients(incremental=True)
+        return _count(db_path), None
+    if stage == "detect":
+        _reset_columns(db_path, ["actual_file_type"])
+        db.update_actual_file_types(workers=workers)
+        return _count(db_path), None
+    if stage == "fingerprint":
+        _reset_columns(db_path, ["file_size", "pre_hash", "content_hash"])
+        db.fingerprint_files(workers=workers)
+        conn = sqlite3.connect(db_path)
+        try:
+            hashed = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM patient_data WHERE content_hash IS NOT NULL"
+            ).fetchone()
+        finally:
+            conn.close()
+        return _count(db_path), hashed[1]
+    if stage == "stats":
+        _reset_columns(db_path, ["brightness_avg", "intensity_status"])
+        db.compute_intensity_stats(workers=workers, volume_cache=volume_cache)
+        records = _nifti_records(db_path)
+        return len(records), _file_bytes(path for _, path in records)
+    if stage == "slices":
+        from volume import open_slice_source, sample_indices
+
+        records = _nifti_records(db_path)
+        read = 0
+        for _, path in records:
+            source = open_slice_source(path)
+            slices = source.read(sample_indices(source.num_slices, 5))
+            read += slices.nbytes
+        return len(records), read
+    if stage == "samples":
+        store_dir = os.path.join(workdir, "samples")
+        shutil.rmtree(store_dir, ignore_errors=True)
+        conn = sqlite3.connect(db_path)
+        try:
+            conn.execute("DROP TABLE IF EXISTS sample_index")
+            conn.commit()
+        finally:
+            conn.close()
+        db.build_sample_store(store_dir, workers=workers, volume_cache=volume_cache)
+        records = _nifti_records(db_path)
+        return len(records), _file_bytes(path for _, path in records)
+    if stage == "dataset":
+        from sample_store import SampleStoreDataset
+
+        dataset = SampleStoreDataset(db_path, os.path.join(workdir, "samples"))
+        read = 0
+        for index in range(len(dataset)):
+            read += dataset[index].numel() * 4
+        return len(dataset), read
+    raise ValueError(f"未知的阶段: {stage}")
+
+
+def _stage_process(stage, db_path, root, workdir, workers, volume_cache, pipe):
+    try:
+        from volume_cache import cache_counts
+
+        # 子进程中的输出（包括 tqdm 进度条）不影响 JSON 结果
+        sys.stdout = sys.stderr = open(os.devnull, "w")
+        cache_before = cache_counts()
+        started = time.perf_counter()
+        files, read_bytes = run_stage(stage, db_path, root, workdir, workers, volume_cache)
+        seconds = time.perf_counter() - started
+        # ru_maxrss 在 Linux 上以 KiB 为单位；进程池的工作进程计入 RUSAGE_CHILDREN
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        hits, misses = (now - old for now, old in zip(cache_counts(), cache_before))
+        pipe.send({"seconds": seconds, "files": files, "bytes": read_bytes, "peak_rss_mb": peak / 1024.0,
+                   "cache_hits": hits, "cache_misses": misses})
+    except ImportError as e:
+        pipe.send({"skipped": f"缺少依赖: {e}"})
+    except Exception as e:
+        pipe.send({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        pipe.close()
+
+
+def measure_stage(stage, db_path, root, workdir, workers=None, volume_cache=None):
+    """
+    在独立的子进程中执行一个阶段，使峰值内存只反映该阶段本身。
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_stage_process,
+                                      args=(stage, db_path, root, workdir, workers, volume_cache, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"error": f"子进程异常退出（exit code {process.exitcode}）"}
+    process.join()
+    if "seconds" in result:
+        seconds = result["seconds"] or 1e-9
+        result["files_per_s"] = result["files"] / seconds
+        result["mb_per_s"] = result["bytes"] / seconds / 1e6 if result["bytes"] is not None else None
+        lookups = result["cache_hits"] + result["cache_misses"]
+        result["cache_hit_rate"] = result["cache_hits"] / lookups if lookups else None
+    return result
+
+
+def run_benchmarks(workdir, stages=STAGES, workers=None, volume_cache=False, **dataset_options):
+    """
+    生成合成数据集并依次测量各阶段。volume_cache=True 时 stats / samples 阶段使用 workdir 下的体数据缓存
+    （每次运行前清空，因此 stats 阶段全部未命中，samples 阶段的命中率反映缓存的效果）。
+    """
+    root = os.path.join(workdir, "ICONIC CCTAS")
+    cache_dir = None
+    if volume_cache:
+        cache_dir = os.path.join(workdir, "volume_cache")
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    manifest = generate_dataset(root, **dataset_options)
+    db_path = os.path.join(workdir, "benchmark.db")
+    if "scan" in stages:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+    results = {}
+    for stage in STAGES:
+        if stage in stages:
+            results[stage] = measure_stage(stage, db_path, root, workdir, workers, cache_dir)
+    return {
+        "dataset": manifest,
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "workers": workers,
+            "volume_cache": bool(volume_cache),
+        },
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+
+def compare_to_baseline(report, baseline, threshold=0.2):
+    """
+    与基线比较：吞吐量（files/s）下降或峰值内存上升超过 threshold 时记为退化。
+    返回 [(阶段, 指标, 基线值, 当前值, 变化比例), ...]。
+    """
+    regressions = []
+    if report["dataset"]["config"] != baseline["dataset"]["config"]:
+        print("警告：当前数据集参数与基线不同，比较结果仅供参考。")
+    for stage, result in report["results"].items():
+        base = baseline["results"].get(stage)
+        if not base or "seconds" not in base or "seconds" not in result:
+            continue
+        for metric, worse_when_lower in (("files_per_s", True), ("peak_rss_mb", False)):
+            old, new = base[metric], result[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            if (worse_when_lower and change < -threshold) or (not worse_when_lower and change > threshold):
+                regressions.append((stage, metric, old, new, change))
+    return regressions
+
+
+def print_report(report):
+    print(f"{'Stage':<12} | {'Files':>7} | {'Files/s':>10} | {'MB/s':>8} | {'Peak RSS MB':>11} | {'Cache hit':>9}")
+    print("-" * 74)
+    for stage, result in report["results"].items():
+        if "seconds" not in result:
+            print(f"{stage:<12} | {result.get('skipped') or result.get('error')}")
+            continue
+        mb_per_s = f"{result['mb_per_s']:.1f}" if result["mb_per_s"] is not None else "-"
+        hit_rate = f"{result['cache_hit_rate']:.0%}" if result.get("cache_hit_rate") is not None else "-"
+        print(f"{stage:<12} | {result['files']:>7} | {result['files_per_s']:>10.1f} | {mb_per_s:>8} | "
+              f"{result['peak_rss_mb']:>11.1f} | {hit_rate:>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DBManager 和各分析阶段的基准测试")
+    parser.add_argument("--workdir", default="benchmark_data", help="合成数据集和数据库所在目录")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"逗号分隔的阶段列表，可选 {','.join(STAGES)}")
+    parser.add_argument("--patients", type=int, default=20)
+    parser.add_argument("--series", type=int, default=2, help="每个患者的 DICOM 序列数")
+    parser.add_argument("--slices", type=int, default=16, help="每个序列的切片数（也是 NIfTI 的层数）")
+    parser.add_argument("--nifti", type=int, default=1, help="每个患者的 NIfTI 文件数")
+    parser.add_argument("--image-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--volume-cache", action="store_true", help="stats / samples 阶段通过体数据缓存读取，并报告命中率")
+    parser.add_argument("--output", help="结果 JSON 的保存路径")
+    parser.add_argument("--baseline", help="基线 JSON；给出时与其比较，出现退化则以状态码 1 退出")
+    parser.add_argument("--save-baseline", action="store_true", help="将本次结果保存为 --baseline 指定的基线")
+    parser.add_argument("--threshold", type=float, default=0.2, help="判定退化的相对变化阈值")
+    args = parser.parse_args(argv)
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"未知的阶段: {', '.join(sorted(unknown))}")
+
+    report = run_benchmarks(args.workdir, stages=stages, workers=args.workers, volume_cache=args.volume_cache,
+                            patients=args.patients, series_per_patient=args.series, slices_per_series=args.slices,
+                            nifti_per_patient=args.nifti, image_size=args.image_size)
+    print_report(report)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(text)
+        print(f"基线已保存到 {args.baseline}")
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(report, baseline, threshold=args.threshold)
+        for stage, metric, old, new, change in regressions:
+            print(f"退化: {stage} {metric} {old:.1f} -> {new:.1f} ({change:+.0%})")
+        if regressions:
+            return 1
+        print("与基线相比没有发现退化。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,42 +1,29 @@
-import sqlite3
+import os
+import sys
+
+# 报表接口位于仓库根目录的 DBManager
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dbmgr import DBManager
+from summary import print_counts
+
 
 def count_actual_file_types(db_path):
     """
     Count the number of each actual file type in the SQLite database.
 
+    Counts come from the summary table maintained by triggers instead of a
+    GROUP BY over patient_data.
+
     :param db_path: Path to the SQLite database file
     """
-    try:
-        # Connect to the SQLite database
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        # SQL query to count each actual file type
-        query = """
-        SELECT actual_file_type, COUNT(*) AS count
-        FROM patient_data
-        GROUP BY actual_file_type
-        ORDER BY count DESC;
-        """
-
-        # Execute the query
-        cursor.execute(query)
-        results = cursor.fetchall()
-
-        # Display the results
-        print("Actual File Type | Count")
-        print("-" * 40)
-        for file_type, count in results:
-            print(f"{file_type:<20} | {count}")
-
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-# Path to the SQLite database
-database_path = "/home/molloi-lab-linux2/Desktop/Andrew/Iconic/patient_data.db"
-
-# Call the function
-count_actual_file_types(database_path)
+    db = DBManager(db_path, None)
+    print_counts(db.actual_file_type_counts(), "Actual File Type", width=20)
+
+
+if __name__ == "__main__":
+    # Path to the SQLite database (can be overridden on the command line)
+    database_path = "/home/molloi-lab-linux2/Desktop/Andrew/Iconic/patient_data.db"
+    if len(sys.argv) > 1:
+        database_path = sys.argv[1]
+
+    count_actual_file_types(database_path)
@@ -1,44 +1,29 @@
-import sqlite3
+import os
+import sys
+
+# 报表接口位于仓库根目录的 DBManager
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dbmgr import DBManager
+from summary import print_counts
 
 
 def display_file_types(db_path):
     """
     Display file types and their counts from the SQLite database.
 
+    Counts come from the summary table maintained by triggers, so this runs in
+    constant time regardless of how many rows patient_data holds.
+
     :param db_path: Path to the SQLite database file
     """
-    try:
-        # Connect to the SQLite database
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        # SQL query to get file types and their counts
-        query = """
-        SELECT file_type, COUNT(*) AS count
-        FROM patient_data
-        GROUP BY file_type
-        ORDER BY count DESC;
-        """
-
-        # Execute the query
-        cursor.execute(query)
-        results = cursor.fetchall()
-
-        # Display the results
-        print("File Type | Count")
-        print("-" * 25)
-        for file_type, count in results:
-            print(f"{file_type:<10} | {count}")
-
-    except sqlite3.Error as e:
-        print(f"Error: {e}")
-    finally:
-        # Close the database connection
-        if conn:
-            conn.close()
-
-# Path to the SQLite database
-database_path = "/home/molloi-lab-linux2/Desktop/Andrew/Iconic/patient_data.db"
-
-# Call the function
-display_file_types(database_path)
+    db = DBManager(db_path, None)
+    print_counts(db.file_type_counts(), "File Type", width=10)
+
+
+if __name__ == "__main__":
+    # Path to the SQLite database (can be overridden on the command line)
+    database_path = "/home/molloi-lab-linux2/Desktop/Andrew/Iconic/patient_data.db"
+    if len(sys.argv) > 1:
+        database_path = sys.argv[1]
+
+    display_file_types(database_path)
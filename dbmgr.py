@@ -1,14 +1,235 @@
 import sqlite3
 import os
+import hashlib
+import heapq
+import json
+import queue
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
+from fswalk import list_patient_folders, walk_patient_files
+from io_sched import device_id, device_kind, metadata_workers
+from metrics import METRICS
+
+
+# 目录 mtime 距扫描开始不足该时长时视为"仍在变化"，不写入快照
+SNAPSHOT_SETTLE_NS = 2 * 10**9
+
+# 已入库路径超过该数量时，KnownPathIndex 在 auto 模式下改用紧凑的摘要数组
+KNOWN_PATH_SET_LIMIT = 2_000_000
+
+
+class IngestWriter(threading.Thread):
+    """
+    单写线程：从有界队列中取出扫描线程产生的记录，在 WAL 模式下用 executemany + INSERT OR IGNORE
+    以大事务批量写入，避免多个线程争抢 SQLite 写锁。
+    """
+
+    def __init__(self, db_path, batch_size=5000, queue_size=64, flush_interval=2.0):
+        super().__init__(name="IngestWriter", daemon=True)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.added = 0
+        self.added_by_source = defaultdict(int)
+        self.error = None
+
+    def put_files(self, rows):
+        # rows: [(patient_id, file_path, file_type, created_at, updated_at, source_id), ...]
+        # 队列满时扫描线程在此等待：该耗时偏高说明瓶颈在数据库写入而不是磁盘
+        with METRICS.timer("scan_queue_put_seconds"):
+            self.queue.put(("files", rows))
+
+    def put_snapshot(self, row):
+        # row: (path, parent_path, mtime_ns, entry_count, last_scanned)
+        self.queue.put(("snapshot", [row]))
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        conn = None
+        pending_files = []
+        pending_snapshots = []
+        last_flush = time.monotonic()
+        try:
+            conn = sqlite3.connect(self.db_path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = False
+
+                if item is None:
+                    break
+                if item:
+                    kind, rows = item
+                    if kind == "files":
+                        pending_files.extend(rows)
+                    else:
+                        pending_snapshots.extend(rows)
+
+                # 攒够一批或空闲超时后提交一次事务
+                if len(pending_files) >= self.batch_size or (
+                    (pending_files or pending_snapshots) and time.monotonic() - last_flush >= self.flush_interval
+                ):
+                    self._flush(conn, pending_files, pending_snapshots)
+                    pending_files, pending_snapshots = [], []
+                    last_flush = time.monotonic()
+
+            self._flush(conn, pending_files, pending_snapshots)
+        except Exception as e:
+            self.error = e
+            # 出错后继续取空队列，避免扫描线程在 put() 上永久阻塞
+            while self.queue.get() is not None:
+                pass
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _flush(self, conn, file_rows, snapshot_rows):
+        if not file_rows and not snapshot_rows:
+            return
+        by_source = defaultdict(list)
+        for row in file_rows:
+            by_source[row[5]].append(row)
+        added = 0
+        start = time.perf_counter()
+        with conn:
+            with METRICS.timer("db_insert_seconds", table="patient_data"):
+                # 按数据源分组插入，以便分别统计各数据源的新增记录数
+                for source_id, rows in by_source.items():
+                    cursor = conn.executemany('''
+                        INSERT OR IGNORE INTO patient_data (patient_id, file_path, file_type, created_at, updated_at,
+                                                            source_id)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', rows)
+                    # rowcount 不包含汇总表触发器产生的修改（total_changes 包含）
+                    self.added_by_source[source_id] += cursor.rowcount
+                    added += cursor.rowcount
+            with METRICS.timer("db_insert_seconds", table="dir_snapshot"):
+                conn.executemany('''
+                    INSERT OR REPLACE INTO dir_snapshot (path, parent_path, mtime_ns, entry_count, last_scanned)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', snapshot_rows)
+            commit_start = time.perf_counter()
+        end = time.perf_counter()
+        self.added += added
+        METRICS.observe("db_commit_seconds", end - commit_start)
+        METRICS.observe("db_transaction_seconds", end - start, stage="ingest")
+        METRICS.inc("db_rows_inserted_total", added, table="patient_data")
+        METRICS.inc("db_rows_ignored_total", len(file_rows) - added, table="patient_data")
+
+
+class KnownPathIndex:
+    """
+    已入库文件路径的内存索引，用于在扫描线程中判断文件是否已存在，代替每个文件一次 SELECT。
+
+    mode='set'  保存完整路径字符串，精确判断；
+    mode='hash' 只保存每个路径 64 位 blake2b 摘要组成的有序数组（约 8 字节/路径），用二分查找判断。
+                数百万路径下误判（把新文件当成已存在）的概率约为 n²/2⁶⁵，可忽略。
+    """
+
+    def __init__(self, mode="set"):
+        self.mode = mode
+        self._paths = set()
+        self._digests = array("Q")
+
+    @staticmethod
+    def _digest(path):
+        digest = hashlib.blake2b(path.encode("utf-8", "surrogateescape"), digest_size=8).digest()
+        return int.from_bytes(digest, "little")
+
+    @classmethod
+    def load(cls, conn, mode="auto", patient_id=None, fetch_size=50000):
+        """
+        从 patient_data 流式读取所有 file_path 构建索引；指定 patient_id 时只加载该患者的记录。
+        """
+        cursor = conn.cursor()
+        where, params = ("WHERE patient_id = ?", (patient_id,)) if patient_id is not None else ("", ())
+        if mode == "auto":
+            cursor.execute(f"SELECT COUNT(*) FROM patient_data {where}", params)
+            mode = "hash" if cursor.fetchone()[0] > KNOWN_PATH_SET_LIMIT else "set"
+
+        index = cls(mode)
+        load_start = time.perf_counter()
+        cursor.execute(f"SELECT file_path FROM patient_data {where}", params)
+        if mode == "set":
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                index._paths.update(row[0] for row in rows)
+        else:
+            # 分块排序后归并，避免一次性生成包含全部摘要的 list
+            chunks = []
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                chunks.append(array("Q", sorted(cls._digest(row[0]) for row in rows)))
+            index._digests = array("Q", heapq.merge(*chunks))
+        METRICS.observe("db_known_paths_load_seconds", time.perf_counter() - load_start, mode=mode)
+        return index
+
+    def __contains__(self, path):
+        if self.mode == "set":
+            return path in self._paths
+        digest = self._digest(path)
+        pos = bisect_left(self._digests, digest)
+        return pos < len(self._digests) and self._digests[pos] == digest
+
+    def __len__(self):
+        return len(self._paths) if self.mode == "set" else len(self._digests)
+
+
+def normalize_roots(full_dataset_path):
+    """
+    把数据集根目录参数统一为 {source_id: 路径}。
+
+    可以是单个路径、路径列表（以目录名作为 source_id，重名时追加 -2、-3 ...）或 {source_id: 路径} 字典。
+    """
+    if full_dataset_path is None:
+        return {}
+    if isinstance(full_dataset_path, dict):
+        return {str(source_id): os.fspath(path) for source_id, path in full_dataset_path.items()}
+    if isinstance(full_dataset_path, (str, os.PathLike)):
+        full_dataset_path = [full_dataset_path]
+    roots = {}
+    for path in full_dataset_path:
+        path = os.fspath(path)
+        base = os.path.basename(os.path.normpath(path)) or path
+        source_id, n = base, 2
+        while source_id in roots:
+            source_id, n = f"{base}-{n}", n + 1
+        roots[source_id] = path
+    return roots
+
 
 class DBManager:
-    def __init__(self, db_path, full_dataset_path):
+    def __init__(self, db_path, full_dataset_path, max_depth=None, include=None, exclude=None):
         self.db_path = db_path
-        self.full_dataset_path = full_dataset_path
+        # 数据集可以分布在多个磁盘上：roots 为 {source_id: 根目录}，full_dataset_path 为第一个根目录
+        self.roots = normalize_roots(full_dataset_path)
+        self.full_dataset_path = next(iter(self.roots.values()), None)
+        # 扫描选项：递归深度（None 表示不限制）以及文件名包含/排除通配模式
+        self.max_depth = max_depth
+        self.include = include
+        self.exclude = exclude
+        # 只读连接池，第一次查询时创建（见 read_pool）
+        self._read_pool = None
 
     def help(self, language=None):
         # 获取系统默认语言或使用用户指定语言
@@ -49,8 +270,18 @@ class DBManager:
 
             5. Scan Folder to Add Missing Patients:
                Scan the specified folder to add missing patient records to the database.
+               Only folders whose modification time changed since the last scan are rescanned
+               (pass incremental=False to force a full scan). Folders that disappeared are reported.
                Method:
-                   db_manager.scan_and_add_missing_patients()
+                   db_manager.scan_and_add_missing_patients(incremental=True)
+
+            6. Stream Records:
+               Iterate over records matching typed filters without loading the whole table. Queries share a small
+               pool of read-only connections and do not block scans or syncs running at the same time.
+               Method:
+                   for record_id, patient_id, path in db_manager.iter_records(actual_file_type="NIfTI-1",
+                                                                            valid_only=True):
+                       ...
 
             Example:
                 db_manager = DBManager('patients.db', 'shant')
@@ -73,6 +304,11 @@ class DBManager:
             Note:
             - Ensure that `full_dataset_path` points to a valid patient data folder.
             - The folder structure should consist of one folder per patient, with the folder name as the patient ID, containing `.nii` files.
+            - Files in nested subfolders (e.g. study/series/slice DICOM) are scanned recursively. Use
+              DBManager(db_path, full_dataset_path, max_depth=..., include=[...], exclude=[...]) to limit the depth
+              or filter file names with wildcard patterns.
+            - `full_dataset_path` may also be a list of roots or a {source_id: root} dict for data spread over
+              several drives. Each device is scanned by its own thread pool and every record stores its source_id.
             """,
 
             "zh": """
@@ -107,8 +343,18 @@ class DBManager:
 
             5. 扫描文件夹添加缺失患者:
                从指定的文件夹扫描患者数据，添加数据库中缺失的患者记录。
+               只会重新扫描自上次扫描后修改时间发生变化的文件夹（传入 incremental=False 可强制完整扫描），
+               并报告已消失的文件夹。
+               方法:
+                   db_manager.scan_and_add_missing_patients(incremental=True)
+
+            6. 流式读取记录:
+               按筛选条件逐条读取记录，不会一次性读入整张表。查询共用少量只读连接，
+               不会阻塞同时运行的扫描或同步。
                方法:
-                   db_manager.scan_and_add_missing_patients()
+                   for record_id, patient_id, path in db_manager.iter_records(actual_file_type="NIfTI-1",
+                                                                            valid_only=True):
+                       ...
 
             示例:
                 db_manager = DBManager('patients.db', 'shant')
@@ -131,6 +377,11 @@ class DBManager:
             注意:
             - 确保 `full_dataset_path` 指向有效的患者数据文件夹。
             - 文件夹结构应为每个患者一个文件夹，文件夹名作为患者 ID，内部包含 `.nii` 文件。
+            - 嵌套子文件夹（例如 study/series/slice 结构的 DICOM）中的文件也会被递归扫描。可使用
+              DBManager(db_path, full_dataset_path, max_depth=..., include=[...], exclude=[...]) 限制递归深度
+              或按通配模式过滤文件名。
+            - 数据分布在多个磁盘上时，`full_dataset_path` 可以是根目录列表或 {source_id: 根目录} 字典，
+              每个设备由各自的线程池同时扫描，每条记录都带有所属的 source_id。
             """
         }
 
@@ -141,10 +392,17 @@ class DBManager:
     def connect_db(self):
         return sqlite3.connect(self.db_path)
 
-    def initialize_database(self):
-        if os.path.exists(self.db_path):
+    def initialize_database(self, assume_yes=None):
+        """
+        创建数据库表结构。数据库已存在时：assume_yes=True 备份旧文件后重新初始化；
+        assume_yes=False 保留现有数据，只补建缺失的表和索引；None 时交互询问。
+        """
+        if os.path.exists(self.db_path) and assume_yes is not False:
             while True:
-                response = input(f"数据库 '{self.db_path}' 已存在。是否重新初始化？(y/n): ").strip().lower()
+                if assume_yes:
+                    response = 'y'
+                else:
+                    response = input(f"数据库 '{self.db_path}' 已存在。是否重新初始化？(y/n): ").strip().lower()
                 if response == 'y':
                     # 重命名旧数据库文件
                     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
@@ -165,6 +423,8 @@ class DBManager:
         try:
             conn = self.connect_db()
             cursor = conn.cursor()
+            # WAL 模式下扫描写入不会阻塞其它读连接，且该设置会持久保存在数据库文件中
+            cursor.execute('PRAGMA journal_mode=WAL')
 
             # 创建表结构
             cursor.execute('''
@@ -177,6 +437,13 @@ class DBManager:
                     updated_at TEXT
                 )
             ''')
+            self._ensure_dir_snapshot_table(cursor)
+            self._ensure_sources(cursor)
+            self._ensure_indexes(cursor)
+            from summary import ensure_summary_tables
+            ensure_summary_tables(cursor)
+            from jobs import ensure_jobs_table
+            ensure_jobs_table(cursor)
             conn.commit()
             print("数据库表 'patient_data' 已创建或确认存在。")
         except Exception as e:
@@ -202,116 +469,871 @@ class DBManager:
         finally:
             conn.close()
 
-    def scan_and_add_patients(self):
-        conn = self.connect_db()
-        cursor = conn.cursor()
-        timestamp = datetime.now().isoformat()
+    def _table_columns(self, cursor, table_name):
+        cursor.execute(f"PRAGMA table_info({table_name});")
+        return [col[1] for col in cursor.fetchall()]
 
-        # 获取所有患者文件夹
-        patient_folders = [
-            os.path.join(self.full_dataset_path, folder)
-            for folder in os.listdir(self.full_dataset_path)
-            if os.path.isdir(os.path.join(self.full_dataset_path, folder))
-        ]
-
-        added_files = 0
-        tasks = []
-
-        # 多线程扫描和添加记录
-        def process_patient_folder(patient_path):
-            nonlocal added_files
-            patient_id = os.path.basename(patient_path)
-            local_added = 0
-
-            with self.connect_db() as local_conn:
-                local_cursor = local_conn.cursor()
-                for file in os.listdir(patient_path):
-                    file_path = os.path.join(patient_path, file)
-                    if os.path.isfile(file_path):
-                        file_type = os.path.splitext(file)[-1].lower()
-                        local_cursor.execute('SELECT 1 FROM patient_data WHERE file_path = ?', (file_path,))
-                        if not local_cursor.fetchone():
-                            try:
-                                local_cursor.execute('''
-                                    INSERT INTO patient_data (patient_id, file_path, file_type, created_at, updated_at)
-                                    VALUES (?, ?, ?, ?, ?)
-                                ''', (patient_id, file_path, file_type, timestamp, timestamp))
-                                local_added += 1
-                            except sqlite3.IntegrityError:
-                                pass
-                local_conn.commit()
-
-            added_files += local_added
-            return local_added
-
-        with ThreadPoolExecutor(max_workers=16) as executor:
-            for folder in patient_folders:
-                tasks.append(executor.submit(process_patient_folder, folder))
-
-            with tqdm(total=len(patient_folders), desc="扫描文件夹并添加患者", unit="folder") as pbar:
-                for future in as_completed(tasks):
-                    future.result()  # 等待线程完成
-                    pbar.update(1)
+    def _ensure_column(self, cursor, table_name, column_name, column_type):
+        if column_name not in self._table_columns(cursor, table_name):
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type};")
 
-        conn.close()
-        print(f"扫描完成，共添加了 {added_files} 条记录。")
+    def _ensure_indexes(self, cursor):
+        # 报表查询（data_explore/ 中的 GROUP BY）和按患者查找都依赖这些索引
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_data_patient_id ON patient_data(patient_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_data_file_type ON patient_data(file_type)')
+        if 'actual_file_type' in self._table_columns(cursor, 'patient_data'):
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_data_actual_file_type '
+                           'ON patient_data(actual_file_type)')
+
+    def _ensure_dir_snapshot_table(self, cursor):
+        # 目录快照表：记录每个已扫描目录的 mtime 和条目数，用于增量扫描
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS dir_snapshot (
+                path TEXT PRIMARY KEY,
+                parent_path TEXT,
+                mtime_ns INTEGER,
+                entry_count INTEGER,
+                last_scanned TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_dir_snapshot_parent ON dir_snapshot(parent_path)')
+        # 生成快照时的扫描设置（include / exclude / max_depth），设置变化后快照不能再用来跳过目录
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS dir_snapshot_meta (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+
+    def _ensure_sources(self, cursor):
+        # 数据源表：每个根目录一个 source_id，并记录最近一次扫描的吞吐量
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sources (
+                source_id TEXT PRIMARY KEY,
+                root_path TEXT,
+                device_kind TEXT,
+                last_scanned TEXT,
+                last_scan_files INTEGER,
+                last_scan_seconds REAL
+            )
+        ''')
+        self._ensure_column(cursor, 'patient_data', 'source_id', 'TEXT')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_data_source_id ON patient_data(source_id)')
+        for source_id, root in self.roots.items():
+            cursor.execute('''
+                INSERT INTO sources (source_id, root_path, device_kind) VALUES (?, ?, ?)
+                ON CONFLICT(source_id) DO UPDATE SET root_path = excluded.root_path, device_kind = excluded.device_kind
+            ''', (source_id, root, device_kind(root)))
+        if cursor.execute('SELECT 1 FROM patient_data WHERE source_id IS NULL LIMIT 1').fetchone():
+            # 引入数据源之前入库的记录按路径前缀补上 source_id（范围查询可以利用 file_path 上的唯一索引）
+            for source_id, root in self.roots.items():
+                prefix = root.rstrip(os.sep) + os.sep
+                cursor.execute(
+                    'UPDATE patient_data SET source_id = ? WHERE source_id IS NULL AND file_path >= ? AND file_path < ?',
+                    (source_id, prefix, prefix[:-1] + chr(ord(os.sep) + 1)))
+
+    def _scan_filters(self):
+        return json.dumps({"include": sorted(self.include or []), "exclude": sorted(self.exclude or []),
+                           "max_depth": self.max_depth}, sort_keys=True)
+
+    def _snapshot_filters_match(self, cursor):
+        # 没有快照时无所谓一致与否；旧版本生成的快照没有记录设置，按不一致处理
+        if cursor.execute('SELECT 1 FROM dir_snapshot LIMIT 1').fetchone() is None:
+            return True
+        row = cursor.execute("SELECT value FROM dir_snapshot_meta WHERE name = 'filters'").fetchone()
+        return row is not None and row[0] == self._scan_filters()
+
+    def _load_dir_snapshot(self, cursor):
+        cursor.execute('SELECT path, parent_path, mtime_ns, entry_count FROM dir_snapshot')
+        return {path: (parent, mtime_ns, entry_count) for path, parent, mtime_ns, entry_count in cursor.fetchall()}
+
+    def _snapshot_children(self, snapshot):
+        children = defaultdict(list)
+        for path, (parent, _, _) in snapshot.items():
+            if parent is not None:
+                children[parent].append(path)
+        return children
+
+    def _snapshot_mtime(self, st, scan_started_ns):
+        # 刚刚被修改过的目录不记录 mtime（exFAT/FAT 的 mtime 精度只有 2 秒），下次扫描时强制重新检查
+        if st.st_mtime_ns >= scan_started_ns - SNAPSHOT_SETTLE_NS:
+            return None
+        return st.st_mtime_ns
+
+    def _collect_patient_folders(self, root, snapshot, children, incremental, scan_started_ns):
+        """
+        返回根目录 root 下的 (患者文件夹列表 [(path, stat)], 已消失的文件夹列表, 根目录快照行)。
+        """
+        root_stat = os.stat(root)
+        known_children = set(children.get(root, ()))
+
+        root_record = snapshot.get(root)
+        if incremental and root_record is not None and root_record[1] == root_stat.st_mtime_ns:
+            # 根目录未变化：患者文件夹列表与上次相同，直接使用快照
+            root_entry_count = root_record[2]
+            patient_folders = []
+            disappeared = []
+            for patient_path in sorted(known_children):
+                try:
+                    patient_folders.append((patient_path, os.stat(patient_path)))
+                except FileNotFoundError:
+                    disappeared.append(patient_path)
+        else:
+            root_entry_count = len(os.listdir(root))
+            patient_folders = list_patient_folders(root, exclude=self.exclude)
+            disappeared = sorted(known_children - {path for path, _ in patient_folders})
+
+        root_row = (root, None, self._snapshot_mtime(root_stat, scan_started_ns), root_entry_count)
+        return patient_folders, disappeared, root_row
+
+    def _report_disappeared_folders(self, cursor, disappeared):
+        if not disappeared:
+            return
+        for path in disappeared:
+            # 同时删除该目录下所有子目录的快照
+            prefix = path + os.sep
+            cursor.execute('DELETE FROM dir_snapshot WHERE path = ? OR substr(path, 1, ?) = ?',
+                           (path, len(prefix), prefix))
+        print(f"发现 {len(disappeared)} 个文件夹已消失:")
+        for path in disappeared[:20]:
+            print(f" - {path}")
+        if len(disappeared) > 20:
+            print(f" ... 以及另外 {len(disappeared) - 20} 个")
 
-    def scan_and_add_missing_patients(self):
+    def scan_and_add_patients(self, preload="auto"):
+        self._scan_patient_folders(incremental=False, desc="扫描文件夹并添加患者", preload=preload)
+
+    def scan_and_add_missing_patients(self, incremental=True, preload="auto"):
+        """
+        扫描数据集并添加数据库中缺失的文件记录。
+
+        incremental=True 时只列举 mtime 与上次快照不同的目录（包括嵌套的 study/series 子目录），
+        并报告已消失的文件夹；incremental=False 时与 scan_and_add_patients 一样完整扫描。
+
+        preload 决定如何判断文件是否已入库：
+            "auto" - 完整扫描时预加载全部已知路径；增量扫描时只为有变化的患者文件夹按 patient_id 加载
+            "set"  - 预加载全部已知路径为 set
+            "hash" - 预加载全部已知路径的 64 位摘要（内存紧张时使用）
+            None   - 不预加载，全部交给写线程的 INSERT OR IGNORE 去重
+        """
+        return self._scan_patient_folders(incremental=incremental, desc="扫描文件夹", preload=preload)
+
+    def _scan_patient_folders(self, incremental, desc, preload="auto"):
         conn = self.connect_db()
         cursor = conn.cursor()
         timestamp = datetime.now().isoformat()
+        scan_started_ns = time.time_ns()
+
+        self._ensure_dir_snapshot_table(cursor)
+        self._ensure_sources(cursor)
+        self._ensure_indexes(cursor)
+        conn.commit()
+        if incremental and not self._snapshot_filters_match(cursor):
+            # 未变化的目录中，旧设置下被过滤掉的文件不在库里，按快照跳过就永远扫不到
+            print("扫描设置（include / exclude / max_depth）与上次扫描不同，本次进行完整扫描。")
+            incremental = False
+        snapshot = self._load_dir_snapshot(cursor)
+        children = self._snapshot_children(snapshot)
+
+        # 已入库路径索引：增量扫描时只有少数文件夹变化，按患者按需加载比加载全表更省
+        known_paths = None
+        per_patient_preload = preload == "auto" and incremental
+        if preload is not None and not per_patient_preload:
+            known_paths = KnownPathIndex.load(conn, mode=preload)
+            print(f"已预加载 {len(known_paths)} 条已知文件路径（{known_paths.mode} 模式）。")
+
+        # 获取每个数据源的所有患者文件夹
+        patient_folders = []
+        disappeared = []
+        root_rows = []
+        stats = {}
+        for source_id, root in self.roots.items():
+            try:
+                folders, missing, root_row = self._collect_patient_folders(
+                    root, snapshot, children, incremental, scan_started_ns
+                )
+            except OSError as e:
+                # 外接磁盘未挂载时跳过该数据源，不影响其它磁盘的扫描
+                print(f"无法访问数据源 {source_id}（{root}）: {e}，本次跳过。")
+                METRICS.inc("errors_total", stage="scan")
+                continue
+            stats[source_id] = {"folders": 0, "files": 0, "seconds": 0.0}
+            patient_folders.extend((source_id, root, folder, folder_stat) for folder, folder_stat in folders)
+            disappeared.extend(missing)
+            root_rows.append(root_row)
 
-        # 获取所有患者文件夹
-        patient_folders = [
-            os.path.join(self.full_dataset_path, folder)
-            for folder in os.listdir(self.full_dataset_path)
-            if os.path.isdir(os.path.join(self.full_dataset_path, folder))
-        ]
+        # 扫描线程只负责产生记录，由单个写线程批量写入数据库
+        writer = IngestWriter(self.db_path)
+        writer.start()
+
+        def process_patient_folder(source_id, root, patient_path, folder_stat):
+            rows = []
+            snapshot_rows = []
+            missing_dirs = []
+            checked = 0
+            lookup_seconds = 0.0
+            folder_started = time.perf_counter()
+            folder_known = known_paths
+
+            def is_unchanged(dir_path, dir_stat):
+                record = snapshot.get(dir_path)
+                if incremental and record is not None and record[1] == dir_stat.st_mtime_ns:
+                    return children.get(dir_path, [])
+                return None
+
+            def on_dir(dir_path, dir_stat, entry_count, subdirs):
+                parent = os.path.dirname(dir_path) if dir_path != patient_path else root
+                snapshot_rows.append((dir_path, parent, self._snapshot_mtime(dir_stat, scan_started_ns),
+                                      entry_count, timestamp))
+                missing_dirs.extend(set(children.get(dir_path, ())) - set(subdirs))
+
+            for patient_id, file_path, _, _ in walk_patient_files(
+                patient_path,
+                max_depth=self.max_depth,
+                include=self.include,
+                exclude=self.exclude,
+                stat_files=False,
+                root_stat=folder_stat,
+                is_unchanged=is_unchanged,
+                on_dir=on_dir,
+            ):
+                checked += 1
+                if per_patient_preload and folder_known is None:
+                    # 该患者文件夹有变化，第一次遇到文件时才加载其已知路径
+                    local_conn = self.connect_db()
+                    try:
+                        folder_known = KnownPathIndex.load(local_conn, mode="set", patient_id=patient_id)
+                    finally:
+                        local_conn.close()
+                if folder_known is not None:
+                    lookup_start = time.perf_counter()
+                    known = file_path in folder_known
+                    lookup_seconds += time.perf_counter() - lookup_start
+                    if known:
+                        continue
+                file_type = os.path.splitext(file_path)[-1].lower()
+                rows.append((patient_id, file_path, file_type, timestamp, timestamp, source_id))
+                if len(rows) >= writer.batch_size:
+                    writer.put_files(rows)
+                    rows = []
+            if rows:
+                writer.put_files(rows)
+
+            # 快照排在该文件夹的所有记录之后入队，写线程保证它不会先于这些记录提交
+            for row in snapshot_rows:
+                writer.put_snapshot(row)
+            if lookup_seconds:
+                METRICS.observe("scan_lookup_seconds", lookup_seconds)
+            METRICS.observe("scan_folder_seconds", time.perf_counter() - folder_started)
+            return source_id, checked, len(snapshot_rows), missing_dirs
 
         checked_files = 0
-        added_files = 0
-        tasks = []
-
-        # 多线程扫描和处理患者文件夹
-        def process_patient_folder(patient_path):
-            nonlocal added_files, checked_files
-            patient_id = os.path.basename(patient_path)
-            local_checked = 0
-            local_added = 0
-
-            with self.connect_db() as local_conn:
-                local_cursor = local_conn.cursor()
-                for file in os.listdir(patient_path):
-                    file_path = os.path.join(patient_path, file)
-                    if os.path.isfile(file_path):
-                        file_type = os.path.splitext(file)[-1].lower()
-                        local_cursor.execute('SELECT 1 FROM patient_data WHERE file_path = ?', (file_path,))
-                        local_checked += 1
-                        if not local_cursor.fetchone():
-                            try:
-                                local_cursor.execute('''
-                                    INSERT INTO patient_data (patient_id, file_path, file_type, created_at, updated_at)
-                                    VALUES (?, ?, ?, ?, ?)
-                                ''', (patient_id, file_path, file_type, timestamp, timestamp))
-                                local_added += 1
-                            except sqlite3.IntegrityError:
-                                pass  # 忽略重复文件
-                local_conn.commit()
-
-            added_files += local_added
-            checked_files += local_checked
-            return local_checked, local_added
-
-        # 使用线程池处理文件夹
-        with ThreadPoolExecutor(max_workers=16) as executor:
-            for folder in patient_folders:
-                tasks.append(executor.submit(process_patient_folder, folder))
-
-            with tqdm(total=len(patient_folders), desc="扫描文件夹", unit="folder") as pbar:
+        changed_dirs = 0
+        pools = {}
+        started = time.perf_counter()
+        try:
+            # 扫描只做 scandir / stat，并发可以高于整文件读取；机械硬盘上相应降低以减少寻道。
+            # 每个设备一个线程池，各磁盘同时扫描，慢盘不会拖住其它磁盘；记录统一交给同一个写线程
+            tasks = []
+            for source_id, root, folder, folder_stat in patient_folders:
+                dev = device_id(root)
+                if dev not in pools:
+                    pools[dev] = ThreadPoolExecutor(max_workers=metadata_workers(root))
+                tasks.append(pools[dev].submit(process_patient_folder, source_id, root, folder, folder_stat))
+
+            with tqdm(total=len(patient_folders), desc=desc, unit="folder") as pbar:
                 for future in as_completed(tasks):
-                    local_checked, local_added = future.result()
-                    pbar.set_postfix(checked_files=checked_files, added_files=added_files)
+                    source_id, checked, listed, missing_dirs = future.result()
+                    checked_files += checked
+                    changed_dirs += listed
+                    disappeared.extend(missing_dirs)
+                    source_stats = stats[source_id]
+                    source_stats["folders"] += 1
+                    source_stats["files"] += checked
+                    source_stats["seconds"] = time.perf_counter() - started
+                    pbar.set_postfix(checked_files=checked_files, added_files=writer.added)
                     pbar.update(1)
+        finally:
+            for pool in pools.values():
+                pool.shutdown()
+            writer.close()
 
+        # 所有文件夹处理完成后再更新根目录快照
+        cursor.executemany('''
+            INSERT OR REPLACE INTO dir_snapshot (path, parent_path, mtime_ns, entry_count, last_scanned)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [root_row + (timestamp,) for root_row in root_rows])
+        cursor.execute("INSERT OR REPLACE INTO dir_snapshot_meta (name, value) VALUES ('filters', ?)",
+                       (self._scan_filters(),))
+        for source_id, source_stats in stats.items():
+            cursor.execute('''
+                UPDATE sources SET last_scanned = ?, last_scan_files = ?, last_scan_seconds = ? WHERE source_id = ?
+            ''', (timestamp, source_stats["files"], source_stats["seconds"], source_id))
+            METRICS.inc("scan_source_files_total", source_stats["files"], source=source_id)
+            METRICS.observe("scan_source_seconds", source_stats["seconds"], source=source_id)
+        self._report_disappeared_folders(cursor, sorted(disappeared))
+        conn.commit()
         conn.close()
-        print(f"扫描完成，共检查了 {checked_files} 个文件，新增了 {added_files} 条记录。")
\ No newline at end of file
+        if incremental:
+            print(f"共 {len(patient_folders)} 个患者文件夹，重新列举了 {changed_dirs} 个有变化的目录。")
+        if len(self.roots) > 1:
+            self._report_source_throughput(stats, writer.added_by_source)
+        print(f"扫描完成，共检查了 {checked_files} 个文件，新增了 {writer.added} 条记录。")
+        return sorted(disappeared)
+
+    def _report_source_throughput(self, stats, added_by_source):
+        print("各数据源扫描情况（用时为从扫描开始到该数据源最后一个文件夹完成）:")
+        for source_id, source_stats in stats.items():
+            seconds = source_stats["seconds"]
+            rate = source_stats["files"] / seconds if seconds > 0 else 0.0
+            print(f" - {source_id:<16} {source_stats['folders']:>6} 个文件夹 {source_stats['files']:>9} 个文件 "
+                  f"新增 {added_by_source.get(source_id, 0):>8}  用时 {seconds:7.1f} 秒  {rate:9.0f} 文件/秒")
+
+    def update_actual_file_types(self, workers=None, checkpoint_every=2000):
+        """
+        并行检测所有未处理文件的实际类型（DICOM / NIfTI / MIME），结果分批提交，可中断后继续。
+        返回未找到的文件数。
+        """
+        from file_format import update_actual_file_types
+
+        conn = self.connect_db()
+        try:
+            cursor = conn.cursor()
+            self._ensure_column(cursor, 'patient_data', 'actual_file_type', 'TEXT')
+            self._ensure_indexes(cursor)
+            conn.commit()
+        finally:
+            conn.close()
+        return update_actual_file_types(self.db_path, workers=workers, checkpoint_every=checkpoint_every)
+
+    def verify_files(self, workers=None, delete_missing=False):
+        """
+        并行重新 stat 所有记录的文件（每个目录列举一次），记录 file_size / file_mtime_ns / is_present /
+        verified_at。之后可以直接在 SQL 中用 is_present 筛选，不必各处逐个检查文件是否存在；
+        大小或修改时间变化的文件会被清空派生数据，重新运行各阶段时重新计算。
+        :param delete_missing: 为 True 时删除文件已不存在的记录，否则只标记 is_present = 0
+        返回 {"checked", "present", "missing", "changed", "skipped"} 计数。
+        """
+        from verify import verify_files
+
+        return verify_files(self.db_path, workers=workers, delete_missing=delete_missing)
+
+    def fingerprint_files(self, workers=None):
+        """
+        计算文件内容指纹（大小 → 头尾预哈希 → 完整哈希），只有可能重复的文件才会被完整读取。
+        读取并发由 I/O 调度器按磁盘类型和实测吞吐量决定，workers 为上限。
+        返回无法读取的文件数。
+        """
+        from fingerprint import fingerprint_files
+
+        conn = self.connect_db()
+        try:
+            cursor = conn.cursor()
+            self._ensure_column(cursor, 'patient_data', 'file_size', 'INTEGER')
+            self._ensure_column(cursor, 'patient_data', 'pre_hash', 'TEXT')
+            self._ensure_column(cursor, 'patient_data', 'content_hash', 'TEXT')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_data_size_pre_hash '
+                           'ON patient_data(file_size, pre_hash)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_data_content_hash ON patient_data(content_hash)')
+            conn.commit()
+        finally:
+            conn.close()
+        return fingerprint_files(self.db_path, workers=workers)
+
+    def find_duplicate_files(self, min_copies=2):
+        """
+        返回内容完全相同的文件组，按可节省的字节数从大到小排列：
+        [(content_hash, file_size, [(id, patient_id, file_path), ...]), ...]
+        需要先运行 fingerprint_files()。
+        """
+        conn = self.connect_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT p.content_hash, p.file_size, p.id, p.patient_id, p.file_path
+                FROM patient_data p
+                JOIN (
+                    SELECT content_hash, COUNT(*) AS copies, MAX(file_size) AS size FROM patient_data
+                    WHERE content_hash IS NOT NULL
+                    GROUP BY content_hash HAVING COUNT(*) >= ?
+                ) d ON d.content_hash = p.content_hash
+                ORDER BY (d.copies - 1) * d.size DESC, p.content_hash, p.id
+            ''', (min_copies,))
+            groups = []
+            for content_hash, file_size, record_id, patient_id, file_path in cursor.fetchall():
+                if not groups or groups[-1][0] != content_hash:
+                    groups.append((content_hash, file_size, []))
+                groups[-1][2].append((record_id, patient_id, file_path))
+            return groups
+        finally:
+            conn.close()
+
+    def duplicate_record_ids(self):
+        """
+        返回可在分析前丢弃的重复副本记录 id（每组内容相同的文件只保留 id 最小的一条）。
+        """
+        conn = self.connect_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id FROM patient_data p
+                WHERE content_hash IS NOT NULL AND id > (
+                    SELECT MIN(id) FROM patient_data WHERE content_hash = p.content_hash
+                )
+                ORDER BY id
+            ''')
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            conn.close()
+
+    def extract_dicom_metadata(self, workers=None):
+        """
+        并行读取 DICOM 文件头中需要的标签，写入规范化的 study / series / instance 表，
+        之后可直接用 SQL 进行队列筛选而无需重新打开文件。
+        返回读取失败的文件数。
+        """
+        from dicom_meta import ensure_metadata_tables, extract_dicom_metadata
+
+        conn = self.connect_db()
+        try:
+            cursor = conn.cursor()
+            self._ensure_column(cursor, 'patient_data', 'meta_status', 'TEXT')
+            ensure_metadata_tables(cursor)
+            conn.commit()
+        finally:
+            conn.close()
+        return extract_dicom_metadata(self.db_path, workers=workers)
+
+    def assemble_series_volumes(self, cache_dir, workers=None, compress=False):
+        """
+        将逐切片存储的 DICOM 序列按位置排序组装为 3D 体数据并缓存为 NIfTI，缓存路径记录在 series 表中。
+        需要先运行 extract_dicom_metadata()；切片未变化的序列在之后的运行中会被跳过。
+        返回组装失败的序列数。
+        """
+        from dicom_meta import ensure_metadata_tables
+        from volume import assemble_series_volumes
+
+        conn = self.connect_db()
+        try:
+            cursor = conn.cursor()
+            ensure_metadata_tables(cursor)
+            self._ensure_column(cursor, 'series', 'volume_path', 'TEXT')
+            self._ensure_column(cursor, 'series', 'volume_signature', 'TEXT')
+            self._ensure_column(cursor, 'series', 'volume_slices', 'INTEGER')
+            self._ensure_column(cursor, 'series', 'volume_updated_at', 'TEXT')
+            conn.commit()
+        finally:
+            conn.close()
+        return assemble_series_volumes(self.db_path, cache_dir, workers=workers, compress=compress)
+
+    def compute_intensity_stats(self, workers=None, slab_size=16, volume_cache=None, volume_cache_bytes=None):
+        """
+        以 slab 为单位流式读取每个 NIfTI 体数据，单遍计算 min / max / mean / std 和固定分箱直方图，
+        在进程池中并行执行并分批写回 patient_data。
+        :param volume_cache: 已解码体数据的缓存目录（见 volume_cache），重复运行时不再解压；
+                             volume_cache_bytes 为缓存总大小上限，默认 50 GiB
+        返回处理失败的文件数。
+        """
+        from intensity import compute_intensity_stats
+
+        conn = self.connect_db()
+        try:
+            cursor = conn.cursor()
+            for column_name, column_type in (
+                ('brightness_max', 'REAL'),
+                ('brightness_min', 'REAL'),
+                ('brightness_avg', 'REAL'),
+                ('brightness_std', 'REAL'),
+                ('brightness_hist', 'BLOB'),
+                ('brightness_hist_spec', 'TEXT'),
+                ('intensity_status', 'TEXT'),
+            ):
+                self._ensure_column(cursor, 'patient_data', column_name, column_type)
+            conn.commit()
+        finally:
+            conn.close()
+        return compute_intensity_stats(self.db_path, workers=workers, slab_size=slab_size, cache_dir=volume_cache,
+                                       cache_bytes=volume_cache_bytes)
+
+    def build_sample_store(self, store_dir, num_slices=5, target_shape=(50, 50), workers=None, volume_cache=None,
+                           volume_cache_bytes=None):
+        """
+        为每条 NIfTI 记录一次性生成 (num_slices, H, W) 的训练样本，写入内存映射分片并建立 sample_index 索引。
+        之后可用 sample_store.SampleStoreDataset 零拷贝读取，训练时无需再解码体数据。
+        volume_cache / volume_cache_bytes 同 compute_intensity_stats。
+        返回处理失败的记录数。
+        """
+        from sample_store import build_sample_store, ensure_sample_index_table
+
+        conn = self.connect_db()
+        try:
+            ensure_sample_index_table(conn.cursor())
+            conn.commit()
+        finally:
+            conn.close()
+        return build_sample_store(self.db_path, store_dir, num_slices=num_slices, target_shape=target_shape,
+                                  workers=workers, cache_dir=volume_cache, cache_bytes=volume_cache_bytes)
+
+    def build_embeddings(self, encoder, model, sample_dir, embedding_dir, num_slices=5, target_shape=(50, 50),
+                         batch_size=64, threads=None, normalize=False):
+        """
+        在 CPU 上批量运行 encoder（例如 notebook 中训练好的 Autoencoder.encoder），为样本库中的每条记录
+        计算嵌入，写入 float32 内存映射分片并建立 embedding_index 索引。需要先运行 build_sample_store()，
+        输入直接来自样本库，不再解码体数据；重新运行只处理新增的记录。
+        :param model: 编码器名称，换了模型或权重时应使用新的名称
+        """
+        from embeddings import build_embeddings
+
+        build_embeddings(self.db_path, sample_dir, embedding_dir, encoder, model, num_slices=num_slices,
+                         target_shape=target_shape, batch_size=batch_size, threads=threads, normalize=normalize)
+
+    def cluster_embeddings(self, embedding_dir, model, k, column="cluster_label", epochs=3, seed=0):
+        """
+        对某个模型的全部嵌入做流式 Mini-Batch K-Means，并把标签批量写入 patient_data 的 column 列。
+        只读取已保存的嵌入，换一个 k 重新聚类不需要重新编码。返回 {标签: 记录数}。
+        """
+        from embeddings import EmbeddingStore, minibatch_kmeans, write_cluster_labels
+
+        store = EmbeddingStore(self.db_path, embedding_dir, model)
+        _, labels = minibatch_kmeans(store, k, epochs=epochs, seed=seed)
+        conn = self.connect_db()
+        try:
+            write_cluster_labels(conn, store.record_ids, labels, column=column)
+        finally:
+            conn.close()
+        print(f"已将 {len(labels)} 条记录聚为 {k} 类，标签写入 patient_data.{column}。")
+        return {label: int((labels == label).sum()) for label in range(k)}
+
+    def nearest_records(self, embedding_dir, model, record_id=None, vector=None, limit=10, metric="cosine"):
+        """
+        返回嵌入与给定记录（或向量）最接近的记录 [(record_id, distance), ...]，按距离升序；
+        以记录查询时结果中不包含该记录本身。
+        """
+        from embeddings import EmbeddingStore, nearest_records
+
+        store = EmbeddingStore(self.db_path, embedding_dir, model)
+        if vector is not None:
+            return nearest_records(store, vector, limit=limit, metric=metric)
+        results = nearest_records(store, store.vector(record_id), limit=limit + 1, metric=metric)
+        return [(rid, distance) for rid, distance in results if rid != record_id][:limit]
+
+    def _table_exists(self, cursor, table_name):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
+        return cursor.fetchone() is not None
+
+    def slice_source(self, record_id=None, series_uid=None):
+        """
+        返回一条记录（或一个 DICOM 序列）的切片读取器，提供 num_slices 属性和 read(indices) 方法，
+        只读取被请求的切片而不解码整个体数据。
+
+        逐切片存储的 DICOM 记录（已运行 extract_dicom_metadata）会返回其所在序列的读取器，
+        第 i 张切片直接读取排序后的第 i 个文件。
+        """
+        from volume import DicomSeriesSliceSource, open_slice_source, series_slice_paths
+
+        conn = self.connect_db()
+        try:
+            cursor = conn.cursor()
+            file_path = None
+            if series_uid is None:
+                cursor.execute('SELECT file_path FROM patient_data WHERE id = ?', (record_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    raise ValueError(f"记录 {record_id} 不存在。")
+                file_path = row[0]
+                if self._table_exists(cursor, 'instance'):
+                    cursor.execute('SELECT series_uid FROM instance WHERE record_id = ?', (record_id,))
+                    row = cursor.fetchone()
+                    if row is not None:
+                        series_uid = row[0]
+            if series_uid is not None:
+                return DicomSeriesSliceSource(series_slice_paths(conn, series_uid))
+            return open_slice_source(file_path)
+        finally:
+            conn.close()
+
+    def read_slices(self, indices, record_id=None, series_uid=None):
+        """
+        只读取指定下标的切片，返回 (len(indices), height, width) 的数组。
+        """
+        return self.slice_source(record_id=record_id, series_uid=series_uid).read(indices)
+
+    def rank_similarity(self, references, target_shape=(100, 100), num_slices=10, workers=None,
+                        refine_top=3, min_coarse_ncc=None, volume_cache=None, volume_cache_bytes=None):
+        """
+        将所有 NIfTI 记录与一张或多张基准切片比较（SSIM + NCC），结果按基准写入 similarity 表。
+
+        :param references: [(reference_path, slice_index), ...]
+        :param refine_top: 每条记录做全分辨率 SSIM 的切片数，其余切片只参与降采样粗筛
+        :param min_coarse_ncc: 粗筛 NCC 低于该值的记录不做 SSIM 精算
+        volume_cache / volume_cache_bytes 同 compute_intensity_stats。
+        返回各基准的 reference_id，用于 top_similar()。
+        """
+        from similarity import ensure_similarity_tables, rank_similarity
+
+        conn = self.connect_db()
+        try:
+            ensure_similarity_tables(conn.cursor())
+            conn.commit()
+        finally:
+            conn.close()
+        return rank_similarity(self.db_path, references, target_shape=target_shape, num_slices=num_slices,
+                               workers=workers, refine_top=refine_top, min_coarse_ncc=min_coarse_ncc,
+                               cache_dir=volume_cache, cache_bytes=volume_cache_bytes)
+
+    def top_similar(self, reference_id, limit=10):
+        """
+        返回与基准最相似的记录：[(record_id, patient_id, file_path, ssim, ncc, best_slice), ...]，按 SSIM 降序。
+        """
+        conn = self.connect_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT s.record_id, p.patient_id, p.file_path, s.ssim, s.ncc, s.best_slice
+                FROM similarity s JOIN patient_data p ON p.id = s.record_id
+                WHERE s.reference_id = ? AND s.ssim IS NOT NULL
+                ORDER BY s.ssim DESC
+                LIMIT ?
+            ''', (reference_id, limit))
+            return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def read_pool(self, size=4):
+        """
+        返回（必要时创建）只读连接池，供 iter_records 等查询共用。
+        """
+        if self._read_pool is None:
+            from query import ReadPool
+            self._read_pool = ReadPool(self.db_path, size=size)
+        return self._read_pool
+
+    def iter_record_batches(self, columns=("id", "patient_id", "file_path"), patient_id=None, file_type=None,
+                            actual_file_type=None, source_id=None, reference_id=None, min_ssim=None,
+                            max_ssim=None, valid_only=False, order="id", page_size=1000, batch_size=256):
+        """
+        分批产生满足条件的记录 [(columns...), ...]，适合把每批直接交给线程池 / 进程池处理。
+
+        :param columns: 返回的列，可以是 patient_data 的列；指定 reference_id 时还可以是 ssim / ncc / best_slice
+        :param patient_id: 患者 ID 或 ID 列表；file_type / actual_file_type / source_id 同理
+        :param reference_id: rank_similarity() 返回的基准 ID，只返回已有相似度的记录
+        :param min_ssim: 相似度下限（含），max_ssim 为上限（含）
+        :param valid_only: 只返回磁盘上仍然存在的文件
+        :param order: "id" 按记录 ID 升序；"ssim" 按相似度从高到低（需要 reference_id）
+        """
+        from query import iter_record_batches
+
+        exists_workers = max((metadata_workers(root) for root in self.roots.values()), default=16)
+        return iter_record_batches(self.read_pool(), columns, patient_id=patient_id, file_type=file_type,
+                                   actual_file_type=actual_file_type, source_id=source_id,
+                                   reference_id=reference_id, min_ssim=min_ssim, max_ssim=max_ssim,
+                                   valid_only=valid_only, order=order, page_size=page_size,
+                                   batch_size=batch_size, exists_workers=exists_workers)
+
+    def iter_records(self, columns=("id", "patient_id", "file_path"), **filters):
+        """
+        逐条产生满足条件的记录，参数见 iter_record_batches。例如按相似度从高到低读取存在的 NIfTI 文件：
+
+            for path, ssim in db_manager.iter_records(("file_path", "ssim"), reference_id=1, order="ssim",
+                                                      actual_file_type="NIfTI-1", valid_only=True):
+                ...
+        """
+        for records in self.iter_record_batches(columns, **filters):
+            yield from records
+
+    def build_previews(self, max_size=128, window=None, workers=None, volume_cache=None, volume_cache_bytes=None):
+        """
+        为所有 NIfTI 记录并行生成窗宽窗位后的中间切片缩略图，缓存在 preview 表中；
+        只有文件发生变化（大小或修改时间）时才会重新生成。
+        :param window: (窗位, 窗宽)，默认按 1% / 99% 分位数自动取窗
+        volume_cache / volume_cache_bytes 同 compute_intensity_stats。
+        返回处理失败的文件数。
+        """
+        from preview import build_previews, ensure_preview_table
+
+        conn = self.connect_db()
+        try:
+            ensure_preview_table(conn.cursor())
+            conn.commit()
+        finally:
+            conn.close()
+        return build_previews(self.db_path, max_size=max_size, window=window, workers=workers,
+                              cache_dir=volume_cache, cache_bytes=volume_cache_bytes)
+
+    def show_similarity_gallery(self, reference_id, limit=50, columns=10, max_size=128, window=None):
+        """
+        按相似度从高到低显示缩略图画廊，直接使用缓存的缩略图，缺失或过期的在显示前补齐。
+        """
+        from preview import ensure_preview_table, load_previews, show_gallery
+
+        ranked = self.top_similar(reference_id, limit=limit)
+        conn = self.connect_db()
+        try:
+            ensure_preview_table(conn.cursor())
+            conn.commit()
+            previews = load_previews(conn, [(row[0], row[2]) for row in ranked], max_size=max_size, window=window)
+        finally:
+            conn.close()
+        shown = [row for row in ranked if row[0] in previews]
+        show_gallery([previews[row[0]] for row in shown],
+                     titles=[f"{row[1]} SSIM: {row[3]:.4f}" for row in shown], columns=columns)
+
+    def _summary_counts(self, table, limit=None):
+        from summary import ensure_summary_tables, summary_counts
+
+        conn = self.connect_db()
+        try:
+            cursor = conn.cursor()
+            ensure_summary_tables(cursor)
+            conn.commit()
+            return summary_counts(cursor, table, limit=limit)
+        finally:
+            conn.close()
+
+    def file_type_counts(self):
+        """
+        按扩展名统计的文件数 [(file_type, count), ...]，读取由触发器维护的汇总表，耗时与记录总数无关。
+        """
+        return self._summary_counts('summary_file_type')
+
+    def actual_file_type_counts(self):
+        """
+        按实际文件类型统计的文件数 [(actual_file_type, count), ...]，尚未检测的记录计入 None。
+        """
+        return self._summary_counts('summary_actual_file_type')
+
+    def patient_file_counts(self, limit=None):
+        """
+        每个患者的文件数 [(patient_id, count), ...]，按数量从大到小排列。
+        """
+        return self._summary_counts('summary_patient', limit=limit)
+
+    def inventory_summary(self):
+        """
+        返回 {'files': 总文件数, 'patients': 患者数, 'file_types': 扩展名种类数}。
+        """
+        from summary import ensure_summary_tables
+
+        conn = self.connect_db()
+        try:
+            cursor = conn.cursor()
+            ensure_summary_tables(cursor)
+            conn.commit()
+            files, patients = cursor.execute('SELECT COALESCE(SUM(count), 0), COUNT(*) FROM summary_patient').fetchone()
+            file_types = cursor.execute('SELECT COUNT(*) FROM summary_file_type').fetchone()[0]
+            return {'files': files, 'patients': patients, 'file_types': file_types}
+        finally:
+            conn.close()
+
+    def rebuild_summaries(self):
+        """
+        从 patient_data 重新计算汇总表（正常情况下触发器会保持汇总同步，仅用于修复）。
+        """
+        from summary import ensure_summary_tables, rebuild_summaries
+
+        conn = self.connect_db()
+        try:
+            cursor = conn.cursor()
+            ensure_summary_tables(cursor)
+            rebuild_summaries(cursor)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def run_pipeline(self, analyzers=("file_type", "hash", "intensity"), references=None, workers=None, **kwargs):
+        """
+        单遍分析：每个文件只读一次，同时运行文件类型嗅探、指纹、亮度统计等分析器，结果在同一事务中批量写回。
+
+        :param analyzers: 分析器名称或 pipeline.Analyzer 实例的列表，可用 pipeline.register_analyzer 注册新的分析器
+        :param references: [(reference_path, slice_index), ...]，提供时同时计算与基准切片的相似度，其余参数见 rank_similarity
+        返回错误数（每个文件的每个出错的分析器计一次）。
+        """
+        from pipeline import SimilarityAnalyzer, run_pipeline
+
+        analyzers = list(analyzers)
+        if references:
+            analyzers.append(SimilarityAnalyzer(references, **kwargs))
+        return run_pipeline(self.db_path, analyzers, workers=workers)
+
+    def metrics(self):
+        """
+        返回当前进程的指标快照：各阶段文件数和读取字节数（附带每秒速率），以及扫描、解码、
+        SQLite 插入 / 提交等环节的延迟直方图。用于判断瓶颈在磁盘、CPU 解码还是数据库写锁。
+        """
+        return METRICS.snapshot()
+
+    def export_metrics(self, path, fmt=None):
+        """
+        把当前指标写入文件；fmt 为 "json" 或 "prometheus"，默认按扩展名判断（.prom 为 Prometheus 文本格式）。
+        """
+        METRICS.write(path, fmt)
+
+    def start_metrics_reporter(self, interval=10.0, json_path=None, prometheus_path=None, callback=None):
+        """
+        启动后台线程，每 interval 秒调用 callback(snapshot) 并写出 JSON / Prometheus 文件。
+        返回 MetricsReporter，长时间任务结束后调用其 stop() 停止（会再汇报一次）。
+        """
+        from metrics import MetricsReporter
+
+        reporter = MetricsReporter(METRICS, interval=interval, json_path=json_path,
+                                   prometheus_path=prometheus_path, callback=callback)
+        reporter.start()
+        return reporter
+
+    def live_sync(self, method="auto", debounce=2.0, max_delay=30.0, poll_interval=60.0, initial_sync=False,
+                  duration=None):
+        """
+        持续监视 full_dataset_path，把文件的新增、改写、删除和移动批量同步到数据库，无需重新扫描。
+        阻塞运行直到按下 Ctrl+C（或 duration 秒后），返回累计的 {inserted, updated, deleted, moved}。
+
+        :param method: "inotify"、"poll" 或 "auto"（优先 inotify，不可用时退回轮询）。
+                       网络共享上其它主机做的修改 inotify 看不到，此时应使用 "poll"
+        :param debounce: 最后一个事件之后等待多少秒再写入数据库
+        :param max_delay: 事件持续不断时，最多积累多少秒就写入一次
+        :param poll_interval: 轮询模式下两次遍历之间的间隔（秒）
+        :param initial_sync: 启动时先完整比对一次数据库与文件系统，补上停止监视期间的新增和删除
+        """
+        from live_sync import LiveSync
+
+        conn = self.connect_db()
+        try:
+            cursor = conn.cursor()
+            self._ensure_dir_snapshot_table(cursor)
+            self._ensure_sources(cursor)
+            conn.commit()
+        finally:
+            conn.close()
+        syncs = []
+        for source_id, root in self.roots.items():
+            if not os.path.isdir(root):
+                print(f"无法访问数据源 {source_id}（{root}），不监视该目录。")
+                continue
+            syncs.append(LiveSync(self.db_path, root, max_depth=self.max_depth, include=self.include,
+                                  exclude=self.exclude, method=method, debounce=debounce, max_delay=max_delay,
+                                  poll_interval=poll_interval, source_id=source_id))
+        if not syncs:
+            return {"inserted": 0, "updated": 0, "deleted": 0, "moved": 0}
+        if len(syncs) == 1:
+            return syncs[0].run(duration=duration, initial_sync=initial_sync)
+
+        # 多个数据源：每个根目录一个监视线程，Ctrl+C 时通知所有线程应用剩余事件后退出
+        stop_event = threading.Event()
+        threads = [threading.Thread(target=sync.run, daemon=True,
+                                    kwargs=dict(duration=duration, initial_sync=initial_sync, stop_event=stop_event))
+                   for sync in syncs]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            print("正在停止同步...")
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+        totals = defaultdict(int)
+        for sync in syncs:
+            for action, count in sync.totals.items():
+                totals[action] += count
+        return dict(totals)
@@ -0,0 +1,195 @@
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import pydicom
+from tqdm import tqdm
+
+from io_sched import default_workers, device_gate
+from metrics import METRICS, imap_instrumented
+from parallel import keyset_chunks
+from record_filter import dicom_condition
+
+# 只读取这些标签，跳过像素数据和其余头部
+DICOM_TAGS = [
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "InstanceNumber",
+    "ImagePositionPatient",
+    "ImageOrientationPatient",
+    "PixelSpacing",
+    "Rows",
+    "Columns",
+    "KVP",
+    "AcquisitionTime",
+]
+
+
+def ensure_metadata_tables(cursor):
+    """
+    创建规范化的 study / series / instance 表及其索引。instance.record_id 对应 patient_data.id。
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS study (
+            study_uid TEXT PRIMARY KEY,
+            patient_id TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS series (
+            series_uid TEXT PRIMARY KEY,
+            study_uid TEXT,
+            image_rows INTEGER,
+            image_columns INTEGER,
+            pixel_spacing_row REAL,
+            pixel_spacing_col REAL,
+            orientation TEXT,
+            kvp REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS instance (
+            record_id INTEGER PRIMARY KEY,
+            series_uid TEXT,
+            instance_number INTEGER,
+            position_x REAL,
+            position_y REAL,
+            position_z REAL,
+            acquisition_time TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_study_patient_id ON study(patient_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_series_study_uid ON series(study_uid)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_instance_series ON instance(series_uid, instance_number)')
+
+
+def _float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_dicom_metadata(file_path):
+    """
+    只解析需要的标签，返回字段字典；不是 DICOM 或缺少 UID 时返回 None。
+    """
+    ds = pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=DICOM_TAGS, force=True)
+    study_uid = ds.get("StudyInstanceUID")
+    series_uid = ds.get("SeriesInstanceUID")
+    if not study_uid or not series_uid:
+        return None
+
+    position = ds.get("ImagePositionPatient") or [None, None, None]
+    spacing = ds.get("PixelSpacing") or [None, None]
+    orientation = ds.get("ImageOrientationPatient")
+    return {
+        "study_uid": str(study_uid),
+        "series_uid": str(series_uid),
+        "instance_number": _int_or_none(ds.get("InstanceNumber")),
+        "position": tuple(_float_or_none(v) for v in position),
+        "pixel_spacing": tuple(_float_or_none(v) for v in spacing),
+        "orientation": "\\".join(str(float(v)) for v in orientation) if orientation else None,
+        "rows": _int_or_none(ds.get("Rows")),
+        "columns": _int_or_none(ds.get("Columns")),
+        "kvp": _float_or_none(ds.get("KVP")),
+        "acquisition_time": str(ds.get("AcquisitionTime")) if ds.get("AcquisitionTime") else None,
+    }
+
+
+def _extract_chunk(records):
+    results = []
+    for record_id, patient_id, file_path in records:
+        if not os.path.exists(file_path):
+            results.append((record_id, patient_id, "missing", None))
+            continue
+        try:
+            meta = read_dicom_metadata(file_path)
+            results.append((record_id, patient_id, "ok" if meta else "not_dicom", meta))
+        except Exception:
+            results.append((record_id, patient_id, "error", None))
+    return results
+
+
+def _write_batch(conn, results):
+    studies, series, instances, statuses = [], [], [], []
+    for record_id, patient_id, status, meta in results:
+        statuses.append((status, record_id))
+        if meta is None:
+            continue
+        studies.append((meta["study_uid"], patient_id))
+        series.append((meta["series_uid"], meta["study_uid"], meta["rows"], meta["columns"],
+                       meta["pixel_spacing"][0], meta["pixel_spacing"][1], meta["orientation"], meta["kvp"]))
+        x, y, z = (meta["position"] + (None, None, None))[:3]
+        instances.append((record_id, meta["series_uid"], meta["instance_number"], x, y, z, meta["acquisition_time"]))
+
+    with METRICS.transaction(conn, "dicom_meta"):
+        conn.executemany("INSERT OR IGNORE INTO study (study_uid, patient_id) VALUES (?, ?)", studies)
+        conn.executemany('''
+            INSERT OR IGNORE INTO series (series_uid, study_uid, image_rows, image_columns,
+                                          pixel_spacing_row, pixel_spacing_col, orientation, kvp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', series)
+        conn.executemany('''
+            INSERT OR REPLACE INTO instance (record_id, series_uid, instance_number,
+                                             position_x, position_y, position_z, acquisition_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', instances)
+        conn.executemany("UPDATE patient_data SET meta_status = ? WHERE id = ?", statuses)
+
+
+def extract_dicom_metadata(db_path, workers=None, chunk_size=64, batch_size=2000):
+    """
+    并行读取所有尚未处理的 DICOM 文件头，批量写入 study / series / instance 表。
+
+    每条记录处理后在 patient_data.meta_status 中记录结果（ok / not_dicom / missing / error），
+    因此中断后重新运行只会处理剩下的文件。返回读取失败（error / missing）的文件数。
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        gate_of = device_gate(lambda chunk: chunk[0][2], kind="metadata", max_workers=workers)
+        workers = workers or default_workers(kind="metadata")
+        columns = [col[1] for col in conn.execute("PRAGMA table_info(patient_data);")]
+        condition = dicom_condition(detected="actual_file_type" in columns)
+
+        total = conn.execute(
+            f"SELECT COUNT(*) FROM patient_data WHERE meta_status IS NULL AND {condition}"
+        ).fetchone()[0]
+        print(f"需要读取文件头的 DICOM 文件数: {total}")
+
+        chunks = keyset_chunks(
+            conn,
+            f"SELECT id, patient_id, file_path FROM patient_data "
+            f"WHERE meta_status IS NULL AND {condition} AND id > ? ORDER BY id LIMIT ?",
+            chunk_size=chunk_size,
+        )
+        pending = []
+        counts = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+                tqdm(total=total, desc="读取 DICOM 文件头", unit="文件") as pbar:
+            for _, results in imap_instrumented(executor, _extract_chunk, chunks, workers * 4,
+                                                 stage="dicom_meta", gate_of=gate_of):
+                pending.extend(results)
+                for result in results:
+                    counts[result[2]] = counts.get(result[2], 0) + 1
+                pbar.update(len(results))
+                METRICS.inc("files_total", len(results), stage="dicom_meta")
+                if len(pending) >= batch_size:
+                    _write_batch(conn, pending)
+                    pending = []
+            if pending:
+                _write_batch(conn, pending)
+
+        print("DICOM 元数据提取完成: " + ", ".join(f"{k}={v}" for k, v in sorted(counts.items())))
+        errors = counts.get("error", 0) + counts.get("missing", 0)
+        METRICS.inc("errors_total", errors, stage="dicom_meta")
+        return errors
+    finally:
+        conn.close()
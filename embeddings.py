@@ -0,0 +1,297 @@
+import os
+import sqlite3
+import uuid
+from datetime import datetime
+
+import numpy as np
+from tqdm import tqdm
+
+from metrics import METRICS
+from sample_store import sample_config
+
+
+def ensure_embedding_index_table(cursor):
+    # 嵌入索引：每条记录对应某个分片文件（.npy，形状 (N, D) 的 float32 矩阵）中的一行，model 为编码器名称
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS embedding_index (
+            model TEXT,
+            record_id INTEGER,
+            shard TEXT,
+            row INTEGER,
+            created_at TEXT,
+            PRIMARY KEY (model, record_id)
+        )
+    ''')
+
+
+def _as_encoder(encoder, threads):
+    """
+    把编码器包装为 numpy (B, ...) float32 -> (B, D) float32 的函数。
+    torch 模块（例如 notebook 中的 Autoencoder.encoder）在 CPU 上以 inference_mode 运行。
+    """
+    if not hasattr(encoder, "parameters"):
+        return lambda batch: np.asarray(encoder(batch), dtype=np.float32).reshape(len(batch), -1)
+
+    import torch
+
+    if threads:
+        torch.set_num_threads(threads)
+    encoder = encoder.to("cpu").eval()
+
+    def run(batch):
+        with torch.inference_mode():
+            output = encoder(torch.from_numpy(batch))
+        if isinstance(output, (tuple, list)):
+            # Autoencoder.forward 返回 (encoded, decoded)
+            output = output[0]
+        return output.reshape(len(batch), -1).numpy().astype(np.float32, copy=False)
+
+    return run
+
+
+def _sample_batches(store_dir, rows, batch_size, normalize):
+    """
+    按分片顺序从样本库读取 rows [(record_id, shard, row)]，逐批产生 (record_ids, (B, S, H, W) 数组)。
+    """
+    shards = {}
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        samples = []
+        for _, shard_name, row in batch:
+            shard = shards.get(shard_name)
+            if shard is None:
+                shard = shards[shard_name] = np.load(os.path.join(store_dir, shard_name), mmap_mode="r")
+            samples.append(shard[row])
+        samples = np.stack(samples).astype(np.float32, copy=False)
+        if normalize:
+            # 与 SampleStoreDataset(normalize=True) 相同的逐样本 min-max 归一化
+            axes = tuple(range(1, samples.ndim))
+            lo = samples.min(axis=axes, keepdims=True)
+            span = samples.max(axis=axes, keepdims=True) - lo
+            samples = np.where(span > 0, (samples - lo) / np.where(span > 0, span, 1), 0).astype(np.float32)
+        yield [record_id for record_id, _, _ in batch], samples
+
+
+def build_embeddings(db_path, sample_dir, embedding_dir, encoder, model, num_slices=5, target_shape=(50, 50),
+                     batch_size=64, threads=None, normalize=False, checkpoint_every=2000):
+    """
+    用 encoder 为样本库中尚未编码的记录批量计算嵌入，写入一个连续的 float32 内存映射分片
+    （.npy，形状 (N, D)），并在 embedding_index 表中记录每条记录所在的行。
+
+    输入直接取自 build_sample_store 生成的 (num_slices, H, W) 样本，不再解码体数据；
+    每 checkpoint_every 条刷新一次分片并提交索引，中断后重新运行只处理没有嵌入的记录。
+    :param encoder: torch 模块（如 Autoencoder.encoder）或 numpy 批处理函数
+    :param model: 编码器名称，不同的模型 / 权重应使用不同的名称
+    :param threads: CPU 推理线程数，默认由 torch 决定
+    """
+    os.makedirs(embedding_dir, exist_ok=True)
+    config = sample_config(num_slices, target_shape)
+    conn = sqlite3.connect(db_path)
+    try:
+        ensure_embedding_index_table(conn.cursor())
+        conn.commit()
+        rows = conn.execute('''
+            SELECT s.record_id, s.shard, s.row FROM sample_index s
+            WHERE s.config = ? AND NOT EXISTS (
+                SELECT 1 FROM embedding_index e WHERE e.model = ? AND e.record_id = s.record_id
+            )
+            ORDER BY s.shard, s.row
+        ''', (config, model)).fetchall()
+        print(f"需要计算嵌入的记录数: {len(rows)}（模型 {model}，样本配置 {config}）")
+        if not rows:
+            return
+
+        encode = _as_encoder(encoder, threads)
+        shard_name = f"embeddings_{model}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}.npy"
+        shard_path = os.path.join(embedding_dir, shard_name)
+        shard = None
+        next_row = 0
+        pending = []
+
+        def checkpoint():
+            if pending:
+                # 先把分片数据落盘，再提交指向这些行的索引
+                shard.flush()
+                with METRICS.transaction(conn, "embeddings"):
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO embedding_index (model, record_id, shard, row, created_at) "
+                        "VALUES (?, ?, ?, ?, ?)", pending)
+                pending.clear()
+
+        timestamp = datetime.now().isoformat()
+        with tqdm(total=len(rows), desc="计算嵌入", unit="文件") as pbar:
+            for record_ids, samples in _sample_batches(sample_dir, rows, batch_size, normalize):
+                with METRICS.timer("encode_seconds", model=model):
+                    vectors = encode(samples)
+                if shard is None:
+                    # 嵌入维度由第一批输出决定
+                    shard = np.lib.format.open_memmap(shard_path, mode="w+", dtype=np.float32,
+                                                      shape=(len(rows), vectors.shape[1]))
+                shard[next_row:next_row + len(vectors)] = vectors
+                pending.extend((model, record_id, shard_name, next_row + i, timestamp)
+                               for i, record_id in enumerate(record_ids))
+                next_row += len(vectors)
+                pbar.update(len(record_ids))
+                METRICS.inc("files_total", len(record_ids), stage="embeddings")
+                if len(pending) >= checkpoint_every:
+                    checkpoint()
+            checkpoint()
+        dim = shard.shape[1]
+        del shard
+        print(f"嵌入已写入 {shard_name}，共 {next_row} 条，维度 {dim}。")
+    finally:
+        conn.close()
+
+
+class EmbeddingStore:
+    """
+    只读访问某个模型的全部嵌入：各分片以内存映射方式打开，按块流式读取，内存占用与记录数无关。
+    """
+
+    def __init__(self, db_path, embedding_dir, model):
+        self.embedding_dir = embedding_dir
+        self.model = model
+        conn = sqlite3.connect(db_path)
+        try:
+            ensure_embedding_index_table(conn.cursor())
+            rows = conn.execute(
+                "SELECT record_id, shard, row FROM embedding_index WHERE model = ? ORDER BY shard, row", (model,)
+            ).fetchall()
+        finally:
+            conn.close()
+        self.record_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self._locations = [(row[1], row[2]) for row in rows]
+        self._shards = {}
+        self.dim = self._shard(rows[0][1]).shape[1] if rows else 0
+
+    def __len__(self):
+        return len(self.record_ids)
+
+    def _shard(self, name):
+        shard = self._shards.get(name)
+        if shard is None:
+            shard = self._shards[name] = np.load(os.path.join(self.embedding_dir, name), mmap_mode="r")
+        return shard
+
+    def iter_blocks(self, block_size=8192):
+        """
+        逐块产生 (start, (B, D) float32 数组)；start 为块在 record_ids 中的起始位置。
+        同一分片中连续的行直接切片读取。
+        """
+        for start in range(0, len(self._locations), block_size):
+            locations = self._locations[start:start + block_size]
+            first_shard, first_row = locations[0]
+            last_shard, last_row = locations[-1]
+            if first_shard == last_shard and last_row - first_row == len(locations) - 1:
+                block = np.asarray(self._shard(first_shard)[first_row:last_row + 1])
+            else:
+                block = np.stack([self._shard(name)[row] for name, row in locations])
+            yield start, block
+
+    def vector(self, record_id):
+        index = np.flatnonzero(self.record_ids == record_id)
+        if not len(index):
+            raise ValueError(f"记录 {record_id} 没有模型 {self.model} 的嵌入。")
+        name, row = self._locations[index[0]]
+        return np.asarray(self._shard(name)[row])
+
+
+def _squared_distances(block, centers, center_norms):
+    distances = (block * block).sum(axis=1)[:, None] - 2.0 * block @ centers.T + center_norms[None, :]
+    return np.maximum(distances, 0.0)
+
+
+def _init_centers(store, k, rng, sample_size, block_size):
+    # 在随机抽取的样本上做 k-means++ 初始化
+    sample_size = min(len(store), max(sample_size, k))
+    chosen = np.sort(rng.choice(len(store), size=sample_size, replace=False))
+    sample = []
+    for start, block in store.iter_blocks(block_size):
+        selected = chosen[(chosen >= start) & (chosen < start + len(block))] - start
+        if len(selected):
+            sample.append(block[selected])
+    sample = np.concatenate(sample).astype(np.float64)
+    centers = [sample[rng.integers(len(sample))]]
+    closest = ((sample - centers[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        total = closest.sum()
+        index = rng.choice(len(sample), p=closest / total) if total > 0 else rng.integers(len(sample))
+        centers.append(sample[index])
+        closest = np.minimum(closest, ((sample - sample[index]) ** 2).sum(axis=1))
+    return np.array(centers)
+
+
+def minibatch_kmeans(store, k, epochs=3, batch_size=1024, block_size=8192, init_size=10000, seed=0):
+    """
+    对 EmbeddingStore 中的全部嵌入做流式 Mini-Batch K-Means（Sculley 2010），
+    每次只在内存中保留一个块，返回 (centers, labels)，labels 与 store.record_ids 一一对应。
+    init_size 为 k-means++ 初始化所用的随机样本数。
+    """
+    if len(store) < k:
+        raise ValueError(f"嵌入数 {len(store)} 少于聚类数 {k}")
+    rng = np.random.default_rng(seed)
+    centers = _init_centers(store, k, rng, init_size, block_size)
+    counts = np.zeros(k)
+    for _ in range(epochs):
+        for _, block in store.iter_blocks(block_size):
+            block = block.astype(np.float64)
+            for start in rng.permutation(np.arange(0, len(block), batch_size)):
+                batch = block[start:start + batch_size]
+                nearest = _squared_distances(batch, centers, (centers * centers).sum(axis=1)).argmin(axis=1)
+                # 每个中心的学习率为 1 / 已分配的样本数，等价于对分配到它的样本求滑动平均
+                batch_counts = np.bincount(nearest, minlength=k)
+                sums = np.zeros_like(centers)
+                np.add.at(sums, nearest, batch)
+                updated = batch_counts > 0
+                counts[updated] += batch_counts[updated]
+                rate = (batch_counts[updated] / counts[updated])[:, None]
+                centers[updated] += rate * (sums[updated] / batch_counts[updated][:, None] - centers[updated])
+    labels = np.empty(len(store), dtype=np.int64)
+    center_norms = (centers * centers).sum(axis=1)
+    for start, block in store.iter_blocks(block_size):
+        labels[start:start + len(block)] = _squared_distances(block.astype(np.float64), centers,
+                                                              center_norms).argmin(axis=1)
+    return centers.astype(np.float32), labels
+
+
+def write_cluster_labels(conn, record_ids, labels, column="cluster_label"):
+    """
+    把聚类标签批量写入 patient_data 的 column 列；没有嵌入的记录置为 NULL。
+    """
+    if not column.isidentifier():
+        raise ValueError(f"无效的列名: {column}")
+    columns = [col[1] for col in conn.execute("PRAGMA table_info(patient_data);")]
+    with METRICS.transaction(conn, "clusters"):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE patient_data ADD COLUMN {column} INTEGER;")
+        conn.execute(f"UPDATE patient_data SET {column} = NULL WHERE {column} IS NOT NULL")
+        conn.executemany(f"UPDATE patient_data SET {column} = ? WHERE id = ?",
+                         zip(labels.tolist(), record_ids.tolist()))
+
+
+def nearest_records(store, query, limit=10, metric="cosine", block_size=8192):
+    """
+    在 store 中查找与 query 向量最接近的 limit 条记录，返回 [(record_id, distance), ...]，按距离升序。
+    metric 为 "cosine"（1 - 余弦相似度）或 "euclidean"。
+    """
+    query = np.asarray(query, dtype=np.float32).reshape(-1)
+    if metric == "cosine":
+        query = query / (np.linalg.norm(query) or 1.0)
+    elif metric != "euclidean":
+        raise ValueError(f"不支持的距离: {metric}")
+    best_ids = np.empty(0, dtype=np.int64)
+    best_distances = np.empty(0, dtype=np.float32)
+    for start, block in store.iter_blocks(block_size):
+        if metric == "cosine":
+            norms = np.linalg.norm(block, axis=1)
+            distances = 1.0 - (block @ query) / np.where(norms > 0, norms, 1.0)
+        else:
+            distances = np.sqrt(np.maximum((block * block).sum(axis=1) - 2.0 * block @ query + query @ query, 0.0))
+        # 每块只保留当前最好的 limit 条，合并后再截断
+        best_ids = np.concatenate([best_ids, store.record_ids[start:start + len(block)]])
+        best_distances = np.concatenate([best_distances, distances.astype(np.float32)])
+        if len(best_distances) > limit:
+            keep = np.argpartition(best_distances, limit)[:limit]
+            best_ids, best_distances = best_ids[keep], best_distances[keep]
+    order = np.argsort(best_distances, kind="stable")
+    return [(int(best_ids[i]), float(best_distances[i])) for i in order]
@@ -0,0 +1,190 @@
+import io
+import os
+import sqlite3
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import magic
+import pydicom
+from tqdm import tqdm
+
+from io_sched import default_workers, device_gate
+from metrics import METRICS, imap_instrumented
+from parallel import keyset_chunks
+
+# 嗅探时读取的文件头大小，足够覆盖 DICOM 前导区、NIfTI 头以及 libmagic 的大多数规则
+HEADER_BYTES = 8192
+
+# 每个工作进程复用一个 libmagic 句柄
+_MAGIC = None
+
+
+def _nifti_version(header):
+    """
+    根据 NIfTI 头部的 sizeof_hdr 和 magic 字段判断版本，不是 NIfTI 时返回 None。
+    """
+    if len(header) >= 348:
+        sizeof_hdr = header[:4]
+        if sizeof_hdr in (struct.pack("<i", 348), struct.pack(">i", 348)) and header[344:347] in (b"n+1", b"ni1"):
+            return "NIfTI-1"
+    if len(header) >= 540:
+        sizeof_hdr = header[:4]
+        if sizeof_hdr in (struct.pack("<i", 540), struct.pack(">i", 540)) and header[4:7] in (b"n+2", b"ni2"):
+            return "NIfTI-2"
+    return None
+
+
+def sniff_header(header):
+    """
+    只根据文件头字节判断格式：DICOM（128 字节前导区后的 DICM 标记）、NIfTI-1/2 以及 gzip 压缩的 NIfTI。
+    无法判断时返回 None。
+    """
+    if len(header) >= 132 and header[128:132] == b"DICM":
+        return "DICOM"
+
+    version = _nifti_version(header)
+    if version:
+        return version
+
+    if header[:2] == b"\x1f\x8b":
+        # 解压文件头的前几百字节，判断是否为 .nii.gz
+        try:
+            inner = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(header, 540)
+        except zlib.error:
+            inner = b""
+        version = _nifti_version(inner)
+        if version:
+            return f"{version} (gzip)"
+        return "application/gzip"
+    return None
+
+
+def _looks_like_raw_dicom(header):
+    # 没有前导区的 DICOM 文件通常直接以 (0008,xxxx) 或 (0002,xxxx) 组的小端标签开头
+    return len(header) >= 8 and header[:2] in (b"\x08\x00", b"\x02\x00") and header[3:4] == b"\x00"
+
+
+def detect_file_format(file_path, magic_handle=None, data=None):
+    """
+    检测文件的实际格式。
+
+    先读取少量文件头进行嗅探；只有嗅探失败时才退回到 pydicom（疑似无前导区的 DICOM）或 libmagic。
+    调用方已经读入整个文件时可通过 data 传入，此时不再访问磁盘。
+    """
+    with METRICS.timer("sniff_seconds"):
+        if data is not None:
+            header = data[:HEADER_BYTES]
+        else:
+            try:
+                with open(file_path, "rb") as f:
+                    header = f.read(HEADER_BYTES)
+            except OSError as e:
+                print(f"处理文件 {file_path} 时出错: {e}")
+                return "unknown"
+        file_format = sniff_header(header)
+    if file_format:
+        return file_format
+
+    # 嗅探失败的文件需要 pydicom / libmagic 解析，代价高得多，单独计数
+    METRICS.inc("sniff_fallback_total")
+    if _looks_like_raw_dicom(header):
+        try:
+            source = io.BytesIO(data) if data is not None else file_path
+            dicom_data = pydicom.dcmread(source, stop_before_pixels=True, force=True)
+            if "SOPClassUID" in dicom_data:
+                return "DICOM"
+        except Exception:
+            pass
+
+    try:
+        if magic_handle is None:
+            magic_handle = magic.Magic(mime=True)
+        if data is not None:
+            return magic_handle.from_buffer(data)
+        file_type = magic_handle.from_buffer(header)
+        if file_type == "application/octet-stream" and len(header) == HEADER_BYTES:
+            # 文件头不足以判断时再让 libmagic 读取整个文件
+            file_type = magic_handle.from_file(file_path)
+        return file_type
+    except Exception as e:
+        print(f"处理文件 {file_path} 时出错: {e}")
+        return "unknown"
+
+
+def _init_worker():
+    global _MAGIC
+    _MAGIC = magic.Magic(mime=True)
+
+
+def _detect_chunk(records):
+    results = []
+    for record_id, file_path in records:
+        if os.path.exists(file_path):
+            results.append((record_id, file_path, detect_file_format(file_path, _MAGIC)))
+        else:
+            results.append((record_id, file_path, None))
+    return results
+
+
+def update_actual_file_types(db_path, workers=None, chunk_size=64, checkpoint_every=2000, page_size=10000):
+    """
+    使用进程池并行检测数据库中所有未处理文件的实际类型。
+
+    检测结果每 checkpoint_every 条批量 UPDATE 并提交一次；中断后重新运行会从未处理的记录继续。
+    找不到的文件保持为空，下次运行时会重新检查（verify_files 标记为不存在的文件除外）。
+    返回未找到的文件数；数据库出错时打印错误后重新抛出（已提交的批次保留，重新运行时继续）。
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        gate_of = device_gate(lambda chunk: chunk[0][1], kind="metadata", max_workers=workers)
+        workers = workers or default_workers(kind="metadata")
+        # 已由 verify_files 确认不存在的文件不再逐个检查
+        columns = [col[1] for col in conn.execute("PRAGMA table_info(patient_data);")]
+        pending = "(actual_file_type IS NULL OR actual_file_type = '')"
+        if "is_present" in columns:
+            pending += " AND is_present IS NOT 0"
+        total_files = conn.execute(f"SELECT COUNT(*) FROM patient_data WHERE {pending};").fetchone()[0]
+        print(f"需要处理的文件总数: {total_files}")
+
+        pending_updates = []
+        missing = 0
+        # 按 id 分页读取 actual_file_type 为空的记录
+        chunks = keyset_chunks(
+            conn,
+            f"SELECT id, file_path FROM patient_data WHERE {pending} AND id > ? ORDER BY id LIMIT ?;",
+            page_size=page_size,
+            chunk_size=chunk_size,
+        )
+
+        def flush():
+            if pending_updates:
+                with METRICS.transaction(conn, "file_type"):
+                    conn.executemany("UPDATE patient_data SET actual_file_type = ? WHERE id = ?", pending_updates)
+                pending_updates.clear()
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor, \
+                tqdm(total=total_files, desc="处理文件", unit="文件") as pbar:
+            # 限制同时在途的任务数量，避免一次性把所有记录读入内存
+            for _, results in imap_instrumented(executor, _detect_chunk, chunks, workers * 4,
+                                                 stage="file_type", gate_of=gate_of):
+                for record_id, file_path, file_format in results:
+                    if file_format is None:
+                        missing += 1
+                        tqdm.write(f"文件未找到: {file_path}")
+                    else:
+                        pending_updates.append((file_format, record_id))
+                    pbar.update(1)
+                METRICS.inc("files_total", len(results), stage="file_type")
+                if len(pending_updates) >= checkpoint_every:
+                    flush()
+            flush()
+
+        print(f"文件类型已成功更新，{missing} 个文件未找到。")
+        METRICS.inc("errors_total", missing, stage="file_type")
+        return missing
+    except sqlite3.Error as e:
+        print(f"数据库错误: {e}")
+        raise
+    finally:
+        conn.close()
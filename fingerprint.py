@@ -0,0 +1,172 @@
+import hashlib
+import os
+import sqlite3
+from tqdm import tqdm
+
+from io_sched import IOScheduler, advise_sequential
+from metrics import METRICS
+
+# 预哈希读取文件头尾各 HEAD_BYTES 字节；完整哈希按 CHUNK_BYTES 分块读取
+HEAD_BYTES = 64 * 1024
+CHUNK_BYTES = 1024 * 1024
+DIGEST_SIZE = 16
+
+
+def pre_hash(file_path, size, head_bytes=HEAD_BYTES):
+    """
+    由文件大小 + 文件头尾内容计算的廉价预哈希，只用于筛选可能重复的候选文件。
+    文件不超过头尾总长度时，预哈希覆盖了整个文件，此时直接返回 (预哈希, 完整哈希)。
+    """
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    h.update(size.to_bytes(8, "little"))
+    with open(file_path, "rb") as f:
+        if size <= 2 * head_bytes:
+            data = f.read()
+            h.update(data)
+            return h.hexdigest(), content_hash_bytes(data)
+        h.update(f.read(head_bytes))
+        f.seek(size - head_bytes)
+        h.update(f.read(head_bytes))
+    return h.hexdigest(), None
+
+
+def pre_hash_bytes(data, head_bytes=HEAD_BYTES):
+    """
+    与 pre_hash 相同的预哈希，但使用已读入内存的文件内容。
+    """
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    h.update(len(data).to_bytes(8, "little"))
+    if len(data) <= 2 * head_bytes:
+        h.update(data)
+    else:
+        h.update(data[:head_bytes])
+        h.update(data[-head_bytes:])
+    return h.hexdigest()
+
+
+def content_hash_bytes(data):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).hexdigest()
+
+
+def content_hash(file_path, chunk_bytes=CHUNK_BYTES):
+    """
+    分块读取整个文件计算 blake2b 哈希，复用同一块缓冲区避免反复分配内存。
+    """
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    buffer = bytearray(chunk_bytes)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        advise_sequential(f)
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def _stat_size(record):
+    record_id, file_path = record
+    try:
+        return record_id, os.stat(file_path).st_size
+    except OSError:
+        return record_id, None
+
+
+def _compute_pre_hash(record):
+    record_id, file_path, size = record
+    try:
+        return record_id, pre_hash(file_path, size)
+    except OSError:
+        return record_id, None
+
+
+def _compute_content_hash(record):
+    record_id, file_path, _ = record
+    try:
+        return record_id, content_hash(file_path)
+    except OSError:
+        return record_id, None
+
+
+def _run_stage(conn, records, func, update_sql, to_params, scheduler, desc, stage, kind="read", size_of=None,
+               batch_size=1000):
+    """
+    通过 I/O 调度器对 records（第二列为文件路径）执行 func，结果分批写回数据库。
+    哈希计算和文件读取都会释放 GIL，因此使用线程即可。
+    """
+    pending = []
+    done = 0
+    failed = 0
+    results = scheduler.map(func, records, path_of=lambda record: record[1], size_of=size_of, kind=kind)
+    for _, (record_id, value) in tqdm(results, total=len(records), desc=desc, unit="文件"):
+        METRICS.inc("files_total", stage=stage)
+        if value is None:
+            failed += 1
+            continue
+        pending.append(to_params(record_id, value))
+        done += 1
+        if len(pending) >= batch_size:
+            with METRICS.transaction(conn, stage):
+                conn.executemany(update_sql, pending)
+            pending = []
+    if pending:
+        with METRICS.transaction(conn, stage):
+            conn.executemany(update_sql, pending)
+    if failed:
+        print(f"{desc}：{failed} 个文件无法读取。")
+    METRICS.inc("errors_total", failed, stage=stage)
+    return done, failed
+
+
+def fingerprint_files(db_path, workers=None):
+    """
+    计算文件指纹，分三步只对可能重复的文件做完整哈希：
+
+    1. 记录所有文件的大小；
+    2. 对大小相同的文件计算预哈希（大小 + 头尾各 64 KiB）；
+    3. 对大小和预哈希都相同的文件计算完整内容哈希。
+
+    已计算的结果保存在 patient_data 中，重复运行时只处理新增的候选文件。
+    读取按路径顺序进行，每个设备的并发读者数由 I/O 调度器根据磁盘类型和实测吞吐量决定，
+    workers 为读取并发的上限。返回无法读取的文件数（各步骤合计）。
+    """
+    scheduler = IOScheduler(max_workers=workers)
+    conn = sqlite3.connect(db_path)
+    try:
+        records = conn.execute("SELECT id, file_path FROM patient_data WHERE file_size IS NULL").fetchall()
+        _, failed = _run_stage(conn, records, _stat_size,
+                               "UPDATE patient_data SET file_size = ? WHERE id = ?",
+                               lambda record_id, size: (size, record_id),
+                               scheduler, desc="读取文件大小", stage="file_size", kind="metadata")
+
+        records = conn.execute('''
+            SELECT id, file_path, file_size FROM patient_data
+            WHERE pre_hash IS NULL AND file_size IN (
+                SELECT file_size FROM patient_data WHERE file_size IS NOT NULL
+                GROUP BY file_size HAVING COUNT(*) > 1
+            )
+        ''').fetchall()
+        _, pre_hash_failed = _run_stage(
+            conn, records, _compute_pre_hash,
+            "UPDATE patient_data SET pre_hash = ?, content_hash = COALESCE(?, content_hash) WHERE id = ?",
+            lambda record_id, hashes: (hashes[0], hashes[1], record_id),
+            scheduler, desc="计算预哈希", stage="pre_hash",
+            size_of=lambda record, result: min(record[2], 2 * HEAD_BYTES))
+
+        records = conn.execute('''
+            SELECT id, file_path, file_size FROM patient_data
+            WHERE content_hash IS NULL AND (file_size, pre_hash) IN (
+                SELECT file_size, pre_hash FROM patient_data WHERE pre_hash IS NOT NULL
+                GROUP BY file_size, pre_hash HAVING COUNT(*) > 1
+            )
+        ''').fetchall()
+        hashed, content_hash_failed = _run_stage(conn, records, _compute_content_hash,
+                                                 "UPDATE patient_data SET content_hash = ? WHERE id = ?",
+                                                 lambda record_id, digest: (digest, record_id),
+                                                 scheduler, desc="计算完整哈希", stage="content_hash",
+                                                 size_of=lambda record, result: record[2])
+        print(f"指纹计算完成，对 {hashed} 个候选重复文件计算了完整哈希。")
+        return failed + pre_hash_failed + content_hash_failed
+    finally:
+        conn.close()
@@ -0,0 +1,123 @@
+import fnmatch
+import os
+import time
+
+from metrics import METRICS
+
+
+def _matches(name, patterns):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def walk_patient_files(patient_path, patient_id=None, max_depth=None, include=None, exclude=None,
+                       stat_files=True, root_stat=None, is_unchanged=None, on_dir=None):
+    """
+    基于 os.scandir 递归遍历一个患者文件夹，逐个产生 (patient_id, path, size, mtime) 记录。
+
+    DirEntry 自带的文件类型信息用于区分文件和目录，不再对每个条目额外调用 os.path.isfile。
+
+    :param patient_path: 患者文件夹路径
+    :param patient_id: 记录中的患者 ID，默认使用文件夹名
+    :param max_depth: 最大递归深度，0 表示只看患者文件夹本身，None 表示不限制
+    :param include: 文件名通配模式列表，只保留匹配的文件（None 表示全部保留）
+    :param exclude: 文件名/目录名通配模式列表，匹配的条目会被跳过
+    :param stat_files: 为 False 时不读取文件的 size/mtime（记录中为 None），省去每个文件一次 stat
+    :param root_stat: 患者文件夹已有的 os.stat 结果，可省去一次 stat
+    :param is_unchanged: 回调 (dir_path, dir_stat) -> 子目录路径列表或 None。
+                         返回列表表示该目录自上次扫描后未变化：不列举其中的文件，只继续检查这些子目录
+    :param on_dir: 回调 (dir_path, dir_stat, entry_count, subdir_paths)，在目录被列举完之后调用
+    """
+    if patient_id is None:
+        patient_id = os.path.basename(os.path.normpath(patient_path))
+    if root_stat is None:
+        root_stat = os.stat(patient_path)
+
+    stack = [(patient_path, root_stat, 0)]
+    while stack:
+        dir_path, dir_stat, depth = stack.pop()
+
+        known_subdirs = is_unchanged(dir_path, dir_stat) if is_unchanged is not None else None
+        if known_subdirs is not None:
+            # 目录本身未变化：文件列表与上次相同，只需检查已知的子目录
+            for subdir in known_subdirs:
+                try:
+                    stack.append((subdir, os.stat(subdir), depth + 1))
+                except FileNotFoundError:
+                    pass
+            continue
+
+        subdirs = []
+        try:
+            # 先完整列举目录再处理条目，使 scan_listdir_seconds 只包含列举本身的耗时
+            with METRICS.timer("scan_listdir_seconds"):
+                with os.scandir(dir_path) as iterator:
+                    entries = list(iterator)
+        except (FileNotFoundError, PermissionError, NotADirectoryError):
+            continue
+        entry_count = len(entries)
+        file_count = 0
+        stat_seconds = 0.0
+        for entry in entries:
+            if exclude and _matches(entry.name, exclude):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if max_depth is None or depth < max_depth:
+                        start = time.perf_counter()
+                        subdirs.append((entry.path, entry.stat(follow_symlinks=False)))
+                        stat_seconds += time.perf_counter() - start
+                elif entry.is_file():
+                    if include and not _matches(entry.name, include):
+                        continue
+                    file_count += 1
+                    if stat_files:
+                        start = time.perf_counter()
+                        st = entry.stat()
+                        stat_seconds += time.perf_counter() - start
+                        yield (patient_id, entry.path, st.st_size, st.st_mtime)
+                    else:
+                        yield (patient_id, entry.path, None, None)
+            except OSError:
+                # 条目在遍历过程中被删除或无法访问
+                continue
+
+        METRICS.inc("scan_dirs_total")
+        METRICS.inc("scan_files_total", file_count)
+        if stat_seconds:
+            # 每个目录记录一次 stat 总耗时，避免每个文件都进入直方图
+            METRICS.observe("scan_stat_seconds", stat_seconds)
+        if on_dir is not None:
+            on_dir(dir_path, dir_stat, entry_count, [path for path, _ in subdirs])
+        stack.extend((path, st, depth + 1) for path, st in reversed(subdirs))
+
+
+def list_patient_folders(root, exclude=None):
+    """
+    返回根目录下的所有患者文件夹 [(path, stat)]。
+    """
+    folders = []
+    with os.scandir(root) as iterator:
+        for entry in iterator:
+            if exclude and _matches(entry.name, exclude):
+                continue
+            try:
+                if entry.is_dir():
+                    folders.append((entry.path, entry.stat()))
+            except OSError:
+                continue
+    return folders
+
+
+def walk_dataset(root, max_depth=None, include=None, exclude=None, stat_files=True):
+    """
+    遍历整个数据集（根目录下每个文件夹为一个患者），逐个产生 (patient_id, path, size, mtime) 记录。
+    """
+    for patient_path, patient_stat in list_patient_folders(root, exclude=exclude):
+        yield from walk_patient_files(
+            patient_path,
+            max_depth=max_depth,
+            include=include,
+            exclude=exclude,
+            stat_files=stat_files,
+            root_stat=patient_stat,
+        )
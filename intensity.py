@@ -0,0 +1,172 @@
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+from io_sched import default_workers, device_gate
+from metrics import METRICS, imap_instrumented
+from parallel import keyset_chunks
+from record_filter import nifti_condition
+from volume_cache import cache_counts, cache_summary, iter_slabs, shared_cache
+
+# 固定分箱的直方图（CT 值范围），超出范围的值计入两端的箱
+HIST_BINS = 256
+HIST_RANGE = (-1024.0, 3072.0)
+
+
+class RunningStats:
+    """
+    逐块累积最小值、最大值、均值、标准差和固定分箱直方图。
+    均值和方差用 Chan 等人的并行合并公式累积，避免 sum/sumsq 的精度问题。
+    """
+
+    def __init__(self, bins=HIST_BINS, value_range=HIST_RANGE):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.bins = bins
+        self.value_range = value_range
+        self.hist = np.zeros(bins, dtype=np.int64)
+
+    def update(self, slab):
+        x = np.asarray(slab, dtype=np.float64).ravel()
+        n = x.size
+        if n == 0:
+            return
+        slab_mean = x.mean()
+        slab_m2 = np.square(x - slab_mean).sum()
+        self.min = min(self.min, x.min())
+        self.max = max(self.max, x.max())
+
+        total = self.count + n
+        delta = slab_mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += slab_m2 + delta * delta * self.count * n / total
+        self.count = total
+
+        lo, hi = self.value_range
+        index = ((x - lo) * (self.bins / (hi - lo))).astype(np.int64)
+        np.clip(index, 0, self.bins - 1, out=index)
+        self.hist += np.bincount(index, minlength=self.bins)
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.m2 / self.count)) if self.count else None
+
+    def result(self):
+        return {
+            "min": float(self.min),
+            "max": float(self.max),
+            "mean": float(self.mean),
+            "std": self.std,
+            "hist": self.hist,
+        }
+
+
+def volume_stats(path, slab_size=16, bins=HIST_BINS, value_range=HIST_RANGE, cache=None):
+    """
+    单遍流式计算一个体数据的 min / max / mean / std 和直方图，峰值内存只有一个 slab。
+    cache 为 volume_cache.VolumeCache 时从已解码的缓存读取。
+    """
+    stats = RunningStats(bins=bins, value_range=value_range)
+    for slab in iter_slabs(path, slab_size=slab_size, cache=cache):
+        stats.update(slab)
+    if stats.count == 0:
+        return None
+    return stats.result()
+
+
+def _stats_chunk(task):
+    records, slab_size, cache_dir, cache_bytes = task
+    cache = shared_cache(cache_dir, cache_bytes)
+    results = []
+    for record_id, file_path in records:
+        try:
+            results.append((record_id, file_path, volume_stats(file_path, slab_size=slab_size, cache=cache), None))
+        except Exception as e:
+            results.append((record_id, file_path, None, str(e)))
+    return results
+
+
+def compute_intensity_stats(db_path, workers=None, slab_size=16, chunk_size=8, batch_size=500, cache_dir=None,
+                            cache_bytes=None):
+    """
+    在进程池中并行计算所有 NIfTI 记录的亮度统计，分批写回 patient_data。
+
+    写入 brightness_min / brightness_max / brightness_avg / brightness_std 以及
+    brightness_hist（int64 直方图的字节串，分箱见 brightness_hist_spec）。
+    每条记录的结果记在 intensity_status 中（ok / empty / error），已处理过的记录（包括失败的）会被跳过，
+    中断后重新运行只处理剩下的文件；文件变化后 live_sync / verify 会清空该列，届时重新计算。
+    cache_dir 不为 None 时通过 volume_cache 读取体数据，缓存总大小不超过 cache_bytes。
+    返回处理失败的文件数。
+    """
+    hist_spec = f"{HIST_RANGE[0]:g}:{HIST_RANGE[1]:g}:{HIST_BINS}"
+    conn = sqlite3.connect(db_path)
+    try:
+        gate_of = device_gate(lambda task: task[0][0][1], max_workers=workers)
+        workers = workers or default_workers()
+        columns = [col[1] for col in conn.execute("PRAGMA table_info(patient_data);")]
+        condition = nifti_condition(detected="actual_file_type" in columns)
+        # 旧版本没有 intensity_status，已有统计值的记录同样视为已处理
+        where = f"brightness_avg IS NULL AND intensity_status IS NULL AND {condition}"
+
+        total = conn.execute(f"SELECT COUNT(*) FROM patient_data WHERE {where}").fetchone()[0]
+        print(f"需要计算亮度统计的文件数: {total}")
+        cache_before = cache_counts()
+        chunks = keyset_chunks(
+            conn,
+            f"SELECT id, file_path FROM patient_data WHERE {where} AND id > ? ORDER BY id LIMIT ?",
+            chunk_size=chunk_size,
+        )
+
+        pending = []
+        failed = []
+        errors = 0
+
+        def flush():
+            if pending or failed:
+                with METRICS.transaction(conn, "intensity"):
+                    conn.executemany('''
+                        UPDATE patient_data
+                        SET brightness_min = ?, brightness_max = ?, brightness_avg = ?, brightness_std = ?,
+                            brightness_hist = ?, brightness_hist_spec = ?, intensity_status = 'ok'
+                        WHERE id = ?
+                    ''', pending)
+                    # 解码失败或没有数据的文件记下状态，不在每次运行时重试
+                    conn.executemany("UPDATE patient_data SET intensity_status = ? WHERE id = ?", failed)
+                pending.clear()
+                failed.clear()
+
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+                tqdm(total=total, desc="计算亮度统计", unit="文件") as pbar:
+            tasks = ((chunk, slab_size, cache_dir, cache_bytes) for chunk in chunks)
+            for _, results in imap_instrumented(executor, _stats_chunk, tasks, workers * 2, stage="intensity",
+                                                 gate_of=gate_of):
+                for record_id, file_path, stats, error in results:
+                    if stats is None:
+                        errors += 1
+                        failed.append(("error" if error else "empty", record_id))
+                        tqdm.write(f"处理文件 {file_path} 时出错: {error or '空数据'}")
+                        continue
+                    pending.append((stats["min"], stats["max"], stats["mean"], stats["std"],
+                                    stats["hist"].tobytes(), hist_spec, record_id))
+                pbar.update(len(results))
+                METRICS.inc("files_total", len(results), stage="intensity")
+                if len(pending) + len(failed) >= batch_size:
+                    flush()
+            flush()
+        print(f"亮度统计已更新，{errors} 个文件处理失败。")
+        summary = cache_summary(cache_before)
+        if summary:
+            print(summary)
+        METRICS.inc("errors_total", errors, stage="intensity")
+        return errors
+    finally:
+        conn.close()
+
+
+def decode_histogram(blob):
+    return np.frombuffer(blob, dtype=np.int64)
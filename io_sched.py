@@ -0,0 +1,264 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from metrics import METRICS
+
+# 按设备类型的默认并发：只读元数据（scandir / stat）的任务可以比整文件读取开更多线程，
+# 机械硬盘上并发读取过多会让磁头来回寻道，吞吐反而下降
+METADATA_WORKERS = {"rotational": 8, "ssd": 32, "unknown": 16}
+READ_WORKERS = {"rotational": 2, "ssd": None, "unknown": 4}
+MAX_READ_WORKERS = {"rotational": 4, "ssd": 32, "unknown": 16}
+
+_ROTATIONAL_CACHE = {}
+
+
+def device_id(path):
+    """
+    返回 path 所在设备的 st_dev；path 不存在时使用最近的已存在的上级目录。
+    """
+    path = os.path.abspath(path)
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise
+            path = parent
+
+
+def device_kind(path):
+    """
+    通过 /sys/dev/block/<major>:<minor>/queue/rotational 判断设备类型，返回 "rotational"、"ssd" 或 "unknown"。
+    分区没有自己的 queue 目录，此时读取所属磁盘的信息。
+    """
+    try:
+        dev = device_id(path)
+    except OSError:
+        return "unknown"
+    kind = _ROTATIONAL_CACHE.get(dev)
+    if kind is None:
+        kind = "unknown"
+        sys_path = os.path.realpath(f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}")
+        for candidate in (sys_path, os.path.dirname(sys_path)):
+            try:
+                with open(os.path.join(candidate, "queue", "rotational")) as f:
+                    kind = "rotational" if f.read().strip() == "1" else "ssd"
+                break
+            except OSError:
+                continue
+        _ROTATIONAL_CACHE[dev] = kind
+    return kind
+
+
+def metadata_workers(path):
+    return METADATA_WORKERS[device_kind(path)]
+
+
+def default_workers(kind="read"):
+    """
+    进程池阶段的默认进程数，只取决于 CPU 数；每个设备上同时读取的任务数由 device_gate 单独限制，
+    因此机械硬盘上的数据不会因为进程池较大而被并发读取。
+    kind="metadata" 用于只读取文件头的阶段（类型嗅探、DICOM 标签），进程数可以高于整文件读取。
+    """
+    cpus = os.cpu_count() or 4
+    return 2 * cpus if kind == "metadata" else cpus
+
+
+def device_gate(path_of, kind="read", max_workers=None):
+    """
+    为进程池阶段生成 parallel.imap_bounded 的 gate_of：返回任务中 path_of(task) 所在设备的并发闸门。
+    闸门上限与 IOScheduler 相同（按设备类型，不超过 max_workers），但不做自适应调整：
+    吞吐量只能在工作进程中测得。一个任务包含多个文件时，按第一个文件所在的设备计。
+    """
+    scheduler = IOScheduler(max_workers=max_workers, adaptive=False)
+    return lambda task: scheduler.limiter(path_of(task), kind)
+
+
+def order_by_locality(items, path_of=lambda item: item, by="path", workers=None):
+    """
+    按磁盘位置的近似顺序排列 items，减少机械硬盘的寻道。
+
+    by="path" 按目录路径排序（同一目录下的文件通常相邻存放）；by="inode" 先并发 stat 再按
+    (设备, inode) 排序，更接近文件在 ext4 等文件系统上的实际分配顺序，但需要额外的元数据访问。
+    """
+    items = list(items)
+    if by == "path":
+        return sorted(items, key=path_of)
+    if by != "inode":
+        raise ValueError(f"未知的排序方式: {by}")
+
+    def inode_key(item):
+        try:
+            st = os.stat(path_of(item))
+            return st.st_dev, st.st_ino
+        except OSError:
+            return -1, -1
+
+    if not items:
+        return items
+    with ThreadPoolExecutor(max_workers=workers or metadata_workers(path_of(items[0]))) as executor:
+        keys = list(executor.map(inode_key, items))
+    return [item for _, item in sorted(zip(keys, items), key=lambda pair: pair[0])]
+
+
+def advise_sequential(f, offset=0, length=0):
+    """
+    提示内核即将顺序读取整个文件（加大预读）；不支持 posix_fadvise 的平台上什么也不做。
+    """
+    if hasattr(os, "posix_fadvise"):
+        try:
+            fd = f.fileno()
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+        except (OSError, AttributeError, ValueError):
+            pass
+
+
+class AdaptiveLimiter:
+    """
+    可动态调整上限的并发闸门。
+
+    每 window 秒统计一次吞吐量（MB/s），用爬山法调整并发上限：吞吐提高则沿原方向继续调整，
+    明显下降则反向，上限保持在 [minimum, maximum] 之间。adaptive=False 时上限固定不变。
+    """
+
+    def __init__(self, initial, minimum=1, maximum=16, window=5.0, adaptive=True):
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.adaptive = adaptive
+        self.history = []
+        self._active = 0
+        self._bytes = 0
+        self._window_start = time.monotonic()
+        self._last_rate = None
+        self._direction = 1
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self, nbytes=0):
+        with self._cond:
+            self._active -= 1
+            self._bytes += nbytes
+            elapsed = time.monotonic() - self._window_start
+            if self.adaptive and elapsed >= self.window:
+                self._adjust(self._bytes / elapsed / 1e6)
+            self._cond.notify_all()
+
+    def _adjust(self, rate):
+        if self._last_rate is not None and rate < self._last_rate * 0.95:
+            self._direction = -self._direction
+        new_limit = max(self.minimum, min(self.limit + self._direction, self.maximum))
+        if new_limit == self.limit:
+            self._direction = -self._direction
+        self.history.append((self.limit, rate))
+        self.limit = new_limit
+        self._last_rate = rate
+        self._bytes = 0
+        self._window_start = time.monotonic()
+
+
+class IOScheduler:
+    """
+    所有读文件阶段共用的 I/O 调度器（线程池）。
+
+    - 任务先按磁盘位置排序；
+    - 每个设备有独立的并发闸门，机械硬盘默认只允许 2 个读者；
+    - kind="read" 时根据实测 MB/s 自动调整每个设备的并发数，kind="metadata" 使用固定的较高并发。
+    """
+
+    def __init__(self, max_workers=None, adaptive=True, window=5.0):
+        self.max_workers = max_workers
+        self.adaptive = adaptive
+        self.window = window
+        self._limiters = {}
+        self._dir_devices = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, path, kind="read"):
+        # 按所在目录缓存设备号，避免为每个文件多做一次 stat
+        directory = os.path.dirname(path)
+        dev = self._dir_devices.get(directory)
+        if dev is None:
+            try:
+                dev = device_id(directory)
+            except OSError:
+                dev = -1
+            self._dir_devices[directory] = dev
+        with self._lock:
+            limiter = self._limiters.get((dev, kind))
+            if limiter is None:
+                device = device_kind(path)
+                if kind == "metadata":
+                    initial = maximum = METADATA_WORKERS[device]
+                else:
+                    initial = READ_WORKERS[device] or min(os.cpu_count() or 4, MAX_READ_WORKERS[device])
+                    maximum = MAX_READ_WORKERS[device]
+                if self.max_workers:
+                    initial, maximum = min(initial, self.max_workers), min(maximum, self.max_workers)
+                limiter = AdaptiveLimiter(initial, maximum=maximum, window=self.window,
+                                          adaptive=self.adaptive and kind == "read")
+                self._limiters[(dev, kind)] = limiter
+            return limiter
+
+    def map(self, func, items, path_of=lambda item: item, size_of=None, kind="read", order="path"):
+        """
+        对 items 执行 func，按完成顺序产生 (item, result)。
+        size_of(item, result) 返回本次读取的字节数，用于吞吐量统计；order 为 None 时保持原顺序。
+
+        每个设备单独排队，只有该设备的闸门还有空位时才提交它的下一个任务：慢盘上等待的任务不会占住
+        线程池，其它设备上的任务也不必排在它们后面。
+        """
+        items = list(items)
+        if order:
+            items = order_by_locality(items, path_of, by=order)
+        if not items:
+            return
+        queues = {}
+        for item in items:
+            queues.setdefault(self.limiter(path_of(item), kind), deque()).append(item)
+
+        def run(limiter, item):
+            limiter.acquire()
+            result = None
+            try:
+                result = func(item)
+                return result
+            finally:
+                nbytes = size_of(item, result) if size_of is not None and result is not None else 0
+                limiter.release(nbytes)
+                if nbytes:
+                    METRICS.inc("io_bytes_total", nbytes, kind=kind)
+
+        in_flight = {}
+        active = dict.fromkeys(queues, 0)
+        with ThreadPoolExecutor(max_workers=sum(limiter.maximum for limiter in queues)) as executor:
+            while True:
+                # 上限可能已被自适应调整，每轮按当前上限补充各设备的任务
+                for limiter, queue in queues.items():
+                    while queue and active[limiter] < limiter.limit:
+                        item = queue.popleft()
+                        in_flight[executor.submit(run, limiter, item)] = (limiter, item)
+                        active[limiter] += 1
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    limiter, item = in_flight.pop(future)
+                    active[limiter] -= 1
+                    yield item, future.result()
+
+    def stats(self):
+        with self._lock:
+            return {f"{dev}:{kind}": {"limit": limiter.limit, "history": list(limiter.history)}
+                    for (dev, kind), limiter in self._limiters.items()}
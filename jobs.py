@@ -0,0 +1,207 @@
+import json
+import os
+import socket
+import sqlite3
+from datetime import datetime
+
+from metrics import METRICS, MetricsReporter
+
+
+def ensure_jobs_table(cursor):
+    # 长任务记录：status 为 running / done / partial / failed / interrupted；checkpoint 为已完成步骤等 JSON 状态
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            params TEXT,
+            status TEXT,
+            host TEXT,
+            pid INTEGER,
+            processed INTEGER DEFAULT 0,
+            checkpoint TEXT,
+            attempts INTEGER DEFAULT 1,
+            started_at TEXT,
+            updated_at TEXT,
+            finished_at TEXT,
+            error TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_name_status ON jobs(name, status)')
+
+
+class JobAlreadyRunning(RuntimeError):
+    pass
+
+
+def _process_alive(host, pid):
+    if host != socket.gethostname():
+        # 无法判断其它主机上的进程，保守地认为仍在运行
+        return True
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Job:
+    """
+    可中断、可恢复的长任务，在 jobs 表中记录状态、进度和检查点。
+
+    各阶段本身只处理尚未有结果的记录（并定期提交），所以重新运行即可从上次提交处继续；
+    Job 负责记录这一过程：同名同参数的未完成任务会被续上（attempts + 1），已完成的步骤
+    （见 run_step）直接跳过。进度取自 METRICS 中 progress_counter（计数器名或名称元组）的合计，
+    每 interval 秒写入一次。
+
+    各阶段把处理失败的文件数记入 errors_total 计数器：步骤期间该计数增加时，步骤不算完成（下次运行时重做），
+    任务结束时状态为 partial 而不是 done。
+
+        with Job(db_path, "detect", {"workers": 8}) as job:
+            job.run_step("detect", manager.update_actual_file_types, workers=8)
+
+    同一任务仍有进程在运行时抛出 JobAlreadyRunning，可以放心地由 cron 重复启动；
+    force=True 时不做此检查（例如另一台主机上的进程已经崩溃）。
+    """
+
+    def __init__(self, db_path, name, params=None, progress_counter="files_total", interval=10.0, force=False):
+        self.db_path = db_path
+        self.name = name
+        self.params = json.dumps(params or {}, sort_keys=True, ensure_ascii=False)
+        self.progress_counter = (progress_counter,) if isinstance(progress_counter, str) else tuple(progress_counter)
+        self.interval = interval
+        self.force = force
+        self.id = None
+        self.processed = 0
+        self.steps = []
+        self.partial = {}
+        self._baseline = 0
+        self._reporter = None
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)
+
+    def _counter_total(self, snapshot=None, names=None):
+        snapshot = snapshot or METRICS.snapshot()
+        names = names or self.progress_counter
+        return sum(c["value"] for c in snapshot["counters"] if c["name"] in names)
+
+    def start(self):
+        now = datetime.now().isoformat()
+        conn = self._connect()
+        try:
+            with conn:
+                # 立即取得写锁，避免两个同时启动的进程都认为没有正在运行的同名任务
+                conn.execute("BEGIN IMMEDIATE")
+                ensure_jobs_table(conn.cursor())
+                row = conn.execute('''
+                    SELECT id, status, host, pid, processed, checkpoint FROM jobs
+                    WHERE name = ? AND params = ? AND status != 'done'
+                    ORDER BY id DESC LIMIT 1
+                ''', (self.name, self.params)).fetchone()
+                if row is not None and row[1] == "running" and not self.force and _process_alive(row[2], row[3]):
+                    raise JobAlreadyRunning(f"任务 {self.name} #{row[0]} 正在运行（{row[2]} 进程 {row[3]}）")
+                if row is None:
+                    cursor = conn.execute('''
+                        INSERT INTO jobs (name, params, status, host, pid, processed, checkpoint, started_at, updated_at)
+                        VALUES (?, ?, 'running', ?, ?, 0, ?, ?, ?)
+                    ''', (self.name, self.params, socket.gethostname(), os.getpid(), json.dumps({"steps": []}),
+                          now, now))
+                    self.id = cursor.lastrowid
+                else:
+                    self.id, _, _, _, self.processed, checkpoint = row
+                    checkpoint = json.loads(checkpoint or "{}")
+                    self.steps = checkpoint.get("steps", [])
+                    self.partial = checkpoint.get("partial", {})
+                    conn.execute('''
+                        UPDATE jobs SET status = 'running', host = ?, pid = ?, attempts = attempts + 1,
+                                        updated_at = ?, error = NULL
+                        WHERE id = ?
+                    ''', (socket.gethostname(), os.getpid(), now, self.id))
+                    done = f"，已完成步骤: {', '.join(self.steps)}" if self.steps else ""
+                    print(f"继续上次未完成的任务 {self.name} #{self.id}（已处理 {self.processed} 个文件{done}）")
+        finally:
+            conn.close()
+        self._baseline = self._counter_total()
+        self._reporter = MetricsReporter(METRICS, interval=self.interval, callback=self._heartbeat)
+        self._reporter.start()
+        return self
+
+    def _heartbeat(self, snapshot):
+        processed = self.processed + self._counter_total(snapshot) - self._baseline
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("UPDATE jobs SET processed = ?, updated_at = ? WHERE id = ?",
+                             (processed, datetime.now().isoformat(), self.id))
+        finally:
+            conn.close()
+
+    def run_step(self, step, func, *args, **kwargs):
+        """
+        执行一个步骤并记录为已完成；恢复的任务中已完成的步骤会被跳过。
+        步骤中有文件处理失败（errors_total 增加）时记为部分完成，下次运行时重新执行。
+        """
+        if step in self.steps:
+            print(f"跳过已完成的步骤: {step}")
+            return None
+        errors_before = self._counter_total(names=("errors_total",))
+        result = func(*args, **kwargs)
+        errors = self._counter_total(names=("errors_total",)) - errors_before
+        if errors:
+            self.partial[step] = errors
+            print(f"步骤 {step} 有 {errors} 个错误，未记为完成，下次运行时会重新执行。")
+        else:
+            self.partial.pop(step, None)
+            self.steps.append(step)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("UPDATE jobs SET checkpoint = ?, updated_at = ? WHERE id = ?",
+                             (json.dumps({"steps": self.steps, "partial": self.partial}), datetime.now().isoformat(),
+                              self.id))
+        finally:
+            conn.close()
+        return result
+
+    def finish(self, status, error=None):
+        if self._reporter is not None:
+            # stop() 会再汇报一次，写入最终的进度
+            self._reporter.stop()
+            self._reporter = None
+        now = datetime.now().isoformat()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ?, finished_at = ? WHERE id = ?",
+                             (status, error, now, now if status in ("done", "partial") else None, self.id))
+        finally:
+            conn.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None and self.partial:
+            self.finish("partial", "部分文件处理失败: " + ", ".join(f"{step} {n} 个" for step, n in self.partial.items()))
+        elif exc_type is None:
+            self.finish("done")
+        elif issubclass(exc_type, KeyboardInterrupt):
+            self.finish("interrupted")
+        else:
+            self.finish("failed", f"{exc_type.__name__}: {exc}")
+        return False
+
+
+def list_jobs(conn, limit=20):
+    """
+    最近的任务 [(id, name, status, processed, attempts, started_at, updated_at, finished_at, error), ...]。
+    """
+    ensure_jobs_table(conn.cursor())
+    return conn.execute('''
+        SELECT id, name, status, processed, attempts, started_at, updated_at, finished_at, error
+        FROM jobs ORDER BY id DESC LIMIT ?
+    ''', (limit,)).fetchall()
@@ -0,0 +1,574 @@
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import os
+import select
+import sqlite3
+import stat
+import struct
+import time
+from datetime import datetime
+
+from metrics import METRICS
+
+# inotify 事件掩码（见 <sys/inotify.h>）
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# 新文件以 IN_CLOSE_WRITE（写完关闭）为准，不在 IN_CREATE 时入库，避免读到写了一半的文件
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+_EVENT_HEADER = struct.Struct("iIII")
+
+# MOVED_FROM 在这段时间内没有配对的 MOVED_TO，说明文件被移出了监视范围，按删除处理
+MOVE_PAIR_SECONDS = 1.0
+
+# 文件内容变化后需要重新计算（或重新校验）的列，以及以 record_id 引用 patient_data 的派生表
+DERIVED_COLUMNS = (
+    "actual_file_type", "meta_status", "file_size", "pre_hash", "content_hash",
+    "brightness_min", "brightness_max", "brightness_avg", "brightness_std",
+    "brightness_hist", "brightness_hist_spec", "intensity_status", "file_mtime_ns", "is_present", "verified_at",
+)
+DEPENDENT_TABLES = ("instance", "similarity", "preview", "sample_index", "embedding_index")
+
+
+def _prefix_range(path):
+    # path 目录下所有路径的范围 [path/, path0)，可以直接利用 file_path 上的唯一索引
+    return path + os.sep, path + chr(ord(os.sep) + 1)
+
+
+def _existing_tables(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def delete_records(conn, record_ids):
+    """
+    删除 patient_data 中的记录以及派生表中引用它们的行。
+    """
+    if not record_ids:
+        return
+    params = [(record_id,) for record_id in record_ids]
+    tables = _existing_tables(conn)
+    for table in DEPENDENT_TABLES:
+        if table in tables:
+            conn.executemany(f"DELETE FROM {table} WHERE record_id = ?", params)
+    conn.executemany("DELETE FROM patient_data WHERE id = ?", params)
+
+
+def invalidate_records(conn, record_ids):
+    """
+    文件内容变化后清空记录的派生列并删除派生表中的结果，下次运行各阶段时会重新计算。
+    """
+    if not record_ids:
+        return
+    params = [(record_id,) for record_id in record_ids]
+    tables = _existing_tables(conn)
+    for table in DEPENDENT_TABLES:
+        if table in tables:
+            conn.executemany(f"DELETE FROM {table} WHERE record_id = ?", params)
+    columns = [col[1] for col in conn.execute("PRAGMA table_info(patient_data);")]
+    derived = [column for column in DERIVED_COLUMNS if column in columns]
+    if derived:
+        assignments = ", ".join(f"{column} = NULL" for column in derived)
+        conn.executemany(f"UPDATE patient_data SET {assignments} WHERE id = ?", params)
+
+
+def _iter_tree(top, accepts):
+    """
+    遍历 top 下被 accepts 接受的目录和文件，产生 (path, is_dir, DirEntry)；目录先于其内容产生。
+    """
+    stack = [top]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as iterator:
+                entries = list(iterator)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not is_dir and not entry.is_file():
+                    continue
+            except OSError:
+                continue
+            if accepts(entry.path, is_dir=is_dir):
+                yield entry.path, is_dir, entry
+                if is_dir:
+                    stack.append(entry.path)
+
+
+class InotifyWatcher:
+    """
+    基于 Linux inotify 的递归目录监视（通过 ctypes 调用 libc，不需要额外依赖）。
+
+    read_events() 返回事件列表 [(action, path, dest, is_dir)]，action 为
+    "changed"（新建或被改写）、"deleted"、"moved" 或 "overflow"（内核事件队列溢出，有事件丢失）。
+    注意 inotify 只能看到本机发生的修改；网络共享上由其它主机做的修改需要使用 PollingWatcher。
+    """
+
+    def __init__(self, root, accepts):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 失败: {os.strerror(err)}")
+        self.fd = fd
+        self.root = root
+        self.accepts = accepts
+        self._paths = {}
+        self._wds = {}
+        self._moves = {}
+        try:
+            self.add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, "inotify 监视数已达上限，请增大 fs.inotify.max_user_watches 或改用轮询")
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                # 目录在建立监视前已被删除或无法访问
+                return
+            raise OSError(err, os.strerror(err), path)
+        self._paths[wd] = path
+        self._wds[path] = wd
+
+    def add_tree(self, top, events=None):
+        """
+        为 top 及其所有子目录建立监视。events 不为 None 时把目录中已存在的文件作为 "changed" 事件加入：
+        新目录在建立监视之前可能已经写入了文件（例如整个目录被复制进来）。
+        """
+        self._add_watch(top)
+        for path, is_dir, _ in _iter_tree(top, self.accepts):
+            if is_dir:
+                self._add_watch(path)
+            elif events is not None:
+                events.append(("changed", path, None, False))
+
+    def _watched_under(self, top):
+        prefix = top + os.sep
+        return [path for path in self._wds if path == top or path.startswith(prefix)]
+
+    def _forget_tree(self, top):
+        for path in self._watched_under(top):
+            wd = self._wds.pop(path)
+            self._paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def _move_tree(self, src, dst, events):
+        watched = self._watched_under(src)
+        if not watched:
+            # 从被排除的目录移入
+            if self.accepts(dst, is_dir=True):
+                self.add_tree(dst, events)
+            return
+        if not self.accepts(dst, is_dir=True):
+            self._forget_tree(src)
+            return
+        # 同一文件系统内的移动不会改变 inode，已有的监视继续有效，只需更新路径
+        for path in watched:
+            wd = self._wds.pop(path)
+            new_path = dst + path[len(src):]
+            self._wds[new_path] = wd
+            self._paths[wd] = new_path
+
+    def _handle(self, wd, mask, cookie, name, events):
+        if mask & IN_Q_OVERFLOW:
+            events.append(("overflow", self.root, None, True))
+            return
+        if mask & IN_IGNORED:
+            path = self._paths.pop(wd, None)
+            if path is not None and self._wds.get(path) == wd:
+                del self._wds[path]
+            return
+        dir_path = self._paths.get(wd)
+        if dir_path is None or mask & IN_DELETE_SELF:
+            return
+        path = os.path.join(dir_path, name)
+        is_dir = bool(mask & IN_ISDIR)
+        if mask & IN_MOVED_FROM:
+            self._moves[cookie] = (path, is_dir, time.monotonic())
+        elif mask & IN_MOVED_TO:
+            source = self._moves.pop(cookie, None)
+            if source is None:
+                # 从监视范围外移入
+                if is_dir:
+                    if self.accepts(path, is_dir=True):
+                        self.add_tree(path, events)
+                elif self.accepts(path):
+                    events.append(("changed", path, None, False))
+                return
+            if is_dir:
+                self._move_tree(source[0], path, events)
+            events.append(("moved", source[0], path, is_dir))
+        elif mask & IN_CREATE:
+            if is_dir and self.accepts(path, is_dir=True):
+                self.add_tree(path, events)
+        elif mask & IN_CLOSE_WRITE:
+            if self.accepts(path):
+                events.append(("changed", path, None, False))
+        elif mask & IN_DELETE:
+            events.append(("deleted", path, None, is_dir))
+
+    def read_events(self, timeout):
+        events = []
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                data = b""
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                self._handle(wd, mask, cookie, name, events)
+
+        now = time.monotonic()
+        for cookie, (path, is_dir, seen) in list(self._moves.items()):
+            if now - seen >= MOVE_PAIR_SECONDS:
+                del self._moves[cookie]
+                if is_dir:
+                    self._forget_tree(path)
+                events.append(("deleted", path, None, is_dir))
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class PollingWatcher:
+    """
+    没有 inotify 时（非 Linux、网络共享、监视数不足）的轮询实现：每 interval 秒遍历一次目录树，
+    与上次的 (设备, inode, 大小, mtime) 比较得到事件；同一 inode 的消失 + 出现识别为移动。
+    每次轮询都要 stat 所有文件，数据集很大时应把 interval 设得足够长。
+    """
+
+    def __init__(self, root, accepts, interval=60.0):
+        self.root = root
+        self.accepts = accepts
+        self.interval = interval
+        self._state = self._snapshot()
+        self._next_poll = time.monotonic() + interval
+
+    def _snapshot(self):
+        state = {}
+        for path, is_dir, entry in _iter_tree(self.root, self.accepts):
+            if is_dir:
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            state[path] = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        return state
+
+    def read_events(self, timeout):
+        remaining = self._next_poll - time.monotonic()
+        if remaining > 0:
+            time.sleep(min(timeout, remaining))
+            if time.monotonic() < self._next_poll:
+                return []
+        old, new = self._state, self._snapshot()
+        self._state = new
+        self._next_poll = time.monotonic() + self.interval
+
+        events = []
+        deleted = {path: info for path, info in old.items() if path not in new}
+        by_inode = {info[:2]: path for path, info in deleted.items()}
+        for path, info in new.items():
+            previous = old.get(path)
+            if previous is None:
+                source = by_inode.pop(info[:2], None)
+                if source is not None and deleted[source][2:] == info[2:]:
+                    del deleted[source]
+                    events.append(("moved", source, path, False))
+                else:
+                    events.append(("changed", path, None, False))
+            elif previous != info:
+                events.append(("changed", path, None, False))
+        events.extend(("deleted", path, None, False) for path in deleted)
+        return events
+
+    def close(self):
+        pass
+
+
+class LiveSync:
+    """
+    持续监视数据集目录，把文件的新增、改写、删除和移动同步到 patient_data。
+
+    事件先在内存中合并（同一路径的多次事件只保留最终状态），在 debounce 秒内没有新事件、
+    或距第一条未处理事件已超过 max_delay 秒、或积累了 batch_size 个路径时，在一个事务中批量应用：
+    - 移动：直接改写 file_path / patient_id，保留已计算的派生数据；
+    - 新增：插入记录；
+    - 改写：更新 updated_at，并清空派生列和派生表中的结果（见 invalidate_records）；
+    - 删除：删除记录及其派生数据（见 delete_records）。
+    应用时以文件系统的当前状态为准，因此重复或乱序的事件不会导致错误的结果。
+    """
+
+    def __init__(self, db_path, root, max_depth=None, include=None, exclude=None, method="auto",
+                 debounce=2.0, max_delay=30.0, batch_size=5000, poll_interval=60.0, source_id=None):
+        self.db_path = db_path
+        self.root = root
+        self.source_id = source_id
+        self.max_depth = max_depth
+        self.include = include
+        self.exclude = exclude
+        self.method = method
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.totals = {"inserted": 0, "updated": 0, "deleted": 0, "moved": 0}
+        self._moves = []
+        self._dirty = {}
+        self._overflow = False
+        self._first_event = None
+        self._last_event = None
+
+    def accepts(self, path, is_dir=False):
+        """
+        按扫描时相同的规则（患者文件夹下的文件、max_depth、include / exclude）判断路径是否应入库。
+        """
+        relative = os.path.relpath(path, self.root)
+        if relative == os.curdir:
+            return is_dir
+        parts = relative.split(os.sep)
+        if parts[0] == os.pardir:
+            return False
+        if self.exclude and any(fnmatch.fnmatch(part, pattern) for part in parts for pattern in self.exclude):
+            return False
+        # 患者文件夹本身深度为 0，其中的文件也在深度 0
+        depth = len(parts) - 1 if is_dir else len(parts) - 2
+        if depth < 0 or (self.max_depth is not None and depth > self.max_depth):
+            return False
+        if not is_dir and self.include and not any(fnmatch.fnmatch(parts[-1], p) for p in self.include):
+            return False
+        return True
+
+    def patient_id(self, path):
+        return os.path.relpath(path, self.root).split(os.sep)[0]
+
+    def open_watcher(self):
+        if self.method in ("auto", "inotify"):
+            try:
+                return InotifyWatcher(self.root, self.accepts)
+            except (OSError, AttributeError) as e:
+                if self.method == "inotify":
+                    raise
+                print(f"无法使用 inotify（{e}），改为每 {self.poll_interval:g} 秒轮询一次。")
+        return PollingWatcher(self.root, self.accepts, interval=self.poll_interval)
+
+    def pending(self):
+        return len(self._moves) + len(self._dirty) + int(self._overflow)
+
+    def _mark(self, path, reason):
+        # "changed" 优先于 "moved"：移动后又被改写的文件需要重新计算派生数据
+        if reason != "moved" or path not in self._dirty:
+            self._dirty[path] = reason
+
+    def add_events(self, events):
+        now = time.monotonic()
+        if events and not self.pending():
+            self._first_event = now
+        for action, path, dest, is_dir in events:
+            METRICS.inc("sync_events_total", action=action)
+            self._last_event = now
+            if action == "overflow":
+                self._overflow = True
+            elif action == "moved":
+                self._moves.append((path, dest, is_dir))
+                if is_dir:
+                    prefix = path + os.sep
+                    for old in [p for p in self._dirty if p.startswith(prefix)]:
+                        self._mark(dest + old[len(path):], self._dirty.pop(old))
+                else:
+                    self._mark(dest, self._dirty.pop(path, "moved"))
+            elif action == "deleted" and is_dir:
+                self._dirty[path] = "dir"
+            else:
+                self._mark(path, "changed")
+
+    def due(self):
+        if not self.pending():
+            return False
+        now = time.monotonic()
+        return (now - self._last_event >= self.debounce or now - self._first_event >= self.max_delay
+                or self.pending() >= self.batch_size)
+
+    def _record_id(self, conn, path):
+        row = conn.execute("SELECT id FROM patient_data WHERE file_path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def _records_under(self, conn, path):
+        low, high = _prefix_range(path)
+        return conn.execute("SELECT id, file_path FROM patient_data WHERE file_path >= ? AND file_path < ?",
+                            (low, high)).fetchall()
+
+    def _drop_snapshots(self, conn, path):
+        # 已删除或移走的目录不再保留快照，避免增量扫描把它们报告为"已消失"
+        low, high = _prefix_range(path)
+        conn.execute("DELETE FROM dir_snapshot WHERE path = ? OR (path >= ? AND path < ?)", (path, low, high))
+
+    def _move_record(self, conn, record_id, dst, timestamp, counts):
+        if not self.accepts(dst):
+            delete_records(conn, [record_id])
+            counts["deleted"] += 1
+            return
+        existing = self._record_id(conn, dst)
+        if existing is not None:
+            # 移动覆盖了已有文件（例如先写临时文件再改名），被覆盖文件的记录作废
+            delete_records(conn, [existing])
+        conn.execute(
+            "UPDATE patient_data SET file_path = ?, patient_id = ?, file_type = ?, updated_at = ? WHERE id = ?",
+            (dst, self.patient_id(dst), os.path.splitext(dst)[-1].lower(), timestamp, record_id))
+        counts["moved"] += 1
+
+    def _apply_move(self, conn, src, dst, is_dir, timestamp, counts):
+        if not is_dir:
+            record_id = self._record_id(conn, src)
+            if record_id is not None:
+                self._move_record(conn, record_id, dst, timestamp, counts)
+            else:
+                # 源文件不在库中（例如被排除的临时文件改名覆盖目标）：目标的内容已经变了
+                self._dirty[dst] = "changed"
+            return
+        for record_id, path in self._records_under(conn, src):
+            self._move_record(conn, record_id, dst + path[len(src):], timestamp, counts)
+        self._drop_snapshots(conn, src)
+        self._drop_snapshots(conn, dst)
+
+    def _reconcile(self, conn, timestamp, counts):
+        inserts = []
+        updates = []
+        deletes = []
+        for path, reason in self._dirty.items():
+            if reason == "dir":
+                if not os.path.isdir(path):
+                    deletes.extend(record_id for record_id, _ in self._records_under(conn, path))
+                    self._drop_snapshots(conn, path)
+                continue
+            try:
+                exists = stat.S_ISREG(os.stat(path).st_mode)
+            except OSError:
+                exists = False
+            record_id = self._record_id(conn, path)
+            if exists and self.accepts(path):
+                file_type = os.path.splitext(path)[-1].lower()
+                if record_id is None:
+                    inserts.append((self.patient_id(path), path, file_type, timestamp, timestamp, self.source_id))
+                elif reason == "changed":
+                    updates.append((file_type, timestamp, record_id))
+            elif not exists and record_id is not None:
+                deletes.append(record_id)
+
+        conn.executemany('''
+            INSERT OR IGNORE INTO patient_data (patient_id, file_path, file_type, created_at, updated_at, source_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', inserts)
+        conn.executemany("UPDATE patient_data SET file_type = ?, updated_at = ? WHERE id = ?", updates)
+        invalidate_records(conn, [record_id for _, _, record_id in updates])
+        delete_records(conn, deletes)
+        counts["inserted"] += len(inserts)
+        counts["updated"] += len(updates)
+        counts["deleted"] += len(deletes)
+
+    def resync(self, conn, counts):
+        """
+        完整比对该根目录下的记录与文件系统：插入缺失的文件、删除已不存在的记录。
+        事件丢失（inotify 队列溢出）后使用；只能发现新增和删除，无法发现期间被改写的文件。
+        """
+        print("正在完整比对数据库与文件系统...")
+        timestamp = datetime.now().isoformat()
+        present = {path for path, is_dir, _ in _iter_tree(self.root, self.accepts) if not is_dir}
+        deletes = []
+        for record_id, path in self._records_under(conn, os.path.normpath(self.root)):
+            if path in present:
+                present.discard(path)
+            elif not os.path.isfile(path):
+                deletes.append(record_id)
+        delete_records(conn, deletes)
+        cursor = conn.executemany('''
+            INSERT OR IGNORE INTO patient_data (patient_id, file_path, file_type, created_at, updated_at, source_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(self.patient_id(path), path, os.path.splitext(path)[-1].lower(), timestamp, timestamp, self.source_id)
+              for path in sorted(present)])
+        # 已有记录的路径被 IGNORE 跳过，只计实际插入的行
+        counts["inserted"] += cursor.rowcount
+        counts["deleted"] += len(deletes)
+
+    def flush(self, conn):
+        """
+        在一个事务中应用所有已合并的事件，返回本批的计数。
+        """
+        counts = {"inserted": 0, "updated": 0, "deleted": 0, "moved": 0}
+        timestamp = datetime.now().isoformat()
+        with METRICS.transaction(conn, "sync"):
+            # 先处理移动（保留派生数据），再按文件系统的当前状态核对其余路径
+            for src, dst, is_dir in self._moves:
+                self._apply_move(conn, src, dst, is_dir, timestamp, counts)
+            if self._overflow:
+                self.resync(conn, counts)
+            self._reconcile(conn, timestamp, counts)
+        self._moves.clear()
+        self._dirty.clear()
+        self._overflow = False
+        for action, count in counts.items():
+            self.totals[action] += count
+            if count:
+                METRICS.inc("sync_records_total", count, action=action)
+        return counts
+
+    def run(self, duration=None, initial_sync=False, stop_event=None):
+        """
+        开始监视，直到 duration 秒后、stop_event 被设置或按下 Ctrl+C；退出前会应用所有未处理的事件。
+
+        initial_sync=True 时先完整比对一次，以补上监视未运行期间发生的新增和删除。
+        """
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        watcher = self.open_watcher()
+        kind = "inotify" if isinstance(watcher, InotifyWatcher) else "轮询"
+        print(f"开始同步 {self.root}（{kind}），按 Ctrl+C 停止。")
+        deadline = None if duration is None else time.monotonic() + duration
+        try:
+            if initial_sync:
+                self._overflow = True
+                self._first_event = self._last_event = time.monotonic()
+            while True:
+                if stop_event is not None and stop_event.is_set():
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                self.add_events(watcher.read_events(timeout=min(self.debounce, 1.0)))
+                if self.due():
+                    counts = self.flush(conn)
+                    print(f"[{datetime.now():%H:%M:%S}] 同步: 新增 {counts['inserted']}，更新 {counts['updated']}，"
+                          f"删除 {counts['deleted']}，移动 {counts['moved']}")
+        except KeyboardInterrupt:
+            print("正在停止同步...")
+        finally:
+            try:
+                if self.pending():
+                    self.flush(conn)
+            finally:
+                watcher.close()
+                conn.close()
+        print("同步结束，累计: " + ", ".join(f"{k}={v}" for k, v in self.totals.items()))
+        return dict(self.totals)
@@ -1,39 +1,298 @@
-from dbmgr import DBManager
+import argparse
+import signal
+import sys
 
-def main():
-    # 文件位置配置
-    db_path = 'patient_data.db'
-    full_dataset_path = '/media/molloi-lab-linux2/HD-88/ICONIC CCTAS'
+# 默认文件位置，可用 --db / --root 覆盖
+DEFAULT_DB_PATH = 'patient_data.db'
+DEFAULT_DATASET_PATH = '/media/molloi-lab-linux2/HD-88/ICONIC CCTAS'
 
-    # 初始化 DBManager 实例
-    db = DBManager(db_path, full_dataset_path)
+# run-all 依次执行的步骤；任务被中断后再次运行会跳过已完成的步骤
+RUN_ALL_STEPS = ("scan", "verify", "detect", "fingerprint", "dicom-meta", "intensity")
 
+# 只影响速度或输出、不影响结果的参数不计入任务身份：换一个 --workers 等重新运行时仍继续原来的任务
+JOB_IGNORED_ARGS = ("handler", "force", "metrics", "metrics_interval", "workers", "checkpoint_every", "slab_size",
+                    "preload", "volume_cache", "volume_cache_gb")
+
+
+def _roots(args):
+    # --source ID=PATH 指定数据源名称；只给 --root 时以目录名作为数据源名称
+    if args.source:
+        return dict(args.source)
+    return args.root or [DEFAULT_DATASET_PATH]
+
+
+def _manager(args):
+    # 各模块在用到时才导入，保证 --help 等命令启动迅速
+    from dbmgr import DBManager
+    return DBManager(args.db, _roots(args), max_depth=args.max_depth, include=args.include, exclude=args.exclude)
+
+
+def _parse_source(text):
+    source_id, sep, path = text.partition("=")
+    if not sep or not source_id or not path:
+        raise argparse.ArgumentTypeError("数据源格式应为 ID=PATH")
+    return source_id, path
+
+
+def _parse_shape(text):
+    height, width = text.lower().split("x")
+    return int(height), int(width)
+
+
+def _parse_reference(text):
+    path, _, index = text.rpartition(":")
+    if not path:
+        raise argparse.ArgumentTypeError("基准切片格式应为 PATH:SLICE_INDEX")
+    return path, int(index)
+
+
+def _steps(db, args):
+    """
+    返回命令对应的 [(步骤名, 无参函数)]。
+    """
+    workers = args.workers
+    # 体数据缓存：解码一次后以 .npy 保存，重复运行的各阶段直接内存映射读取
+    cache = {"volume_cache": args.volume_cache,
+             "volume_cache_bytes": int(args.volume_cache_gb * 1024 ** 3) if args.volume_cache_gb else None}
+    preload = None if getattr(args, "preload", "auto") == "none" else getattr(args, "preload", "auto")
+    available = {
+        "scan": lambda: db.scan_and_add_missing_patients(incremental=not getattr(args, "full", False),
+                                                         preload=preload),
+        "verify": lambda: db.verify_files(workers=workers, delete_missing=getattr(args, "delete_missing", False)),
+        "detect": lambda: db.update_actual_file_types(workers=workers,
+                                                      checkpoint_every=getattr(args, "checkpoint_every", 2000)),
+        "fingerprint": lambda: db.fingerprint_files(workers=workers),
+        "dicom-meta": lambda: db.extract_dicom_metadata(workers=workers),
+        "intensity": lambda: db.compute_intensity_stats(workers=workers,
+                                                        slab_size=getattr(args, "slab_size", 16), **cache),
+    }
+    if args.command == "run-all":
+        return [(step, available[step]) for step in RUN_ALL_STEPS]
+    if args.command in available:
+        return [(args.command, available[args.command])]
+    if args.command == "assemble":
+        return [("assemble", lambda: db.assemble_series_volumes(args.cache_dir, workers=workers,
+                                                                compress=args.compress))]
+    if args.command == "samples":
+        return [("samples", lambda: db.build_sample_store(args.store_dir, num_slices=args.num_slices,
+                                                          target_shape=args.shape, workers=workers, **cache))]
+    if args.command == "previews":
+        return [("previews", lambda: db.build_previews(max_size=args.max_size, workers=workers, **cache))]
+    if args.command == "pipeline":
+        return [("pipeline", lambda: db.run_pipeline(analyzers=args.analyzers, workers=workers))]
+    if args.command == "cluster":
+        def cluster():
+            sizes = db.cluster_embeddings(args.embedding_dir, args.model, args.k, column=args.column,
+                                          epochs=args.epochs)
+            for label, size in sizes.items():
+                print(f"  类别 {label}: {size} 条记录")
+        return [("cluster", cluster)]
+    if args.command == "similarity":
+        def rank():
+            for reference_id in db.rank_similarity(args.reference, target_shape=args.shape,
+                                                   num_slices=args.num_slices, workers=workers, **cache):
+                print(f"基准 #{reference_id} 最相似的 {args.top} 条记录:")
+                for record_id, patient_id, file_path, ssim, ncc, best_slice in db.top_similar(reference_id,
+                                                                                             args.top):
+                    print(f"  {ssim:.4f}  {ncc:.4f}  第 {best_slice} 张  {patient_id}  {file_path}")
+        return [("similarity", rank)]
+    raise ValueError(f"未知的命令: {args.command}")
+
+
+def run_job(args):
+    """
+    以可恢复任务的方式运行长命令：进度和已完成步骤记录在 jobs 表中，中断后用相同参数再次运行即可继续。
+    有步骤部分失败时返回退出码 1。
+    """
+    from jobs import Job
+
+    db = _manager(args)
+    db.initialize_database(assume_yes=False)
+    params = {key: value for key, value in vars(args).items() if key not in JOB_IGNORED_ARGS}
+    progress_counter = {"scan": "scan_files_total", "run-all": ("scan_files_total", "files_total")}.get(
+        args.command, "files_total")
+    with Job(args.db, args.command, params, progress_counter=progress_counter, force=args.force) as job:
+        for step, func in _steps(db, args):
+            job.run_step(step, func)
+    return 1 if job.partial else 0
+
+
+def cmd_init(args):
+    _manager(args).initialize_database(assume_yes=args.reinit)
+
+
+def cmd_sync(args):
+    _manager(args).live_sync(method=args.method, debounce=args.debounce, max_delay=args.max_delay,
+                             poll_interval=args.poll_interval, initial_sync=args.initial_sync,
+                             duration=args.duration)
+
+
+def cmd_summary(args):
+    from summary import print_counts
+
+    db = _manager(args)
+    inventory = db.inventory_summary()
+    print(f"文件数: {inventory['files']}，患者数: {inventory['patients']}，扩展名种类: {inventory['file_types']}")
+    print_counts(db.file_type_counts(), header="文件类型")
+    print_counts(db.actual_file_type_counts(), header="实际文件类型")
+
+
+def cmd_jobs(args):
+    import sqlite3
+    from jobs import list_jobs
+
+    conn = sqlite3.connect(args.db)
     try:
-        print("1. 初始化数据库")
-        print("2. 扫描并初始化数据库")
-        print("3. 扫描并添加缺失患者记录")
-        print("0. 退出")
-
-        while True:
-            choice = input("请选择操作（输入对应数字）：").strip()
-            if choice == '1':
-                db.initialize_database()
-            elif choice == '2':
-                db.scan_and_add_patients()
-            elif choice == '3':
-                db.scan_and_add_missing_patients()
-            elif choice == '0':
-                print("退出程序")
-                break
-            else:
-                print("无效的选择，请重新输入！")
+        rows = list_jobs(conn, limit=args.limit)
+        conn.commit()
+    finally:
+        conn.close()
+    if not rows:
+        print("没有任务记录。")
+    for job_id, name, status, processed, attempts, started_at, updated_at, finished_at, error in rows:
+        line = f"#{job_id:<5} {name:<12} {status:<12} 已处理 {processed:<8} 第 {attempts} 次运行  更新于 {updated_at}"
+        print(line + (f"  错误: {error}" if error else ""))
 
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="ICONIC CCTAS 数据集管理工具")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="数据库路径")
+    parser.add_argument("--root", action="append", default=None,
+                        help="数据集根目录（每个子文件夹为一个患者），可重复指定多个磁盘")
+    parser.add_argument("--source", type=_parse_source, action="append", default=None,
+                        help="带名称的数据集根目录 ID=PATH（可重复），优先于 --root")
+    parser.add_argument("--workers", type=int, default=None, help="并发数，默认按磁盘类型和 CPU 数自动选择")
+    parser.add_argument("--max-depth", type=int, default=None, help="患者文件夹内的最大递归深度")
+    parser.add_argument("--include", action="append", default=None, help="只收录匹配的文件名（可重复）")
+    parser.add_argument("--exclude", action="append", default=None, help="跳过匹配的文件名或目录名（可重复）")
+    parser.add_argument("--volume-cache", default=None,
+                        help="已解码体数据的缓存目录（intensity / samples / previews / similarity 使用）")
+    parser.add_argument("--volume-cache-gb", type=float, default=None, help="体数据缓存的大小上限（GB），默认 50")
+    parser.add_argument("--force", action="store_true", help="即使记录显示同名任务仍在运行也继续执行")
+    parser.add_argument("--metrics", default=None, help="定期写出指标文件（.prom 为 Prometheus 格式，否则为 JSON）")
+    parser.add_argument("--metrics-interval", type=float, default=30.0, help="写出指标文件的间隔（秒）")
+    subparsers = parser.add_subparsers(dest="command", metavar="命令")
+
+    p = subparsers.add_parser("init", help="创建数据库表结构")
+    p.add_argument("--reinit", action="store_true", help="数据库已存在时备份旧文件并重新初始化（不询问）")
+    p.set_defaults(handler=cmd_init)
+
+    p = subparsers.add_parser("scan", help="扫描数据集并添加缺失的文件记录")
+    p.add_argument("--full", action="store_true", help="完整扫描，不使用目录快照跳过未变化的目录")
+    p.add_argument("--preload", choices=("auto", "set", "hash", "none"), default="auto",
+                   help="已知路径的预加载方式")
+    p.set_defaults(handler=run_job)
+
+    p = subparsers.add_parser("verify", help="校验所有文件是否存在、大小和修改时间是否变化")
+    p.add_argument("--delete-missing", action="store_true", help="删除文件已不存在的记录（默认只做标记）")
+    p.set_defaults(handler=run_job)
+
+    p = subparsers.add_parser("detect", help="检测文件的实际类型")
+    p.add_argument("--checkpoint-every", type=int, default=2000, help="每处理多少个文件提交一次")
+    p.set_defaults(handler=run_job)
+
+    p = subparsers.add_parser("fingerprint", help="计算文件指纹，用于查找重复文件")
+    p.set_defaults(handler=run_job)
+
+    p = subparsers.add_parser("dicom-meta", help="提取 DICOM 文件头中的检查 / 序列信息")
+    p.set_defaults(handler=run_job)
+
+    p = subparsers.add_parser("intensity", help="计算 NIfTI 文件的亮度统计")
+    p.add_argument("--slab-size", type=int, default=16, help="每次读取的切片数")
+    p.set_defaults(handler=run_job)
+
+    p = subparsers.add_parser("assemble", help="把 DICOM 序列组装为体数据文件")
+    p.add_argument("--cache-dir", required=True, help="体数据输出目录")
+    p.add_argument("--compress", action="store_true", help="输出压缩的 .nii.gz")
+    p.set_defaults(handler=run_job)
+
+    p = subparsers.add_parser("samples", help="生成训练样本分片")
+    p.add_argument("--store-dir", required=True, help="样本分片目录")
+    p.add_argument("--num-slices", type=int, default=5)
+    p.add_argument("--shape", type=_parse_shape, default=(50, 50), help="切片尺寸 HxW，默认 50x50")
+    p.set_defaults(handler=run_job)
+
+    p = subparsers.add_parser("previews", help="生成缩略图缓存")
+    p.add_argument("--max-size", type=int, default=128)
+    p.set_defaults(handler=run_job)
+
+    p = subparsers.add_parser("pipeline", help="单遍分析：每个文件只读一次，同时运行多个分析器")
+    p.add_argument("--analyzers", nargs="+", default=["file_type", "hash", "intensity"])
+    p.set_defaults(handler=run_job)
+
+    p = subparsers.add_parser("cluster", help="对已保存的嵌入做 Mini-Batch K-Means 聚类，标签写回数据库")
+    p.add_argument("--embedding-dir", required=True, help="嵌入分片目录")
+    p.add_argument("--model", required=True, help="编码器名称（build_embeddings 时指定）")
+    p.add_argument("--k", type=int, required=True, help="聚类数")
+    p.add_argument("--column", default="cluster_label", help="写入标签的列名")
+    p.add_argument("--epochs", type=int, default=3)
+    p.set_defaults(handler=run_job)
+
+    p = subparsers.add_parser("similarity", help="与基准切片比较相似度")
+    p.add_argument("--reference", type=_parse_reference, action="append", required=True,
+                   help="基准切片 PATH:SLICE_INDEX（可重复）")
+    p.add_argument("--shape", type=_parse_shape, default=(100, 100), help="比较时的切片尺寸 HxW")
+    p.add_argument("--num-slices", type=int, default=10)
+    p.add_argument("--top", type=int, default=10, help="输出最相似的记录数")
+    p.set_defaults(handler=run_job)
+
+    p = subparsers.add_parser("run-all", help="依次执行 " + " → ".join(RUN_ALL_STEPS) + "，可中断后继续")
+    p.add_argument("--full", action="store_true", help="完整扫描，不使用目录快照")
+    p.set_defaults(handler=run_job)
+
+    p = subparsers.add_parser("sync", help="持续监视数据集目录并同步数据库")
+    p.add_argument("--method", choices=("auto", "inotify", "poll"), default="auto")
+    p.add_argument("--debounce", type=float, default=2.0)
+    p.add_argument("--max-delay", type=float, default=30.0)
+    p.add_argument("--poll-interval", type=float, default=60.0)
+    p.add_argument("--initial-sync", action="store_true", help="启动时先完整比对一次")
+    p.add_argument("--duration", type=float, default=None, help="运行多少秒后退出，默认一直运行")
+    p.set_defaults(handler=cmd_sync)
+
+    p = subparsers.add_parser("summary", help="输出文件类型统计")
+    p.set_defaults(handler=cmd_summary)
+
+    p = subparsers.add_parser("jobs", help="列出最近的任务及其状态")
+    p.add_argument("--limit", type=int, default=20)
+    p.set_defaults(handler=cmd_jobs)
+    return parser
+
+
+def _interrupt(signum, frame):
+    # kill / nohup 下的 SIGTERM 按 Ctrl+C 处理，任务会被记录为 interrupted
+    raise KeyboardInterrupt
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 0
+    signal.signal(signal.SIGTERM, _interrupt)
+
+    reporter = None
+    if args.metrics:
+        from metrics import METRICS, MetricsReporter
+        path_option = "prometheus_path" if args.metrics.endswith(".prom") else "json_path"
+        reporter = MetricsReporter(METRICS, interval=args.metrics_interval, **{path_option: args.metrics})
+        reporter.start()
+    try:
+        return args.handler(args) or 0
+    except KeyboardInterrupt:
+        print("已中断；使用相同的参数重新运行即可从上次的检查点继续。")
+        return 130
     except Exception as e:
+        from jobs import JobAlreadyRunning
+        if isinstance(e, JobAlreadyRunning):
+            print(e)
+            return 2
         print(f"运行时发生错误：{e}")
+        return 1
     finally:
-        print("程序已结束。")
-
+        if reporter is not None:
+            reporter.stop()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,264 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from parallel import imap_bounded
+
+# 延迟直方图的桶上界（秒），覆盖从单次 stat 到长事务的范围
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, 120.0)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, counts, total, count):
+        for i, n in enumerate(counts):
+            self.counts[i] += n
+        self.sum += total
+        self.count += count
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class MetricsRegistry:
+    """
+    进程内的轻量指标注册表：计数器（文件数、字节数）和延迟直方图（各阶段耗时、SQLite 事务延迟）。
+
+    指标名可以带标签，例如 METRICS.inc("files_total", 10, stage="intensity")。
+    进程池中的工作进程各有一份注册表，通过 imap_instrumented 把增量合并回主进程。
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.enabled = True
+        self._counters = {}
+        self._histograms = {}
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        记录 with 块的耗时（秒）到直方图 name 中。
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def transaction(self, conn, stage):
+        """
+        代替 "with conn:" 使用，同时把整个事务（包括等待写锁）的耗时记入 db_transaction_seconds。
+        """
+        start = time.perf_counter()
+        with conn:
+            yield conn
+        self.observe("db_transaction_seconds", time.perf_counter() - start, stage=stage)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started = time.time()
+
+    def export_state(self):
+        """
+        可 pickle 的原始状态，用于从工作进程传回主进程。
+        """
+        with self._lock:
+            return (dict(self._counters),
+                    {key: (list(h.counts), h.sum, h.count) for key, h in self._histograms.items()})
+
+    def merge_state(self, state):
+        counters, histograms = state
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, (counts, total, count) in histograms.items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram()
+                histogram.merge(counts, total, count)
+
+    def add_callback(self, callback):
+        """
+        注册回调，MetricsReporter 每次汇报时以 snapshot() 的结果调用。
+        """
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self._callbacks.remove(callback)
+
+    def notify(self):
+        snapshot = self.snapshot()
+        for callback in list(self._callbacks):
+            callback(snapshot)
+        return snapshot
+
+    def snapshot(self):
+        """
+        返回当前所有指标：计数器附带自开始以来的平均速率（每秒），直方图附带次数、总和和分桶计数。
+        """
+        elapsed = max(time.time() - self.started, 1e-9)
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value, "rate": value / elapsed}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{"name": name, "labels": dict(labels), "count": h.count, "sum": h.sum,
+                           "mean": h.sum / h.count if h.count else None,
+                           "buckets": dict(zip([str(b) for b in h.buckets] + ["+Inf"], h.counts))}
+                          for (name, labels), h in sorted(self._histograms.items())]
+        return {"timestamp": time.time(), "uptime_seconds": elapsed, "counters": counters, "histograms": histograms}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, ensure_ascii=False)
+
+    def to_prometheus(self, prefix="iconic_"):
+        """
+        Prometheus 文本格式（可供 node_exporter 的 textfile collector 读取）。
+        """
+        def label_text(labels, extra=None):
+            items = list(labels.items()) + (list(extra.items()) if extra else [])
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        snapshot = self.snapshot()
+        lines = []
+        declared = set()
+        for counter in snapshot["counters"]:
+            name = prefix + counter["name"]
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{label_text(counter['labels'])} {counter['value']}")
+        for histogram in snapshot["histograms"]:
+            name = prefix + histogram["name"]
+            if name not in declared:
+                lines.append(f"# TYPE {name} histogram")
+                declared.add(name)
+            cumulative = 0
+            for bound, count in histogram["buckets"].items():
+                cumulative += count
+                lines.append(f"{name}_bucket{label_text(histogram['labels'], {'le': bound})} {cumulative}")
+            lines.append(f"{name}_sum{label_text(histogram['labels'])} {histogram['sum']}")
+            lines.append(f"{name}_count{label_text(histogram['labels'])} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, fmt=None):
+        """
+        原子地写出指标文件；fmt 为 "json" 或 "prometheus"，默认按扩展名判断（.prom 为 Prometheus）。
+        """
+        fmt = fmt or ("prometheus" if path.endswith(".prom") else "json")
+        text = self.to_prometheus() if fmt == "prometheus" else self.to_json()
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+METRICS = MetricsRegistry()
+
+
+class MetricsReporter(threading.Thread):
+    """
+    后台线程：每 interval 秒调用已注册的回调，并按需写出 JSON / Prometheus 文件。
+    callback 只在该线程运行期间注册，stop() 时注销。
+    """
+
+    def __init__(self, registry=METRICS, interval=10.0, json_path=None, prometheus_path=None, callback=None):
+        super().__init__(daemon=True)
+        self.registry = registry
+        self.callback = callback
+        self.interval = interval
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self._stop_event = threading.Event()
+
+    def report(self):
+        self.registry.notify()
+        if self.json_path:
+            self.registry.write(self.json_path, "json")
+        if self.prometheus_path:
+            self.registry.write(self.prometheus_path, "prometheus")
+
+    def start(self):
+        if self.callback is not None:
+            self.registry.add_callback(self.callback)
+        super().start()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                print(f"写出指标时出错: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.report()
+        if self.callback is not None:
+            self.registry.remove_callback(self.callback)
+
+
+class _Instrumented:
+    # 在工作进程中执行任务，并把该任务产生的指标增量随结果一起返回；
+    # 在主进程中（例如线程池）执行时指标已直接记入 METRICS，不做重置
+    def __init__(self, func, stage):
+        self.func = func
+        self.stage = stage
+        self.owner_pid = os.getpid()
+
+    def __call__(self, item):
+        if os.getpid() == self.owner_pid:
+            with METRICS.timer("task_seconds", stage=self.stage):
+                return self.func(item), None
+        METRICS.reset()
+        with METRICS.timer("task_seconds", stage=self.stage):
+            result = self.func(item)
+        return result, METRICS.export_state()
+
+
+def imap_instrumented(executor, func, items, max_in_flight, stage, gate_of=None):
+    """
+    与 parallel.imap_bounded 相同，但会收集进程池中每个任务的指标（解码耗时、读取字节数等）
+    并合并到主进程的 METRICS。
+    """
+    for item, (result, state) in imap_bounded(executor, _Instrumented(func, stage), items, max_in_flight,
+                                              gate_of=gate_of):
+        if state is not None:
+            METRICS.merge_state(state)
+        yield item, result
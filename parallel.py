@@ -0,0 +1,67 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+def imap_bounded(executor, func, items, max_in_flight, gate_of=None, lookahead=None):
+    """
+    将 items 逐个提交给 executor 执行 func，按完成顺序产生 (item, result)。
+
+    同时在途的任务数不超过 max_in_flight，items 可以是惰性生成器，不会被一次性读入内存。
+
+    gate_of(item) 返回该任务的并发闸门（带 limit 属性的对象，例如 io_sched.device_gate 给出的按设备闸门）。
+    某个闸门的在途任务数达到 limit 时，它的任务先暂存在各自的队列中（合计不超过 lookahead 个，
+    默认 4 * max_in_flight），其它闸门的任务照常提交，慢盘上的任务不会占满整个进程池。
+    """
+    items = iter(items)
+    lookahead = lookahead or 4 * max_in_flight
+    in_flight = {}
+    queues = {}
+    active = {}
+    queued = 0
+    exhausted = False
+
+    def submit(gate, item):
+        in_flight[executor.submit(func, item)] = (gate, item)
+        active[gate] = active.get(gate, 0) + 1
+
+    while True:
+        for gate, queue in queues.items():
+            while queue and len(in_flight) < max_in_flight and active.get(gate, 0) < gate.limit:
+                submit(gate, queue.popleft())
+                queued -= 1
+        while not exhausted and len(in_flight) < max_in_flight and queued < lookahead:
+            item = next(items, None)
+            if item is None:
+                exhausted = True
+                break
+            gate = gate_of(item) if gate_of is not None else None
+            if gate is None or active.get(gate, 0) < gate.limit:
+                submit(gate, item)
+            else:
+                queues.setdefault(gate, deque()).append(item)
+                queued += 1
+        if not in_flight:
+            break
+
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            gate, item = in_flight.pop(future)
+            active[gate] -= 1
+            yield item, future.result()
+
+
+def keyset_chunks(conn, query, params=(), page_size=10000, chunk_size=64):
+    """
+    按 id 分页执行查询，逐块产生记录列表。
+
+    query 的第一列必须是 id，并以 "... AND id > ? ORDER BY id LIMIT ?" 结尾；params 为其余参数。
+    已处理的记录在分页过程中被更新也不会被重复读取。
+    """
+    last_id = -1
+    while True:
+        rows = conn.execute(query, tuple(params) + (last_id, page_size)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
@@ -0,0 +1,409 @@
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from tqdm import tqdm
+
+from io_sched import default_workers, device_gate
+from metrics import METRICS, imap_instrumented
+from parallel import keyset_chunks
+from record_filter import nifti_condition
+
+# 已注册的分析器：名称 -> 类
+ANALYZERS = {}
+
+# 与其它阶段一致的 NIfTI 记录筛选条件（actual_file_type 为空时按扩展名判断）
+NIFTI_CONDITION = nifti_condition()
+
+# 工作进程中的分析器实例
+_WORKER_ANALYZERS = None
+
+
+def register_analyzer(cls):
+    """
+    注册分析器的类装饰器，之后可以在 run_pipeline 中按名称使用。
+    """
+    ANALYZERS[cls.name] = cls
+    return cls
+
+
+class FileContext:
+    """
+    单个文件在一次流水线中的共享读取结果。
+
+    header、data 和 volume 都是按需读取并缓存的：只需要文件头的分析器不会触发整文件读取，
+    多个分析器需要整个文件时也只读一次磁盘。
+    """
+
+    def __init__(self, record_id, file_path):
+        self.record_id = record_id
+        self.file_path = file_path
+        self._header = None
+        self._data = None
+        self._volume = None
+        self._volume_loaded = False
+
+    @property
+    def header(self):
+        from file_format import HEADER_BYTES
+
+        if self._data is not None:
+            return self._data[:HEADER_BYTES]
+        if self._header is None:
+            with open(self.file_path, "rb") as f:
+                self._header = f.read(HEADER_BYTES)
+        return self._header
+
+    @property
+    def has_data(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        if self._data is None:
+            from io_sched import advise_sequential
+
+            with open(self.file_path, "rb") as f:
+                advise_sequential(f)
+                self._data = f.read()
+        return self._data
+
+    @property
+    def volume(self):
+        """
+        解码后的 (depth, height, width) 体数据；不是 NIfTI 文件时为 None。
+        """
+        if not self._volume_loaded:
+            from volume import decode_nifti_bytes
+
+            self._volume = decode_nifti_bytes(self.data)
+            self._volume_loaded = True
+        return self._volume
+
+
+class AnalysisFailed(Exception):
+    """
+    分析器无法处理某个文件时抛出：错误照常汇报，value（例如失败状态）仍然写入数据库，
+    使 pending_sql 不再选中该记录，避免每次运行都重新读取无法处理的文件。
+    """
+
+    def __init__(self, message, value):
+        super().__init__(message)
+        self.value = value
+
+
+class Analyzer:
+    """
+    分析器基类。
+
+    子类设置 name 和 columns（写入 patient_data 的列名 -> 类型），实现 pending_sql（仍需处理的记录的
+    WHERE 条件）和 analyze(ctx)（返回 {列名: 值}，不适用时返回 None）。需要写其它表的分析器覆盖 store。
+    reads_data 为 True 的分析器需要整个文件内容。prepare 在主进程中调用一次，之后分析器实例会被复制到各工作进程。
+    需要记录失败、不再重试的文件由 analyze 抛出 AnalysisFailed。
+    """
+
+    name = None
+    columns = {}
+    reads_data = True
+
+    def prepare(self, conn):
+        existing = [col[1] for col in conn.execute("PRAGMA table_info(patient_data);")]
+        for column, column_type in self.columns.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE patient_data ADD COLUMN {column} {column_type};")
+
+    def pending_sql(self):
+        raise NotImplementedError
+
+    def analyze(self, ctx):
+        raise NotImplementedError
+
+    def store(self, conn, results):
+        """
+        把 [(record_id, 结果字典), ...] 写入数据库；由调用方统一提交事务。
+        """
+        columns = list(self.columns)
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        conn.executemany(f"UPDATE patient_data SET {assignments} WHERE id = ?",
+                         [[values[column] for column in columns] + [record_id] for record_id, values in results])
+
+
+@register_analyzer
+class FileTypeAnalyzer(Analyzer):
+    """
+    文件类型嗅探（同 file_format.update_actual_file_types），只有其它分析器已读入整个文件时才使用全文内容。
+    """
+
+    name = "file_type"
+    columns = {"actual_file_type": "TEXT"}
+    reads_data = False
+
+    def __init__(self):
+        self._magic = None
+
+    def __getstate__(self):
+        # libmagic 句柄不能序列化，工作进程中第一次使用时重新创建。
+        # 注意不能返回 {}：空字典为假值，反序列化时会跳过 __dict__ 的恢复，_magic 属性将不存在
+        return {"_magic": None}
+
+    def pending_sql(self):
+        return "(actual_file_type IS NULL OR actual_file_type = '')"
+
+    def analyze(self, ctx):
+        import magic
+        from file_format import detect_file_format
+
+        if self._magic is None:
+            self._magic = magic.Magic(mime=True)
+        data = ctx.data if ctx.has_data else None
+        return {"actual_file_type": detect_file_format(ctx.file_path, self._magic, data=data)}
+
+
+@register_analyzer
+class HashAnalyzer(Analyzer):
+    """
+    文件大小、预哈希和完整内容哈希（与 fingerprint.py 的结果相同）。
+    文件内容已经在内存中，因此直接为每个文件计算完整哈希，而不是只对候选重复文件计算。
+    """
+
+    name = "hash"
+    columns = {"file_size": "INTEGER", "pre_hash": "TEXT", "content_hash": "TEXT"}
+
+    def pending_sql(self):
+        return "content_hash IS NULL"
+
+    def analyze(self, ctx):
+        from fingerprint import content_hash_bytes, pre_hash_bytes
+
+        data = ctx.data
+        return {"file_size": len(data), "pre_hash": pre_hash_bytes(data), "content_hash": content_hash_bytes(data)}
+
+
+@register_analyzer
+class IntensityAnalyzer(Analyzer):
+    """
+    亮度统计（同 intensity.compute_intensity_stats），只处理 NIfTI 文件。
+    """
+
+    name = "intensity"
+    columns = {"brightness_min": "REAL", "brightness_max": "REAL", "brightness_avg": "REAL",
+               "brightness_std": "REAL", "brightness_hist": "BLOB", "brightness_hist_spec": "TEXT",
+               "intensity_status": "TEXT"}
+
+    def pending_sql(self):
+        return f"(brightness_avg IS NULL AND intensity_status IS NULL AND {NIFTI_CONDITION})"
+
+    def analyze(self, ctx):
+        from intensity import HIST_BINS, HIST_RANGE, RunningStats
+
+        # 与 intensity.compute_intensity_stats 一致：无法解码或没有数据的文件记下状态，不在每次运行时重试
+        failed = dict.fromkeys(self.columns)
+        try:
+            volume = ctx.volume
+        except Exception as e:
+            raise AnalysisFailed(str(e), dict(failed, intensity_status="error")) from e
+        if volume is None or volume.size == 0:
+            raise AnalysisFailed("空数据", dict(failed, intensity_status="empty"))
+        stats = RunningStats()
+        stats.update(volume)
+        result = stats.result()
+        return {"brightness_min": result["min"], "brightness_max": result["max"], "brightness_avg": result["mean"],
+                "brightness_std": result["std"], "brightness_hist": result["hist"].tobytes(),
+                "brightness_hist_spec": f"{HIST_RANGE[0]:g}:{HIST_RANGE[1]:g}:{HIST_BINS}", "intensity_status": "ok"}
+
+
+@register_analyzer
+class SimilarityAnalyzer(Analyzer):
+    """
+    与基准切片的 SSIM / NCC（同 similarity.rank_similarity），结果写入 similarity 表；
+    无法解码的文件写入 status = 'error' 的行，不再重试。
+    """
+
+    name = "similarity"
+
+    def __init__(self, references, target_shape=(100, 100), num_slices=10, coarse_factor=4, refine_top=3,
+                 min_coarse_ncc=None):
+        self.references = list(references)
+        self.target_shape = tuple(target_shape)
+        self.num_slices = num_slices
+        self.coarse_factor = coarse_factor
+        self.refine_top = refine_top
+        self.min_coarse_ncc = min_coarse_ncc
+        self.reference_ids = []
+        self.reference_slices = None
+        self.coarse_references = None
+
+    def prepare(self, conn):
+        from similarity import downsample, ensure_similarity_tables, load_reference_slice, register_reference
+
+        ensure_similarity_tables(conn.cursor())
+        self.reference_ids = [register_reference(conn, path, index, self.target_shape, self.num_slices)
+                              for path, index in self.references]
+        self.reference_slices = np.stack([load_reference_slice(path, index, self.target_shape)
+                                          for path, index in self.references]).astype(np.float64)
+        self.coarse_references = downsample(self.reference_slices, self.coarse_factor)
+
+    def pending_sql(self):
+        ids = ",".join(str(int(reference_id)) for reference_id in self.reference_ids)
+        return (f"({NIFTI_CONDITION} AND (SELECT COUNT(*) FROM similarity s "
+                f"WHERE s.record_id = patient_data.id AND s.reference_id IN ({ids})) < {len(self.reference_ids)})")
+
+    def analyze(self, ctx):
+        from similarity import best_matches
+        from volume import resize_bilinear, sample_indices
+
+        failed = {reference_id: (None, None, None, "error") for reference_id in self.reference_ids}
+        try:
+            volume = ctx.volume
+        except Exception as e:
+            raise AnalysisFailed(str(e), failed) from e
+        if volume is None or len(volume) == 0:
+            raise AnalysisFailed("空数据", failed)
+        indices = sample_indices(len(volume), self.num_slices)
+        candidates = resize_bilinear(volume[indices], self.target_shape)
+        scores = best_matches(candidates, [(0, len(indices))], indices, self.reference_slices,
+                              self.coarse_references, self.coarse_factor, self.refine_top, self.min_coarse_ncc)[0]
+        return {reference_id: tuple(score) + ("ok",) for reference_id, score in zip(self.reference_ids, scores)}
+
+    def store(self, conn, results):
+        conn.executemany('''
+            INSERT OR REPLACE INTO similarity (reference_id, record_id, ssim, ncc, best_slice, status)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(reference_id, record_id) + tuple(score)
+              for record_id, scores in results for reference_id, score in scores.items()])
+
+
+def create_analyzers(analyzers):
+    """
+    把名称或分析器实例的列表转换为实例列表。
+    """
+    instances = []
+    for analyzer in analyzers:
+        if isinstance(analyzer, str):
+            if analyzer not in ANALYZERS:
+                raise ValueError(f"未知的分析器: {analyzer}，可用: {', '.join(sorted(ANALYZERS))}")
+            analyzer = ANALYZERS[analyzer]()
+        instances.append(analyzer)
+    return instances
+
+
+def analyze_file(record_id, file_path, analyzers):
+    """
+    对一个文件依次运行 analyzers，文件内容在分析器之间共享。
+    返回 ({分析器下标: 结果}, [错误信息, ...])。
+    """
+    ctx = FileContext(record_id, file_path)
+    try:
+        # 任一分析器需要全文时先整体读入一次，其余分析器（包括文件类型嗅探）都复用这份内容
+        if any(analyzer.reads_data for _, analyzer in analyzers):
+            ctx.data
+        elif not os.path.exists(file_path):
+            raise FileNotFoundError(f"文件不存在: {file_path}")
+    except OSError as e:
+        return {}, [str(e)]
+
+    results = {}
+    errors = []
+    for index, analyzer in analyzers:
+        try:
+            value = analyzer.analyze(ctx)
+        except AnalysisFailed as e:
+            errors.append(f"{analyzer.name}: {e}")
+            value = e.value
+        except Exception as e:
+            errors.append(f"{analyzer.name}: {e}")
+            continue
+        if value is not None:
+            results[index] = value
+    return results, errors
+
+
+def _init_worker(analyzers):
+    global _WORKER_ANALYZERS
+    _WORKER_ANALYZERS = analyzers
+
+
+def _analyze_chunk(records):
+    results = []
+    for row in records:
+        record_id, file_path, flags = row[0], row[1], row[2:]
+        needed = [(i, _WORKER_ANALYZERS[i]) for i, flag in enumerate(flags) if flag]
+        results.append((record_id, file_path) + analyze_file(record_id, file_path, needed))
+    return results
+
+
+def run_pipeline(db_path, analyzers=("file_type", "hash", "intensity"), workers=None, chunk_size=8,
+                 batch_size=500, page_size=5000, mp_context=None):
+    """
+    单遍流水线：每个文件只打开一次，把文件内容交给所有仍需处理该文件的分析器。
+
+    各分析器的结果在同一个事务中分批提交；某个分析器不适用或失败的记录会在下次运行时重试，
+    分析器抛出 AnalysisFailed 记下失败状态的除外。
+    记录是否需要某个分析器在读取时按当前列值判断，因此扩展名不符、本次才识别为 NIfTI 的文件
+    会在下次运行时补做亮度统计和相似度。
+    整个文件被读入工作进程内存，chunk_size 和 workers 决定了同时驻留内存的文件数。
+    mp_context 为工作进程的 multiprocessing 上下文（例如 spawn / forkserver），默认使用平台默认方式。
+    返回错误数（每个文件的每个出错的分析器计一次）。
+    """
+    analyzers = create_analyzers(analyzers)
+    conn = sqlite3.connect(db_path)
+    try:
+        gate_of = device_gate(lambda chunk: chunk[0][1], max_workers=workers)
+        workers = workers or default_workers()
+        with conn:
+            for analyzer in analyzers:
+                analyzer.prepare(conn)
+        conditions = [analyzer.pending_sql() for analyzer in analyzers]
+        flags = ", ".join(conditions)
+        where = " OR ".join(conditions)
+        total = conn.execute(f"SELECT COUNT(*) FROM patient_data WHERE {where}").fetchone()[0]
+        print(f"需要处理的文件数: {total}，分析器: {', '.join(analyzer.name for analyzer in analyzers)}")
+
+        read_conn = sqlite3.connect(db_path)
+        chunks = keyset_chunks(
+            read_conn,
+            f"SELECT id, file_path, {flags} FROM patient_data WHERE ({where}) AND id > ? ORDER BY id LIMIT ?",
+            page_size=page_size, chunk_size=chunk_size,
+        )
+        pending = [[] for _ in analyzers]
+        processed = 0
+        errors = 0
+
+        def flush():
+            if any(pending):
+                with METRICS.transaction(conn, "pipeline"):
+                    for analyzer, results in zip(analyzers, pending):
+                        if results:
+                            analyzer.store(conn, results)
+                for results in pending:
+                    results.clear()
+
+        started = datetime.now()
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_init_worker,
+                                     initargs=(analyzers,)) as executor, \
+                    tqdm(total=total, desc="单遍分析", unit="文件") as pbar:
+                for _, results in imap_instrumented(executor, _analyze_chunk, chunks, workers * 2,
+                                                     stage="pipeline", gate_of=gate_of):
+                    for record_id, file_path, values, file_errors in results:
+                        for index, value in values.items():
+                            pending[index].append((record_id, value))
+                        for error in file_errors:
+                            errors += 1
+                            tqdm.write(f"处理文件 {file_path} 时出错: {error}")
+                    processed += len(results)
+                    pbar.update(len(results))
+                    METRICS.inc("files_total", len(results), stage="pipeline")
+                    if sum(len(results) for results in pending) >= batch_size:
+                        flush()
+                flush()
+        finally:
+            read_conn.close()
+        elapsed = (datetime.now() - started).total_seconds()
+        print(f"单遍分析完成，处理 {processed} 个文件，用时 {elapsed:.1f} 秒，{errors} 个错误。")
+        METRICS.inc("errors_total", errors, stage="pipeline")
+        return errors
+    finally:
+        conn.close()
@@ -0,0 +1,207 @@
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from tqdm import tqdm
+
+from io_sched import default_workers, device_gate
+from metrics import METRICS, imap_instrumented
+from record_filter import nifti_condition
+from volume import resize_bilinear
+from volume_cache import cache_counts, cache_summary, open_volume_source, shared_cache
+
+
+def ensure_preview_table(cursor):
+    # 缩略图缓存：每条记录一张 uint8 中间切片，fingerprint 为 "大小:mtime_ns"，spec 为生成参数
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS preview (
+            record_id INTEGER PRIMARY KEY,
+            fingerprint TEXT,
+            spec TEXT,
+            height INTEGER,
+            width INTEGER,
+            image BLOB,
+            created_at TEXT
+        )
+    ''')
+
+
+def file_fingerprint(path):
+    st = os.stat(path)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def preview_spec(max_size, window):
+    if window is None:
+        return f"{max_size}:auto"
+    return f"{max_size}:{window[0]:g}/{window[1]:g}"
+
+
+def apply_window(image, window=None):
+    """
+    窗宽窗位映射到 0-255。window 为 (窗位, 窗宽)；为 None 时用 1% / 99% 分位数自动取窗。
+    """
+    image = np.asarray(image, dtype=np.float32)
+    if window is None:
+        lo, hi = np.percentile(image, (1, 99))
+    else:
+        center, width = window
+        lo, hi = center - width / 2.0, center + width / 2.0
+    if hi <= lo:
+        return np.zeros(image.shape, dtype=np.uint8)
+    scaled = (image - lo) * (255.0 / (hi - lo))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def make_thumbnail(path, max_size=128, window=None, cache=None):
+    """
+    读取体数据的中间切片（没有缓存时只读这一张），按长边缩放到 max_size 并做窗宽窗位，返回 uint8 数组。
+    """
+    source = open_volume_source(path, cache)
+    image = source.read([source.num_slices // 2])[0]
+    scale = min(1.0, max_size / max(image.shape))
+    shape = (max(1, round(image.shape[0] * scale)), max(1, round(image.shape[1] * scale)))
+    if shape != image.shape:
+        image = resize_bilinear(image, shape)
+    return apply_window(image, window)
+
+
+def _preview_chunk(task):
+    records, max_size, window, cache_dir, cache_bytes = task
+    cache = shared_cache(cache_dir, cache_bytes)
+    results = []
+    for record_id, file_path, known_fingerprint in records:
+        try:
+            fingerprint = file_fingerprint(file_path)
+            if fingerprint == known_fingerprint:
+                results.append((record_id, file_path, fingerprint, None, None))
+                continue
+            results.append((record_id, file_path, fingerprint, make_thumbnail(file_path, max_size, window, cache),
+                            None))
+        except Exception as e:
+            results.append((record_id, file_path, None, None, str(e)))
+    return results
+
+
+def _store_previews(conn, rows, spec):
+    timestamp = datetime.now().isoformat()
+    with METRICS.transaction(conn, "preview"):
+        conn.executemany('''
+            INSERT OR REPLACE INTO preview (record_id, fingerprint, spec, height, width, image, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(record_id, fingerprint, spec, image.shape[0], image.shape[1], image.tobytes(), timestamp)
+              for record_id, fingerprint, image in rows])
+
+
+def _known_fingerprints(conn, spec):
+    return dict(conn.execute('SELECT record_id, fingerprint FROM preview WHERE spec = ?', (spec,)).fetchall())
+
+
+def build_previews(db_path, max_size=128, window=None, workers=None, chunk_size=32, batch_size=500, cache_dir=None,
+                   cache_bytes=None):
+    """
+    在进程池中为所有 NIfTI 记录生成缩略图并写入 preview 表。
+
+    每个文件先比较 stat 指纹，未变化的不再解码；文件被修改或生成参数（max_size / window）改变时重新生成。
+    cache_dir 不为 None 时通过 volume_cache 读取体数据，缓存总大小不超过 cache_bytes。
+    返回处理失败的文件数。
+    """
+    spec = preview_spec(max_size, window)
+    conn = sqlite3.connect(db_path)
+    try:
+        gate_of = device_gate(lambda task: task[0][0][1], max_workers=workers)
+        workers = workers or default_workers()
+        columns = [col[1] for col in conn.execute("PRAGMA table_info(patient_data);")]
+        condition = nifti_condition(detected="actual_file_type" in columns)
+        known = _known_fingerprints(conn, spec)
+        records = [(record_id, file_path, known.get(record_id)) for record_id, file_path in
+                   conn.execute(f"SELECT id, file_path FROM patient_data WHERE {condition} ORDER BY file_path").fetchall()]
+        print(f"需要检查缩略图的文件数: {len(records)}（已缓存 {len(known)} 张）")
+        cache_before = cache_counts()
+
+        pending = []
+        generated = 0
+        errors = 0
+        chunks = (records[i:i + chunk_size] for i in range(0, len(records), chunk_size))
+        tasks = ((chunk, max_size, window, cache_dir, cache_bytes) for chunk in chunks)
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+                tqdm(total=len(records), desc="生成缩略图", unit="文件") as pbar:
+            for _, results in imap_instrumented(executor, _preview_chunk, tasks, workers * 2, stage="preview",
+                                                 gate_of=gate_of):
+                for record_id, file_path, fingerprint, image, error in results:
+                    if error is not None:
+                        errors += 1
+                        tqdm.write(f"处理文件 {file_path} 时出错: {error}")
+                    elif image is not None:
+                        pending.append((record_id, fingerprint, image))
+                        generated += 1
+                pbar.update(len(results))
+                METRICS.inc("files_total", len(results), stage="preview")
+                if len(pending) >= batch_size:
+                    _store_previews(conn, pending, spec)
+                    pending.clear()
+            _store_previews(conn, pending, spec)
+        print(f"缩略图已更新，新生成 {generated} 张，{errors} 个文件处理失败。")
+        summary = cache_summary(cache_before)
+        if summary:
+            print(summary)
+        METRICS.inc("errors_total", errors, stage="preview")
+        return errors
+    finally:
+        conn.close()
+
+
+def load_previews(conn, records, max_size=128, window=None):
+    """
+    返回 {record_id: uint8 缩略图}，records 为 [(record_id, file_path), ...]。
+    缓存中缺失或文件已变化的缩略图会在当前进程中重新生成并写回；无法读取的文件不出现在结果中。
+    """
+    spec = preview_spec(max_size, window)
+    ids = [record_id for record_id, _ in records]
+    cached = {}
+    for i in range(0, len(ids), 500):
+        part = ids[i:i + 500]
+        cached.update((row[0], row[1:]) for row in conn.execute(f'''
+            SELECT record_id, fingerprint, height, width, image FROM preview
+            WHERE spec = ? AND record_id IN ({",".join("?" * len(part))})
+        ''', [spec] + part))
+
+    previews = {}
+    regenerated = []
+    for record_id, file_path in records:
+        try:
+            fingerprint = file_fingerprint(file_path)
+            row = cached.get(record_id)
+            if row is not None and row[0] == fingerprint:
+                previews[record_id] = np.frombuffer(row[3], dtype=np.uint8).reshape(row[1], row[2])
+                continue
+            previews[record_id] = make_thumbnail(file_path, max_size, window)
+            regenerated.append((record_id, fingerprint, previews[record_id]))
+        except Exception as e:
+            print(f"生成缩略图时出错 {file_path}: {e}")
+    if regenerated:
+        _store_previews(conn, regenerated, spec)
+    return previews
+
+
+def show_gallery(images, titles=None, columns=10, size=2.0):
+    """
+    以网格形式显示缩略图。
+    """
+    import matplotlib.pyplot as plt
+
+    if not images:
+        print("没有可显示的缩略图。")
+        return
+    rows = (len(images) + columns - 1) // columns
+    fig, axes = plt.subplots(rows, columns, figsize=(columns * size, rows * size), squeeze=False)
+    for i, ax in enumerate(axes.flat):
+        ax.axis("off")
+        if i < len(images):
+            ax.imshow(images[i], cmap="gray", vmin=0, vmax=255)
+            if titles is not None:
+                ax.set_title(titles[i], fontsize=8)
+    plt.tight_layout()
+    plt.show()
@@ -0,0 +1,222 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from metrics import METRICS
+
+# 可在查询结果中返回的列；similarity 相关的列只有指定 reference_id 时可用
+RECORD_COLUMNS = (
+    "id", "patient_id", "file_path", "file_type", "created_at", "updated_at", "source_id",
+    "actual_file_type", "meta_status", "file_size", "pre_hash", "content_hash",
+    "brightness_min", "brightness_max", "brightness_avg", "brightness_std",
+)
+SIMILARITY_COLUMNS = ("ssim", "ncc", "best_slice")
+
+
+class ReadPool:
+    """
+    只读连接池。连接以 mode=ro 打开并设置 query_only，WAL 模式下读取不会阻塞扫描 / 同步等写入，
+    多个加载器（或同一进程中的多个线程）共享少量连接，不必各自打开、关闭。
+    """
+
+    def __init__(self, db_path, size=4, timeout=30.0):
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        uri = f"file:{quote(os.path.abspath(self.db_path))}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, timeout=self.timeout, check_same_thread=False)
+        conn.execute("PRAGMA query_only = 1")
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._open()
+                except Exception:
+                    self._created -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"{self.timeout} 秒内没有空闲的只读连接（连接池大小 {self.size}）") from None
+
+    def release(self, conn):
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        # 只关闭空闲连接；仍被生成器占用的连接归还后会被下一次 close() 关闭
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+def _as_list(value):
+    return list(value) if isinstance(value, (list, tuple, set, frozenset)) else [value]
+
+
+def _build_filters(patient_id=None, file_type=None, actual_file_type=None, source_id=None, reference_id=None,
+                   min_ssim=None, max_ssim=None):
+    """
+    把筛选条件转换为 (join, where 子句列表, 参数列表)。patient_id 等可以是单个值或列表。
+    """
+    join = ""
+    where, params = [], []
+    for column, value in (("patient_id", patient_id), ("file_type", file_type),
+                          ("actual_file_type", actual_file_type), ("source_id", source_id)):
+        if value is None:
+            continue
+        values = _as_list(value)
+        where.append(f"p.{column} IN ({', '.join('?' * len(values))})")
+        params.extend(values)
+    if reference_id is not None:
+        join = "JOIN similarity s ON s.record_id = p.id AND s.reference_id = ?"
+        params.insert(0, reference_id)
+        where.append("s.ssim IS NOT NULL")
+        if min_ssim is not None:
+            where.append("s.ssim >= ?")
+            params.append(min_ssim)
+        if max_ssim is not None:
+            where.append("s.ssim <= ?")
+            params.append(max_ssim)
+    elif min_ssim is not None or max_ssim is not None:
+        raise ValueError("按相似度筛选时需要指定 reference_id")
+    return join, where, params
+
+
+def _select_columns(columns, reference_id):
+    selected = []
+    for column in columns:
+        if column in SIMILARITY_COLUMNS and reference_id is not None:
+            selected.append(f"s.{column}")
+        elif column in RECORD_COLUMNS:
+            selected.append(f"p.{column}")
+        else:
+            raise ValueError(f"不支持的列: {column}")
+    return selected
+
+
+def iter_record_batches(pool, columns=("id", "patient_id", "file_path"), patient_id=None, file_type=None,
+                      actual_file_type=None, source_id=None, reference_id=None, min_ssim=None, max_ssim=None,
+                      valid_only=False, order="id", page_size=1000, batch_size=256, exists_workers=16):
+    """
+    分批产生满足筛选条件的记录列表，每条记录是 columns 对应的元组。
+
+    按 id（order="ssim" 时按 (ssim 降序, id)）做 keyset 分页，每页一条 LIMIT 查询，
+    再用 fetchmany 每次取出 batch_size 条，内存占用只与 page_size 有关，调用方拿到第一批结果即可开始处理。
+    valid_only=True 时跳过磁盘上已不存在的文件：已校验过的记录（见 verify.verify_files）直接按 is_present
+    在 SQL 中筛选，只有尚未校验的记录才检查文件；stat 在网络共享 / 机械硬盘上的延迟远大于 CPU 开销，
+    每批的检查由 exists_workers 个线程并行执行。
+    """
+    if order not in ("id", "ssim"):
+        raise ValueError(f"不支持的排序方式: {order}")
+    if order == "ssim" and reference_id is None:
+        raise ValueError("按相似度排序时需要指定 reference_id")
+    join, where, params = _build_filters(patient_id, file_type, actual_file_type, source_id, reference_id,
+                                         min_ssim, max_ssim)
+    # 分页键（id，以及按相似度排序时的 ssim）固定放在结果的最前面，产出前去掉
+    keys = ["p.id"] if order == "id" else ["s.ssim", "p.id"]
+    selected = keys + _select_columns(columns, reference_id)
+    if valid_only:
+        with pool.connection() as conn:
+            verified = "is_present" in {col[1] for col in conn.execute("PRAGMA table_info(patient_data);")}
+        if verified:
+            where.append("p.is_present IS NOT 0")
+            selected.append("p.is_present")
+        else:
+            selected.append("NULL")
+        selected.append("p.file_path")
+    if order == "id":
+        keyset = "p.id > ?"
+        order_by = "p.id"
+    else:
+        keyset = "(s.ssim < ? OR (s.ssim = ? AND p.id > ?))"
+        order_by = "s.ssim DESC, p.id"
+    base_where = " AND ".join(where + [keyset])
+    query = (f"SELECT {', '.join(selected)} FROM patient_data p {join} "
+             f"WHERE {base_where} ORDER BY {order_by} LIMIT ?")
+    n_keys = len(keys)
+
+    executor = ThreadPoolExecutor(max_workers=exists_workers) if valid_only and exists_workers > 1 else None
+    try:
+        yield from _paginate(pool, query, params, order, n_keys, page_size, batch_size, valid_only, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def _paginate(pool, query, params, order, n_keys, page_size, batch_size, valid_only, executor):
+    exists_map = executor.map if executor is not None else map
+    last = None
+    with pool.connection() as conn:
+        while True:
+            if order == "id":
+                key_params = [last[0] if last else -1]
+            else:
+                key_params = [last[0], last[0], last[1]] if last else [float("inf"), float("inf"), -1]
+            start = time.perf_counter()
+            cursor = conn.execute(query, params + key_params + [page_size])
+            page_rows = 0
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    METRICS.observe("db_query_seconds", time.perf_counter() - start)
+                    page_rows += len(rows)
+                    last = rows[-1][:n_keys]
+                    if valid_only:
+                        # 最后两列为 is_present 和 file_path，is_present 为 NULL 的记录尚未校验
+                        unverified = [row[-1] for row in rows if row[-2] is None]
+                        absent = {path for path, ok in zip(unverified, exists_map(os.path.exists, unverified))
+                                  if not ok}
+                        records = [row[n_keys:-2] for row in rows if row[-1] not in absent]
+                        METRICS.inc("query_missing_files_total", len(absent))
+                    else:
+                        records = [row[n_keys:] for row in rows]
+                    METRICS.inc("query_rows_total", len(records))
+                    if records:
+                        yield records
+                    start = time.perf_counter()
+            finally:
+                # 调用方提前停止迭代时也要结束语句，连接归还连接池时不再持有读事务
+                cursor.close()
+            if page_rows < page_size:
+                return
+
+
+def iter_records(pool, columns=("id", "patient_id", "file_path"), **filters):
+    """
+    逐条产生满足筛选条件的记录，参数见 iter_record_batches。
+    """
+    for records in iter_record_batches(pool, columns, **filters):
+        yield from records
+
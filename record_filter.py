@@ -0,0 +1,36 @@
+def _column(alias, name):
+    return f"{alias}.{name}" if alias else name
+
+
+# 扫描时 file_type 记录的是小写扩展名；DICOM 切片经常没有扩展名
+DICOM_EXTENSIONS = (".dcm", ".dicom", ".ima", "")
+
+
+def dicom_condition(alias=None, detected=True):
+    """
+    DICOM 记录的 WHERE 条件，alias 为 patient_data 在查询中的别名。
+
+    detected=True 时以文件类型检测的结果（actual_file_type）为准，尚未检测的记录（NULL）按扩展名判断；
+    actual_file_type 列存在并不代表检测已经运行过（汇总表初始化时就会创建该列），因此不能只看检测结果。
+    patient_data 中还没有 actual_file_type 列时传入 detected=False。
+    """
+    extensions = ", ".join(f"'{extension}'" for extension in DICOM_EXTENSIONS)
+    by_extension = f"{_column(alias, 'file_type')} IN ({extensions})"
+    if not detected:
+        return by_extension
+    actual = _column(alias, "actual_file_type")
+    return f"({actual} = 'DICOM' OR ({actual} IS NULL AND {by_extension}))"
+
+
+def nifti_condition(alias=None, detected=True):
+    """
+    NIfTI 记录的 WHERE 条件，参数同 dicom_condition。
+
+    x.nii.gz 的 file_type 是 '.gz'，只凭扩展名会把所有 gzip 文件都当作 NIfTI，因此 '.gz' 还要求路径以 .nii.gz 结尾。
+    """
+    file_type = _column(alias, "file_type")
+    by_extension = f"({file_type} = '.nii' OR ({file_type} = '.gz' AND {_column(alias, 'file_path')} LIKE '%.nii.gz'))"
+    if not detected:
+        return by_extension
+    actual = _column(alias, "actual_file_type")
+    return f"({actual} LIKE 'NIfTI%' OR ({actual} IS NULL AND {by_extension}))"
@@ -0,0 +1,194 @@
+import os
+import sqlite3
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from tqdm import tqdm
+
+from io_sched import default_workers, device_gate
+from metrics import METRICS, imap_instrumented
+from record_filter import nifti_condition
+from volume import resize_bilinear, sample_indices
+from volume_cache import cache_counts, cache_summary, open_volume_source, shared_cache
+
+
+def ensure_sample_index_table(cursor):
+    # 样本索引：每条记录对应分片文件中的一行，config 形如 "5x50x50"（切片数 x 高 x 宽）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sample_index (
+            config TEXT,
+            record_id INTEGER,
+            shard TEXT,
+            row INTEGER,
+            created_at TEXT,
+            PRIMARY KEY (config, record_id)
+        )
+    ''')
+
+
+def sample_config(num_slices, target_shape):
+    return f"{num_slices}x{target_shape[0]}x{target_shape[1]}"
+
+
+def extract_samples(file_path, num_slices=5, target_shape=(50, 50), cache=None):
+    """
+    从体数据中均匀选取 num_slices 张切片并缩放到 target_shape，返回 (num_slices, H, W) 的 float32 数组。
+    没有缓存时只读取被选中的切片，不解码整个体数据。
+    """
+    source = open_volume_source(file_path, cache)
+    slices = source.read(sample_indices(source.num_slices, num_slices))
+    return resize_bilinear(slices, target_shape)
+
+
+def _sample_chunk(task):
+    records, num_slices, target_shape, cache_dir, cache_bytes = task
+    cache = shared_cache(cache_dir, cache_bytes)
+    results = []
+    for record_id, file_path in records:
+        try:
+            results.append((record_id, extract_samples(file_path, num_slices, target_shape, cache), None))
+        except Exception as e:
+            results.append((record_id, None, f"{file_path}: {e}"))
+    return results
+
+
+def build_sample_store(db_path, store_dir, num_slices=5, target_shape=(50, 50), workers=None,
+                       chunk_size=8, checkpoint_every=500, cache_dir=None, cache_bytes=None):
+    """
+    为数据库中尚未处理的 NIfTI 记录一次性生成训练样本，写入一个连续的内存映射分片文件
+    （.npy，形状 (N, num_slices, H, W)），并在 sample_index 表中记录每条记录所在的行。
+
+    每 checkpoint_every 条样本刷新一次分片并提交索引，中断后重新运行只处理没有索引的记录。
+    cache_dir 不为 None 时通过 volume_cache 读取体数据，缓存总大小不超过 cache_bytes。
+    返回处理失败的记录数。
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    config = sample_config(num_slices, target_shape)
+    conn = sqlite3.connect(db_path)
+    try:
+        gate_of = device_gate(lambda task: task[0][0][1], max_workers=workers)
+        workers = workers or default_workers()
+        columns = [col[1] for col in conn.execute("PRAGMA table_info(patient_data);")]
+        condition = nifti_condition("p", detected="actual_file_type" in columns)
+        records = conn.execute(f'''
+            SELECT p.id, p.file_path FROM patient_data p
+            WHERE {condition} AND NOT EXISTS (
+                SELECT 1 FROM sample_index s WHERE s.config = ? AND s.record_id = p.id
+            )
+            ORDER BY p.file_path
+        ''', (config,)).fetchall()
+        print(f"需要生成样本的记录数: {len(records)}（配置 {config}）")
+        cache_before = cache_counts()
+        if not records:
+            return 0
+
+        shard_name = f"samples_{config}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}.npy"
+        shard = np.lib.format.open_memmap(
+            os.path.join(store_dir, shard_name), mode="w+", dtype=np.float32,
+            shape=(len(records), num_slices) + tuple(target_shape),
+        )
+        next_row = 0
+        pending = []
+        errors = 0
+
+        def checkpoint():
+            if pending:
+                # 先把分片数据落盘，再提交指向这些行的索引
+                shard.flush()
+                with METRICS.transaction(conn, "samples"):
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO sample_index (config, record_id, shard, row, created_at) "
+                        "VALUES (?, ?, ?, ?, ?)", pending)
+                pending.clear()
+
+        chunks = (records[i:i + chunk_size] for i in range(0, len(records), chunk_size))
+        tasks = ((chunk, num_slices, tuple(target_shape), cache_dir, cache_bytes) for chunk in chunks)
+        timestamp = datetime.now().isoformat()
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+                tqdm(total=len(records), desc="生成训练样本", unit="文件") as pbar:
+            for _, results in imap_instrumented(executor, _sample_chunk, tasks, workers * 2, stage="samples",
+                                                 gate_of=gate_of):
+                for record_id, samples, error in results:
+                    if samples is None:
+                        errors += 1
+                        tqdm.write(f"生成样本时出错 {error}")
+                        continue
+                    shard[next_row] = samples
+                    pending.append((config, record_id, shard_name, next_row, timestamp))
+                    next_row += 1
+                pbar.update(len(results))
+                METRICS.inc("files_total", len(results), stage="samples")
+                if len(pending) >= checkpoint_every:
+                    checkpoint()
+            checkpoint()
+        del shard
+        if next_row == 0:
+            os.remove(os.path.join(store_dir, shard_name))
+        print(f"样本已写入 {shard_name}，共 {next_row} 条，{errors} 条失败。")
+        summary = cache_summary(cache_before)
+        if summary:
+            print(summary)
+        METRICS.inc("errors_total", errors, stage="samples")
+        return errors
+    finally:
+        conn.close()
+
+
+class SampleStoreDataset:
+    """
+    从预生成的样本分片读取训练数据的 Dataset（可直接交给 torch DataLoader）。
+
+    分片以写时复制的内存映射方式打开，__getitem__ 返回的张量是分片数据的零拷贝视图；
+    多个 DataLoader worker 之间共享同一份页缓存。
+    """
+
+    def __init__(self, db_path, store_dir, num_slices=5, target_shape=(50, 50), record_ids=None,
+                 normalize=False, flatten=False):
+        self.store_dir = store_dir
+        self.normalize = normalize
+        self.flatten = flatten
+        config = sample_config(num_slices, target_shape)
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute(
+                "SELECT record_id, shard, row FROM sample_index WHERE config = ? ORDER BY record_id", (config,)
+            ).fetchall()
+        finally:
+            conn.close()
+        if record_ids is not None:
+            wanted = set(record_ids)
+            rows = [row for row in rows if row[0] in wanted]
+        self.record_ids = [row[0] for row in rows]
+        self._locations = [(row[1], row[2]) for row in rows]
+        self._shards = {}
+
+    def __len__(self):
+        return len(self._locations)
+
+    def _shard(self, name):
+        # 每个进程第一次访问时才打开，DataLoader 的 worker 进程各自持有自己的映射
+        shard = self._shards.get(name)
+        if shard is None:
+            shard = np.load(os.path.join(self.store_dir, name), mmap_mode="c")
+            self._shards[name] = shard
+        return shard
+
+    def __getitem__(self, idx):
+        import torch
+
+        name, row = self._locations[idx]
+        sample = self._shard(name)[row]
+        if self.normalize:
+            # 与 notebook 中的 VAE 数据集一致的逐样本 min-max 归一化（需要拷贝）
+            lo, hi = sample.min(), sample.max()
+            sample = (sample - lo) / (hi - lo) if hi > lo else np.zeros_like(sample)
+        if self.flatten:
+            sample = sample.reshape(-1)
+        return torch.from_numpy(sample)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
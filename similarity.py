@@ -0,0 +1,301 @@
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from tqdm import tqdm
+
+from io_sched import default_workers, device_gate
+from metrics import METRICS, imap_instrumented
+from record_filter import nifti_condition
+from volume import read_slices, resize_bilinear, sample_indices
+from volume_cache import cache_counts, cache_summary, open_volume_source, shared_cache
+
+# 与 skimage.metrics.structural_similarity 默认参数一致
+SSIM_WIN = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+
+# 工作进程中的基准切片：(R, H, W) 原分辨率和 (R, h, w) 降采样版本
+_REFERENCES = None
+_COARSE_REFERENCES = None
+
+
+def _window_mean(x, win):
+    """
+    用积分图计算 (..., H, W) 上所有完整 win x win 窗口的均值，结果为 (..., H-win+1, W-win+1)。
+    """
+    c = np.cumsum(np.cumsum(x, axis=-2), axis=-1)
+    c = np.pad(c, [(0, 0)] * (x.ndim - 2) + [(1, 0), (1, 0)])
+    s = c[..., win:, win:] - c[..., :-win, win:] - c[..., win:, :-win] + c[..., :-win, :-win]
+    return s / (win * win)
+
+
+def ssim_batch(candidates, reference, data_range=None, win=SSIM_WIN):
+    """
+    批量计算每张候选切片与基准切片的 SSIM，candidates 为 (B, H, W)，reference 为 (H, W)。
+
+    结果与 skimage 的 structural_similarity（均匀窗口、样本协方差）相同：skimage 先滤波再裁掉
+    (win-1)//2 宽的边界，等价于只在完整窗口上取平均。data_range 默认为每张候选切片的 max - min，
+    与 notebook 中的调用方式一致。
+    候选切片为常数时 data_range 为 0，与同样为常数的窗口比较会得到 0/0；两个窗口此时完全相同，记为 1。
+    """
+    x = np.asarray(candidates, dtype=np.float64)
+    y = np.broadcast_to(np.asarray(reference, dtype=np.float64), x.shape)
+    if data_range is None:
+        data_range = x.max(axis=(-2, -1)) - x.min(axis=(-2, -1))
+    data_range = np.asarray(data_range, dtype=np.float64).reshape(-1, 1, 1)
+
+    cov_norm = win * win / (win * win - 1.0)
+    ux = _window_mean(x, win)
+    uy = _window_mean(y, win)
+    vx = cov_norm * (_window_mean(x * x, win) - ux * ux)
+    vy = cov_norm * (_window_mean(y * y, win) - uy * uy)
+    vxy = cov_norm * (_window_mean(x * y, win) - ux * uy)
+
+    c1 = (SSIM_K1 * data_range) ** 2
+    c2 = (SSIM_K2 * data_range) ** 2
+    numerator = (2 * ux * uy + c1) * (2 * vxy + c2)
+    denominator = (ux * ux + uy * uy + c1) * (vx + vy + c2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        s = np.where(denominator > 0, numerator / denominator, 1.0)
+    return s.mean(axis=(-2, -1))
+
+
+def ncc_batch(candidates, references):
+    """
+    零均值归一化互相关。candidates 为 (B, H, W)，references 为 (R, H, W)，返回 (R, B)。
+    """
+    x = np.asarray(candidates, dtype=np.float64).reshape(len(candidates), -1)
+    y = np.asarray(references, dtype=np.float64).reshape(len(references), -1)
+    x = x - x.mean(axis=1, keepdims=True)
+    y = y - y.mean(axis=1, keepdims=True)
+    x_norm = np.linalg.norm(x, axis=1)
+    y_norm = np.linalg.norm(y, axis=1)
+    denom = np.outer(y_norm, x_norm)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(denom > 0, (y @ x.T) / denom, 0.0)
+
+
+def downsample(images, factor):
+    """
+    按 factor x factor 的块求均值进行降采样（多余的边缘像素被丢弃）。
+    """
+    images = np.asarray(images, dtype=np.float64)
+    h = images.shape[-2] // factor * factor
+    w = images.shape[-1] // factor * factor
+    images = images[..., :h, :w]
+    return images.reshape(images.shape[:-2] + (h // factor, factor, w // factor, factor)).mean(axis=(-3, -1))
+
+
+def load_reference_slice(reference_path, slice_index, target_shape=(100, 100)):
+    return resize_bilinear(read_slices(reference_path, [slice_index])[0], target_shape)
+
+
+def _init_worker(references, coarse_factor):
+    global _REFERENCES, _COARSE_REFERENCES
+    _REFERENCES = references
+    _COARSE_REFERENCES = downsample(references, coarse_factor)
+
+
+def score_records(records, references, coarse_references, target_shape, num_slices, coarse_factor,
+                  refine_top, min_coarse_ncc, cache=None):
+    """
+    对一批记录计算与每张基准切片的相似度。
+
+    所有记录的候选切片被堆成一个数组：先在降采样分辨率上批量计算 NCC，每条记录只保留
+    粗筛得分最高的 refine_top 张切片做全分辨率 SSIM；粗筛最高分低于 min_coarse_ncc 的记录跳过
+    精算（ssim 记为 None）。
+    返回 ([(record_id, file_path, [(ssim, ncc, best_slice), ...每个基准]), ...], [(record_id, file_path, 错误), ...])
+    """
+    batches = []
+    spans = []
+    slice_numbers = []
+    valid = []
+    failed = []
+    offset = 0
+    for record_id, file_path in records:
+        try:
+            source = open_volume_source(file_path, cache)
+            indices = sample_indices(source.num_slices, num_slices)
+            batches.append(resize_bilinear(source.read(indices), target_shape))
+        except Exception as e:
+            failed.append((record_id, file_path, str(e)))
+            continue
+        valid.append((record_id, file_path))
+        spans.append((offset, offset + len(indices)))
+        slice_numbers.extend(int(i) for i in indices)
+        offset += len(indices)
+    if not valid:
+        return [], failed
+
+    candidates = np.concatenate(batches)
+    results = best_matches(candidates, spans, slice_numbers, references, coarse_references, coarse_factor,
+                           refine_top, min_coarse_ncc)
+    return [(record_id, file_path, scores) for (record_id, file_path), scores in zip(valid, results)], failed
+
+
+def best_matches(candidates, spans, slice_numbers, references, coarse_references, coarse_factor, refine_top,
+                 min_coarse_ncc=None):
+    """
+    candidates 为若干记录的候选切片堆成的 (B, H, W) 数组，spans[i] = (lo, hi) 是第 i 条记录所占的行，
+    slice_numbers 为每一行在原体数据中的切片下标。返回每条记录对每个基准的 [(ssim, ncc, best_slice), ...]。
+    """
+    coarse = ncc_batch(downsample(candidates, coarse_factor), coarse_references)  # (R, B)
+    fine_ncc = ncc_batch(candidates, references)
+    results = [[] for _ in spans]
+    for r, reference in enumerate(references):
+        selected = []
+        owners = []
+        for owner, (lo, hi) in enumerate(spans):
+            scores = coarse[r, lo:hi]
+            if min_coarse_ncc is not None and scores.max() < min_coarse_ncc:
+                continue
+            top = lo + np.argsort(scores)[::-1][:refine_top]
+            selected.extend(top)
+            owners.extend([owner] * len(top))
+        ssim_values = ssim_batch(candidates[selected], reference) if selected else []
+
+        best = {}
+        for row, owner, value in zip(selected, owners, ssim_values):
+            if owner not in best or value > best[owner][0]:
+                best[owner] = (float(value), row)
+        for owner, (lo, hi) in enumerate(spans):
+            if owner in best:
+                value, row = best[owner]
+            else:
+                value, row = None, lo + int(np.argmax(coarse[r, lo:hi]))
+            results[owner].append((value, float(fine_ncc[r, row]), int(slice_numbers[row])))
+    return results
+
+
+def _score_chunk(task):
+    records, target_shape, num_slices, coarse_factor, refine_top, min_coarse_ncc, cache_dir, cache_bytes = task
+    return score_records(records, _REFERENCES, _COARSE_REFERENCES, target_shape, num_slices, coarse_factor,
+                         refine_top, min_coarse_ncc, cache=shared_cache(cache_dir, cache_bytes))
+
+
+def ensure_similarity_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS similarity_reference (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT,
+            slice_index INTEGER,
+            target_shape TEXT,
+            num_slices INTEGER,
+            created_at TEXT,
+            UNIQUE (path, slice_index, target_shape, num_slices)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS similarity (
+            reference_id INTEGER,
+            record_id INTEGER,
+            ssim REAL,
+            ncc REAL,
+            best_slice INTEGER,
+            status TEXT,
+            PRIMARY KEY (reference_id, record_id)
+        )
+    ''')
+    # status 为 ok / error：无法读取的记录也写一行（分数为 NULL），不在每次运行时重试
+    if "status" not in [col[1] for col in cursor.execute("PRAGMA table_info(similarity);")]:
+        cursor.execute("ALTER TABLE similarity ADD COLUMN status TEXT;")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_similarity_rank ON similarity(reference_id, ssim DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_similarity_record ON similarity(record_id)')
+
+
+def register_reference(conn, path, slice_index, target_shape, num_slices):
+    shape = f"{target_shape[0]}x{target_shape[1]}"
+    conn.execute('''
+        INSERT OR IGNORE INTO similarity_reference (path, slice_index, target_shape, num_slices, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (path, slice_index, shape, num_slices, datetime.now().isoformat()))
+    return conn.execute('''
+        SELECT id FROM similarity_reference
+        WHERE path = ? AND slice_index = ? AND target_shape = ? AND num_slices = ?
+    ''', (path, slice_index, shape, num_slices)).fetchone()[0]
+
+
+def rank_similarity(db_path, references, target_shape=(100, 100), num_slices=10, workers=None,
+                    coarse_factor=4, refine_top=3, min_coarse_ncc=None, chunk_size=16, batch_size=1000,
+                    cache_dir=None, cache_bytes=None):
+    """
+    将每条 NIfTI 记录均匀抽取的 num_slices 张切片与一张或多张基准切片比较，结果按基准分别写入
+    similarity 表（ssim / ncc / best_slice）。
+
+    :param references: [(reference_path, slice_index), ...]
+    :param coarse_factor: 粗筛时的降采样倍数
+    :param refine_top: 每条记录参与全分辨率 SSIM 的切片数（等于 num_slices 时为精确的最大 SSIM）
+    :param min_coarse_ncc: 粗筛 NCC 低于该值的记录不做 SSIM 精算
+    :param cache_dir: 已解码体数据的缓存目录（见 volume_cache），总大小不超过 cache_bytes
+    返回各基准在 similarity_reference 表中的 id。已有结果的 (基准, 记录) 不会重复计算；
+    读取失败的记录写入 status = 'error'、分数为 NULL 的行，同样不再重试（文件变化后 live_sync / verify 会删除这些行）。
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        gate_of = device_gate(lambda task: task[0][0][1], max_workers=workers)
+        workers = workers or default_workers()
+        reference_ids = []
+        reference_slices = []
+        with conn:
+            for path, slice_index in references:
+                reference_ids.append(register_reference(conn, path, slice_index, target_shape, num_slices))
+                reference_slices.append(load_reference_slice(path, slice_index, target_shape))
+        reference_slices = np.stack(reference_slices).astype(np.float64)
+
+        columns = [col[1] for col in conn.execute("PRAGMA table_info(patient_data);")]
+        condition = nifti_condition("p", detected="actual_file_type" in columns)
+        placeholders = ",".join("?" * len(reference_ids))
+        records = conn.execute(f'''
+            SELECT p.id, p.file_path FROM patient_data p
+            WHERE {condition} AND (
+                SELECT COUNT(*) FROM similarity s WHERE s.record_id = p.id AND s.reference_id IN ({placeholders})
+            ) < ?
+            ORDER BY p.file_path
+        ''', reference_ids + [len(reference_ids)]).fetchall()
+        print(f"需要计算相似度的记录数: {len(records)}，基准切片数: {len(reference_ids)}")
+        cache_before = cache_counts()
+
+        pending = []
+        errors = 0
+
+        def flush():
+            if pending:
+                with METRICS.transaction(conn, "similarity"):
+                    conn.executemany('''
+                        INSERT OR REPLACE INTO similarity (reference_id, record_id, ssim, ncc, best_slice, status)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', pending)
+                pending.clear()
+
+        chunks = (records[i:i + chunk_size] for i in range(0, len(records), chunk_size))
+        tasks = ((chunk, tuple(target_shape), num_slices, coarse_factor, refine_top, min_coarse_ncc, cache_dir,
+                  cache_bytes) for chunk in chunks)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(reference_slices, coarse_factor)) as executor, \
+                tqdm(total=len(records), desc="计算相似度", unit="文件") as pbar:
+            for task, (results, failed) in imap_instrumented(executor, _score_chunk, tasks, workers * 2,
+                                                                  stage="similarity", gate_of=gate_of):
+                for record_id, _, scores in results:
+                    for reference_id, (ssim, ncc, best_slice) in zip(reference_ids, scores):
+                        pending.append((reference_id, record_id, ssim, ncc, best_slice, "ok"))
+                for record_id, file_path, error in failed:
+                    errors += 1
+                    pending.extend((reference_id, record_id, None, None, None, "error")
+                                   for reference_id in reference_ids)
+                    tqdm.write(f"处理文件 {file_path} 时出错: {error}")
+                pbar.update(len(task[0]))
+                METRICS.inc("files_total", len(task[0]), stage="similarity")
+                if len(pending) >= batch_size:
+                    flush()
+            flush()
+        print(f"相似度已写入数据库，{errors} 个文件处理失败。")
+        summary = cache_summary(cache_before)
+        if summary:
+            print(summary)
+        # 返回值是基准 ID，失败数只记入 errors_total（任务据此判断步骤是否完整）
+        METRICS.inc("errors_total", errors, stage="similarity")
+        return reference_ids
+    finally:
+        conn.close()
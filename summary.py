@@ -0,0 +1,89 @@
+# 报表用的物化汇总表，由 patient_data 上的触发器增量维护。
+# 主键不能用 NULL 做 upsert，NULL 分类以 NULL_KEY 保存，读取时再还原为 None
+# （无扩展名的文件 file_type 为空字符串，需与 NULL 区分）。
+NULL_KEY = '<NULL>'
+
+SUMMARY_DIMENSIONS = {
+    "summary_file_type": "file_type",
+    "summary_actual_file_type": "actual_file_type",
+    "summary_patient": "patient_id",
+}
+
+
+def _upsert(table, column, value, delta):
+    return f'''
+            INSERT INTO {table} ({column}, count) VALUES (COALESCE({value}, '{NULL_KEY}'), {delta})
+            ON CONFLICT({column}) DO UPDATE SET count = count + ({delta});'''
+
+
+def _decrement(table, column, value):
+    return _upsert(table, column, value, -1) + f'''
+            DELETE FROM {table} WHERE {column} = COALESCE({value}, '{NULL_KEY}') AND count <= 0;'''
+
+
+def _create_triggers(cursor):
+    inserts = "".join(_upsert(table, column, f"NEW.{column}", 1) for table, column in SUMMARY_DIMENSIONS.items())
+    deletes = "".join(_decrement(table, column, f"OLD.{column}") for table, column in SUMMARY_DIMENSIONS.items())
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_summary_insert AFTER INSERT ON patient_data BEGIN{inserts}\n        END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_summary_delete AFTER DELETE ON patient_data BEGIN{deletes}\n        END")
+    for table, column in SUMMARY_DIMENSIONS.items():
+        # 只在该列的值真正改变时调整计数
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_update AFTER UPDATE OF {column} ON patient_data
+            WHEN OLD.{column} IS NOT NEW.{column}
+            BEGIN{_decrement(table, column, f"OLD.{column}")}{_upsert(table, column, f"NEW.{column}", 1)}
+            END''')
+
+
+def rebuild_summaries(cursor):
+    """
+    用一次 GROUP BY 重新计算所有汇总表。
+    """
+    for table, column in SUMMARY_DIMENSIONS.items():
+        cursor.execute(f"DELETE FROM {table}")
+        cursor.execute(f'''
+            INSERT INTO {table} ({column}, count)
+            SELECT COALESCE({column}, '{NULL_KEY}'), COUNT(*) FROM patient_data GROUP BY COALESCE({column}, '{NULL_KEY}')
+        ''')
+
+
+def ensure_summary_tables(cursor):
+    """
+    创建汇总表和维护触发器。首次安装时（触发器尚不存在）按现有数据重建一次汇总，之后只做增量更新。
+    调用方负责提交事务。
+    """
+    columns = [col[1] for col in cursor.execute("PRAGMA table_info(patient_data);").fetchall()]
+    # 触发器需要 actual_file_type 列，因此这里会提前创建它：该列存在并不代表已经运行过类型检测，
+    # 按类型筛选记录的阶段必须把 NULL 当作“尚未检测”处理（见 record_filter）
+    if "actual_file_type" not in columns:
+        cursor.execute("ALTER TABLE patient_data ADD COLUMN actual_file_type TEXT;")
+    for table, column in SUMMARY_DIMENSIONS.items():
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                {column} TEXT PRIMARY KEY,
+                count INTEGER NOT NULL
+            )
+        ''')
+    installed = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_summary_insert'").fetchone()
+    if installed is None:
+        _create_triggers(cursor)
+        rebuild_summaries(cursor)
+
+
+def summary_counts(cursor, table, limit=None):
+    """
+    返回 [(分类, 数量), ...]，按数量从大到小排列；分类为 NULL 的记录以 None 表示。
+    """
+    column = SUMMARY_DIMENSIONS[table]
+    query = f"SELECT NULLIF({column}, '{NULL_KEY}'), count FROM {table} ORDER BY count DESC, {column}"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    return cursor.execute(query).fetchall()
+
+
+def print_counts(rows, header, width=20):
+    print(f"{header:<{width}} | Count")
+    print("-" * (width + 20))
+    for value, count in rows:
+        print(f"{str(value):<{width}} | {count}")
@@ -0,0 +1,31 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbmgr import DBManager  # noqa: E402
+
+
+def test_dicom_meta_processes_undetected_records_after_scan(tmp_path):
+    root = tmp_path / "dataset"
+    for patient in ("P1", "P2"):
+        series = root / patient / "series"
+        series.mkdir(parents=True)
+        for i in range(3):
+            (series / f"slice_{i}.dcm").write_bytes(b"not really dicom")
+        (series / "notes.txt").write_text("ignored")
+    db_path = str(tmp_path / "patient_data.db")
+
+    db = DBManager(db_path, str(root))
+    db.initialize_database(assume_yes=False)
+    db.scan_and_add_missing_patients()
+    db.extract_dicom_metadata(workers=1)
+
+    conn = sqlite3.connect(db_path)
+    try:
+        statuses = dict(conn.execute("SELECT file_type, COUNT(meta_status) FROM patient_data GROUP BY file_type"))
+    finally:
+        conn.close()
+    # 尚未运行类型检测（actual_file_type 为 NULL）的 .dcm 记录按扩展名被选中
+    assert statuses == {".dcm": 6, ".txt": 0}
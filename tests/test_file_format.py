@@ -0,0 +1,22 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_format import update_actual_file_types  # noqa: E402
+
+
+def test_update_actual_file_types_raises_database_errors(tmp_path, capsys):
+    db_path = str(tmp_path / "patient_data.db")
+    # 缺少 actual_file_type 列：查询失败时不能悄悄返回 None
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE patient_data (id INTEGER PRIMARY KEY, file_path TEXT)")
+    conn.commit()
+    conn.close()
+
+    with pytest.raises(sqlite3.OperationalError):
+        update_actual_file_types(db_path, workers=1)
+    assert "数据库错误" in capsys.readouterr().out
@@ -0,0 +1,59 @@
+import os
+import sqlite3
+import sys
+
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbmgr import DBManager  # noqa: E402
+
+
+def test_intensity_marks_failures_and_skips_plain_gzip(tmp_path, capsys):
+    series = tmp_path / "dataset" / "P1" / "series"
+    series.mkdir(parents=True)
+    volume = np.arange(4 * 8 * 8, dtype=np.float32).reshape(4, 8, 8)
+    sitk.WriteImage(sitk.GetImageFromArray(volume), str(series / "ok.nii.gz"))
+    (series / "broken.nii").write_bytes(b"not a volume")
+    (series / "archive.tar.gz").write_bytes(b"not a volume either")
+    db_path = str(tmp_path / "patient_data.db")
+
+    db = DBManager(db_path, str(tmp_path / "dataset"))
+    db.initialize_database(assume_yes=False)
+    db.scan_and_add_missing_patients()
+    db.compute_intensity_stats(workers=1)
+
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = {os.path.basename(path): (avg, status) for path, avg, status in
+                conn.execute("SELECT file_path, brightness_avg, intensity_status FROM patient_data")}
+    finally:
+        conn.close()
+    assert rows["ok.nii.gz"] == (float(volume.mean()), "ok")
+    assert rows["broken.nii"] == (None, "error")
+    # .gz 但不是 .nii.gz 的文件不算 NIfTI
+    assert rows["archive.tar.gz"] == (None, None)
+
+    # 失败的文件不会在下次运行时重试
+    capsys.readouterr()
+    db.compute_intensity_stats(workers=1)
+    assert "需要计算亮度统计的文件数: 0" in capsys.readouterr().out
+
+
+def test_stage_summaries_report_volume_cache_hits(tmp_path, capsys):
+    series = tmp_path / "dataset" / "P1" / "series"
+    series.mkdir(parents=True)
+    sitk.WriteImage(sitk.GetImageFromArray(np.ones((4, 8, 8), dtype=np.float32)), str(series / "ok.nii.gz"))
+    db_path = str(tmp_path / "patient_data.db")
+    cache_dir = str(tmp_path / "cache")
+
+    db = DBManager(db_path, str(tmp_path / "dataset"))
+    db.initialize_database(assume_yes=False)
+    db.scan_and_add_missing_patients()
+    capsys.readouterr()
+    # 缓存在工作进程中查找，计数经 imap_instrumented 合并回主进程
+    db.compute_intensity_stats(workers=1, volume_cache=cache_dir)
+    assert "体数据缓存命中 0 次，未命中 1 次（命中率 0%）" in capsys.readouterr().out
+    db.build_previews(workers=1, volume_cache=cache_dir)
+    assert "体数据缓存命中 1 次，未命中 0 次（命中率 100%）" in capsys.readouterr().out
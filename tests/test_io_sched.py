@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from io_sched import AdaptiveLimiter, IOScheduler  # noqa: E402
+
+
+class TwoDeviceScheduler(IOScheduler):
+    # 按路径前缀模拟两块磁盘：hdd 上只允许一个读者，总并发不超过 2
+    def __init__(self):
+        super().__init__(max_workers=2)
+        self.devices = {"hdd": AdaptiveLimiter(1, maximum=1, adaptive=False),
+                        "ssd": AdaptiveLimiter(2, maximum=2, adaptive=False)}
+
+    def limiter(self, path, kind="read"):
+        return self.devices[path.split("/")[0]]
+
+
+def test_map_does_not_block_ssd_behind_rotational_disk():
+    def read(path):
+        time.sleep(0.1 if path.startswith("hdd") else 0.01)
+        return path
+
+    # 按路径排序后机械硬盘的任务全部排在前面
+    items = [f"hdd/{i}" for i in range(4)] + [f"ssd/{i}" for i in range(8)]
+    finished = [item for item, _ in TwoDeviceScheduler().map(read, items, order="path")]
+
+    assert sorted(finished) == sorted(items)
+    # SSD 上的任务不必等机械硬盘上排队的任务完成
+    assert all(item.startswith("ssd") for item in finished[:8])
+
+
+def test_imap_bounded_gates_tasks_per_device():
+    from concurrent.futures import ThreadPoolExecutor
+
+    from parallel import imap_bounded
+
+    gates = {"hdd": AdaptiveLimiter(1, maximum=1, adaptive=False),
+             "ssd": AdaptiveLimiter(4, maximum=4, adaptive=False)}
+    running = {"hdd": 0, "ssd": 0}
+    peak = {"hdd": 0, "ssd": 0}
+
+    def read(path):
+        device = path.split("/")[0]
+        running[device] += 1
+        peak[device] = max(peak[device], running[device])
+        time.sleep(0.1 if device == "hdd" else 0.01)
+        running[device] -= 1
+        return path
+
+    items = [f"hdd/{i}" for i in range(3)] + [f"ssd/{i}" for i in range(8)]
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        finished = [item for item, _ in imap_bounded(executor, read, items, 5,
+                                                     gate_of=lambda path: gates[path.split("/")[0]])]
+
+    assert sorted(finished) == sorted(items)
+    assert peak["hdd"] == 1
+    # 机械硬盘的任务在前面排队时，SSD 的任务照常提交
+    assert all(item.startswith("ssd") for item in finished[:8])
@@ -0,0 +1,67 @@
+import json
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jobs import Job  # noqa: E402
+from metrics import METRICS  # noqa: E402
+
+
+def _job_row(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT status, checkpoint, attempts FROM jobs ORDER BY id DESC LIMIT 1").fetchone()
+    finally:
+        conn.close()
+
+
+def test_step_with_errors_is_partial_and_rerun(tmp_path):
+    db_path = str(tmp_path / "patient_data.db")
+    calls = []
+
+    def stage(errors):
+        calls.append(errors)
+        METRICS.inc("errors_total", errors, stage="test")
+        return errors
+
+    with Job(db_path, "test", {"x": 1}, interval=3600) as job:
+        job.run_step("clean", stage, 0)
+        job.run_step("flaky", stage, 2)
+    status, checkpoint, _ = _job_row(db_path)
+    assert status == "partial"
+    assert json.loads(checkpoint) == {"steps": ["clean"], "partial": {"flaky": 2}}
+
+    # 再次运行时跳过已完成的步骤，重新执行部分失败的步骤
+    with Job(db_path, "test", {"x": 1}, interval=3600) as job:
+        job.run_step("clean", stage, 0)
+        job.run_step("flaky", stage, 0)
+    status, checkpoint, attempts = _job_row(db_path)
+    assert calls == [0, 2, 0]
+    assert (status, attempts) == ("done", 2)
+    assert json.loads(checkpoint) == {"steps": ["clean", "flaky"], "partial": {}}
+
+
+def test_changing_workers_resumes_the_same_job(tmp_path):
+    from main import main
+
+    root = tmp_path / "dataset" / "P1"
+    root.mkdir(parents=True)
+    (root / "a.txt").write_text("text\n")
+    db_path = str(tmp_path / "patient_data.db")
+    base = ["--db", db_path, "--root", str(tmp_path / "dataset")]
+
+    assert main(base + ["--workers", "1", "scan"]) == 0
+    # 模拟任务被中断，再换一个并发数继续
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("UPDATE jobs SET status = 'failed'")
+    conn.close()
+    assert main(base + ["--workers", "2", "--volume-cache-gb", "1", "scan"]) == 0
+    conn = sqlite3.connect(db_path)
+    try:
+        jobs = conn.execute("SELECT status, attempts FROM jobs").fetchall()
+    finally:
+        conn.close()
+    assert jobs == [("done", 2)]
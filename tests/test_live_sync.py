@@ -0,0 +1,40 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from live_sync import LiveSync  # noqa: E402
+
+
+class UnindexedSync(LiveSync):
+    # 模拟比对时没有找到已有记录（例如另一个进程刚刚插入了同一路径）
+    def _records_under(self, conn, path):
+        return []
+
+
+def test_resync_counts_only_inserted_rows(tmp_path):
+    root = tmp_path / "dataset"
+    (root / "P1").mkdir(parents=True)
+    for name in ("a.dcm", "b.dcm"):
+        (root / "P1" / name).write_bytes(b"data")
+    db_path = str(tmp_path / "patient_data.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE patient_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id TEXT,
+            file_path TEXT UNIQUE,
+            file_type TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            source_id INTEGER
+        )
+    ''')
+    conn.execute("INSERT INTO patient_data (patient_id, file_path, file_type) VALUES ('P1', ?, '.dcm')",
+                 (str(root / "P1" / "a.dcm"),))
+
+    counts = {"inserted": 0, "deleted": 0}
+    UnindexedSync(db_path, str(root)).resync(conn, counts)
+    conn.close()
+    assert counts == {"inserted": 1, "deleted": 0}
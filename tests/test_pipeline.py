@@ -0,0 +1,127 @@
+import multiprocessing
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import FileTypeAnalyzer, SimilarityAnalyzer, run_pipeline  # noqa: E402
+
+
+def _make_db(tmp_path, count=6):
+    db_path = str(tmp_path / "patient_data.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE patient_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id TEXT,
+            file_path TEXT UNIQUE,
+            file_type TEXT,
+            created_at TEXT,
+            updated_at TEXT
+        )
+    ''')
+    for i in range(count):
+        path = tmp_path / f"file_{i}.txt"
+        path.write_text(f"plain text file {i}\n")
+        conn.execute("INSERT INTO patient_data (patient_id, file_path, file_type) VALUES (?, ?, ?)",
+                     ("P1", str(path), ".txt"))
+    conn.commit()
+    conn.close()
+    return db_path
+
+
+def test_file_type_analyzer_survives_pickling():
+    import pickle
+
+    analyzer = pickle.loads(pickle.dumps(FileTypeAnalyzer()))
+    assert analyzer._magic is None
+
+
+@pytest.mark.parametrize("method", ["spawn", "forkserver"])
+def test_pipeline_file_type_in_fresh_worker_processes(tmp_path, method):
+    if method not in multiprocessing.get_all_start_methods():
+        pytest.skip(f"{method} 不可用")
+    db_path = _make_db(tmp_path)
+    run_pipeline(db_path, ["file_type"], workers=2, mp_context=multiprocessing.get_context(method))
+
+    conn = sqlite3.connect(db_path)
+    try:
+        types = [row[0] for row in conn.execute("SELECT actual_file_type FROM patient_data")]
+    finally:
+        conn.close()
+    assert len(types) == 6
+    assert all(file_type == "text/plain" for file_type in types)
+
+
+def test_pipeline_does_not_retry_undecodable_nifti(tmp_path, capsys):
+    import numpy as np
+    import SimpleITK as sitk
+
+    db_path = _make_db(tmp_path, count=0)
+    valid = tmp_path / "valid.nii"
+    sitk.WriteImage(sitk.GetImageFromArray(np.zeros((4, 8, 8), dtype=np.float32)), str(valid))
+    # 文件头完整但数据被截断（解码时抛出异常），以及根本不是 NIfTI 的文件（没有数据）
+    truncated = tmp_path / "truncated.nii"
+    truncated.write_bytes(valid.read_bytes()[:400])
+    corrupt = tmp_path / "corrupt.nii"
+    corrupt.write_bytes(b"not a volume")
+    conn = sqlite3.connect(db_path)
+    conn.execute("ALTER TABLE patient_data ADD COLUMN actual_file_type TEXT")
+    conn.executemany("INSERT INTO patient_data (patient_id, file_path, file_type) VALUES ('P1', ?, '.nii')",
+                     [(str(truncated),), (str(corrupt),)])
+    conn.commit()
+    conn.close()
+
+    run_pipeline(db_path, ["intensity"], workers=1)
+    conn = sqlite3.connect(db_path)
+    try:
+        statuses = dict(conn.execute("SELECT file_path, intensity_status FROM patient_data"))
+    finally:
+        conn.close()
+    assert statuses == {str(truncated): "error", str(corrupt): "empty"}
+
+    capsys.readouterr()
+    run_pipeline(db_path, ["intensity"], workers=1)
+    assert "需要处理的文件数: 0" in capsys.readouterr().out
+
+
+def test_pipeline_similarity_records_failures_and_constant_slices(tmp_path, capsys):
+    import math
+
+    import numpy as np
+    import SimpleITK as sitk
+
+    db_path = _make_db(tmp_path, count=0)
+    # 常数体数据：参考切片和候选切片的方差都为 0
+    constant = tmp_path / "constant.nii"
+    sitk.WriteImage(sitk.GetImageFromArray(np.zeros((4, 8, 8), dtype=np.float32)), str(constant))
+    corrupt = tmp_path / "corrupt.nii"
+    corrupt.write_bytes(b"not a volume")
+    conn = sqlite3.connect(db_path)
+    conn.execute("ALTER TABLE patient_data ADD COLUMN actual_file_type TEXT")
+    conn.executemany("INSERT INTO patient_data (patient_id, file_path, file_type) VALUES ('P1', ?, '.nii')",
+                     [(str(constant),), (str(corrupt),)])
+    conn.commit()
+    conn.close()
+
+    def run():
+        analyzer = SimilarityAnalyzer([(str(constant), 0)], target_shape=(8, 8), num_slices=2)
+        return run_pipeline(db_path, [analyzer], workers=1)
+
+    assert run() == 1
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = {path: (ssim, status) for path, ssim, status in conn.execute(
+            "SELECT p.file_path, s.ssim, s.status FROM similarity s JOIN patient_data p ON p.id = s.record_id")}
+    finally:
+        conn.close()
+    assert rows[str(corrupt)] == (None, "error")
+    ssim, status = rows[str(constant)]
+    assert status == "ok" and math.isfinite(ssim)
+
+    capsys.readouterr()
+    assert run() == 0
+    assert "需要处理的文件数: 0" in capsys.readouterr().out
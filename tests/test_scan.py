@@ -0,0 +1,38 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbmgr import DBManager  # noqa: E402
+
+
+def _file_types(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return dict(conn.execute("SELECT file_type, COUNT(*) FROM patient_data GROUP BY file_type"))
+    finally:
+        conn.close()
+
+
+def test_incremental_scan_rescans_when_filters_change(tmp_path):
+    root = tmp_path / "dataset"
+    for patient in ("P1", "P2"):
+        series = root / patient / "series"
+        series.mkdir(parents=True)
+        (series / "slice_0.dcm").write_bytes(b"dicom")
+        (series / "notes.txt").write_text("notes")
+    # 刚修改过的目录不会被快照信任，把目录时间调到过去
+    for directory in (root, *root.rglob("*")):
+        if directory.is_dir():
+            os.utime(directory, (1_000_000_000, 1_000_000_000))
+    db_path = str(tmp_path / "patient_data.db")
+
+    db = DBManager(db_path, str(root), exclude=["*.txt"])
+    db.initialize_database(assume_yes=False)
+    db.scan_and_add_missing_patients()
+    assert _file_types(db_path) == {".dcm": 2}
+
+    # 目录没有任何变化，但去掉了排除规则：快照不能再用来跳过目录
+    DBManager(db_path, str(root)).scan_and_add_missing_patients()
+    assert _file_types(db_path) == {".dcm": 2, ".txt": 2}
@@ -0,0 +1,14 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from verify import _directory_tasks  # noqa: E402
+
+
+def test_directory_tasks_list_each_directory_once():
+    # 按 file_path 排序后，子目录中的文件夹杂在同一目录的文件之间
+    rows = [(1, "/d/P1/a.dcm"), (2, "/d/P1/sub/b.dcm"), (3, "/d/P1/z.dcm"), (4, "/d/P1-2/c.dcm")]
+    tasks = dict(_directory_tasks(sorted(rows, key=lambda row: row[1])))
+    assert sorted(tasks) == ["/d/P1", "/d/P1-2", "/d/P1/sub"]
+    assert [row[0] for row in tasks["/d/P1"]] == [1, 3]
@@ -0,0 +1,43 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from volume import DicomSeriesSliceSource, ItkSliceSource, order_series_slices  # noqa: E402
+
+AXIAL = "1\\0\\0\\0\\1\\0"
+
+
+def test_order_series_slices_collapses_copies_only():
+    rows = [
+        ("b/2.dcm", 0, 0, 1.0, 2),
+        ("a/1.dcm", 0, 0, 0.0, 1),
+        ("b/1.dcm", 0, 0, 0.0, 1),  # 复制到另一个文件夹的同一张切片
+        ("a/2.dcm", 0, 0, 1.0, 2),
+    ]
+    assert order_series_slices(rows, AXIAL) == (["a/1.dcm", "a/2.dcm"], 0)
+
+
+def test_order_series_slices_counts_extra_phases():
+    # 两个时相，每个位置各有一张切片，第二个时相的 InstanceNumber 接在第一个之后
+    rows = [(f"p{phase}/{z}.dcm", 0, 0, float(z), phase * 3 + z + 1) for phase in range(2) for z in range(3)]
+    paths, dropped = order_series_slices(rows, AXIAL)
+    assert paths == ["p0/0.dcm", "p0/1.dcm", "p0/2.dcm"]
+    assert dropped == 3
+
+
+def test_slice_sources_read_first_plane_of_higher_dimensional_images(tmp_path):
+    import numpy as np
+    import SimpleITK as sitk
+
+    volume = np.arange(2 * 3 * 4 * 5, dtype=np.float32).reshape(2, 3, 4, 5)
+    path = str(tmp_path / "series.mha")
+    sitk.WriteImage(sitk.GetImageFromArray(volume, isVector=False), path)
+
+    source = ItkSliceSource(path)
+    assert source.num_slices == 3
+    np.testing.assert_array_equal(source.read([2, 0]), volume[0, [2, 0]])
+
+    # 多帧文件当作单张切片读取时取第一帧
+    frames = DicomSeriesSliceSource([path])
+    np.testing.assert_array_equal(frames.read([0]), volume[:1, 0])
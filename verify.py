@@ -0,0 +1,182 @@
+import os
+import sqlite3
+import stat
+from datetime import datetime
+
+from tqdm import tqdm
+
+from io_sched import IOScheduler
+from live_sync import delete_records, invalidate_records
+from metrics import METRICS
+
+# 校验结果：file_size 与 fingerprint 阶段共用；is_present 为 1 / 0，尚未校验的记录为 NULL
+VERIFY_COLUMNS = (("file_size", "INTEGER"), ("file_mtime_ns", "INTEGER"), ("is_present", "INTEGER"),
+                  ("verified_at", "TEXT"))
+
+
+def ensure_verify_columns(cursor):
+    columns = {col[1] for col in cursor.execute("PRAGMA table_info(patient_data);").fetchall()}
+    for column, column_type in VERIFY_COLUMNS:
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE patient_data ADD COLUMN {column} {column_type};")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_data_is_present ON patient_data(is_present)')
+
+
+def _verify_directory(task):
+    """
+    校验同一目录下的一组记录，返回 [(record, size, mtime_ns)]，文件不存在时 size 为 None。
+
+    目录只列举一次：不存在的文件和整个消失的目录不再逐个 stat，只有存在的文件才读取大小和修改时间。
+    目录无法列举（权限等）时返回 None，这些记录保持原状。
+    """
+    dir_path, records = task
+    if len(records) == 1:
+        # 只有一个文件时直接 stat，比列举可能很大的目录更快
+        record = records[0]
+        try:
+            st = os.stat(record[1])
+        except (FileNotFoundError, NotADirectoryError):
+            return [(record, None, None)]
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return [(record, None, None)]
+        return [(record, st.st_size, st.st_mtime_ns)]
+
+    try:
+        with os.scandir(dir_path) as iterator:
+            entries = {entry.name: entry for entry in iterator}
+    except (FileNotFoundError, NotADirectoryError):
+        entries = {}
+    except OSError:
+        return None
+    results = []
+    for record in records:
+        entry = entries.get(os.path.basename(record[1]))
+        try:
+            if entry is not None and entry.is_file():
+                st = entry.stat()
+                results.append((record, st.st_size, st.st_mtime_ns))
+                continue
+        except OSError:
+            pass
+        results.append((record, None, None))
+    return results
+
+
+def _directory_tasks(rows):
+    # 按目录分组，每组一个任务。按 file_path 排序时同一目录的文件并不一定相邻（子目录中的文件会排在中间，
+    # 例如 a/x、a/sub/y、a/z），所以用字典分组，保证一页内每个目录只列举一次
+    groups = {}
+    for row in rows:
+        groups.setdefault(os.path.dirname(row[1]), []).append(row)
+    return list(groups.items())
+
+
+def verify_files(db_path, workers=None, delete_missing=False, page_size=20000, batch_size=5000):
+    """
+    并行校验所有记录对应的文件是否仍然存在，并记录 file_size / file_mtime_ns / is_present / verified_at。
+
+    记录按路径分页读取并按目录分组，每个目录列举一次；各设备的并发由 I/O 调度器按磁盘类型控制，
+    workers 为并发上限。大小或修改时间发生变化（以及重新出现）的文件视为内容已变化，
+    会清空其派生列（文件类型、哈希、亮度等）并删除派生表中的结果，之后重新运行各阶段即可重新计算。
+    不存在的文件标记为 is_present = 0；delete_missing=True 时直接删除这些记录。
+
+    返回 {"checked", "present", "missing", "changed", "skipped"} 计数。
+    """
+    scheduler = IOScheduler(max_workers=workers)
+    conn = sqlite3.connect(db_path, timeout=60)
+    counts = {"checked": 0, "present": 0, "missing": 0, "changed": 0, "skipped": 0}
+    try:
+        ensure_verify_columns(conn.cursor())
+        conn.commit()
+        # 整个数据源不可访问（磁盘未挂载等）时跳过它的记录，而不是全部标记为不存在
+        offline = []
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='sources'").fetchone():
+            for source_id, root_path in conn.execute("SELECT source_id, root_path FROM sources").fetchall():
+                if not os.path.isdir(root_path):
+                    print(f"无法访问数据源 {source_id}（{root_path}），跳过其中的记录。")
+                    offline.append(source_id)
+        condition = "1"
+        if offline:
+            condition = f"(source_id IS NULL OR source_id NOT IN ({', '.join('?' * len(offline))}))"
+        total_files = conn.execute(f"SELECT COUNT(*) FROM patient_data WHERE {condition}", offline).fetchone()[0]
+        present, changed, missing = [], [], []
+
+        def flush(timestamp):
+            counts["present"] += len(present) + len(changed)
+            counts["changed"] += len(changed)
+            counts["missing"] += len(missing)
+            with METRICS.transaction(conn, "verify"):
+                # 先清空派生列（其中包括 file_size），再写入新的大小和修改时间
+                invalidate_records(conn, [record_id for _, _, record_id in changed])
+                conn.executemany('''
+                    UPDATE patient_data SET file_size = ?, file_mtime_ns = ?, is_present = 1, verified_at = ?
+                    WHERE id = ?
+                ''', [(size, mtime_ns, timestamp, record_id) for size, mtime_ns, record_id in present + changed])
+                conn.executemany("UPDATE patient_data SET updated_at = ? WHERE id = ?",
+                                 [(timestamp, record_id) for _, _, record_id in changed])
+                if delete_missing:
+                    delete_records(conn, missing)
+                else:
+                    conn.executemany("UPDATE patient_data SET is_present = 0, verified_at = ? WHERE id = ?",
+                                     [(timestamp, record_id) for record_id in missing])
+            present.clear()
+            changed.clear()
+            missing.clear()
+
+        last_path = ""
+        with tqdm(total=total_files, desc="校验文件", unit="文件") as pbar:
+            while True:
+                # 按 file_path 做 keyset 分页（利用唯一索引），同一目录的记录落在一起
+                rows = conn.execute(f'''
+                    SELECT id, file_path, file_size, file_mtime_ns, is_present FROM patient_data
+                    WHERE {condition} AND file_path > ? ORDER BY file_path LIMIT ?
+                ''', offline + [last_path, page_size]).fetchall()
+                if not rows:
+                    break
+                last_path = rows[-1][1]
+                timestamp = datetime.now().isoformat()
+                tasks = _directory_tasks(rows)
+                results = scheduler.map(_verify_directory, tasks, path_of=lambda task: task[1][0][1],
+                                        kind="metadata", order=None)
+                for task, result in results:
+                    n = len(task[1])
+                    pbar.update(n)
+                    METRICS.inc("files_total", n, stage="verify")
+                    if result is None:
+                        counts["skipped"] += n
+                        tqdm.write(f"无法列举目录: {task[0]}")
+                        continue
+                    for (record_id, _, old_size, old_mtime_ns, was_present), size, mtime_ns in result:
+                        if size is None:
+                            missing.append(record_id)
+                            continue
+                        if (was_present == 0 or (old_size is not None and old_size != size)
+                                or (old_mtime_ns is not None and old_mtime_ns != mtime_ns)):
+                            changed.append((size, mtime_ns, record_id))
+                        else:
+                            present.append((size, mtime_ns, record_id))
+                    counts["checked"] += n
+                    if len(present) + len(changed) + len(missing) >= batch_size:
+                        flush(timestamp)
+                flush(timestamp)
+                if len(rows) < page_size:
+                    break
+
+        if counts["changed"]:
+            METRICS.inc("verify_changed_total", counts["changed"])
+        if counts["missing"]:
+            METRICS.inc("verify_missing_total", counts["missing"])
+        action = "已删除记录" if delete_missing else "已标记为不存在"
+        message = f"校验完成，共检查 {counts['checked']} 个文件：{counts['present']} 个存在"
+        if counts["changed"]:
+            message += f"（其中 {counts['changed']} 个已变化，派生数据已清空）"
+        message += f"，{counts['missing']} 个不存在（{action}）"
+        if counts["skipped"]:
+            message += f"，{counts['skipped']} 个因目录无法访问而跳过"
+        print(message + "。")
+        METRICS.inc("errors_total", counts["skipped"] + len(offline), stage="verify")
+        return counts
+    finally:
+        conn.close()
@@ -0,0 +1,440 @@
+import gzip
+import hashlib
+import io
+import os
+import sqlite3
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import groupby
+
+import numpy as np
+import SimpleITK as sitk
+from tqdm import tqdm
+
+from io_sched import default_workers, device_gate
+from metrics import METRICS, imap_instrumented
+
+
+# NIfTI-1 datatype 代码到 NumPy 类型的映射（不支持 RGB / 复数类型）
+NIFTI_DTYPES = {
+    2: "u1", 4: "i2", 8: "i4", 16: "f4", 64: "f8",
+    256: "i1", 512: "u2", 768: "u4", 1024: "i8", 1280: "u8",
+}
+
+
+def _is_gzip(path):
+    with open(path, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def _open_maybe_gzip(path):
+    return gzip.open(path, "rb") if _is_gzip(path) else open(path, "rb")
+
+
+def read_nifti_header(f):
+    """
+    解析 NIfTI-1 头部，返回 (shape_zyx, dtype, vox_offset, slope, inter)；不支持的文件返回 None。
+    """
+    header = f.read(348)
+    if len(header) < 348:
+        return None
+    for endian in "<>":
+        if struct.unpack(endian + "i", header[:4])[0] == 348:
+            break
+    else:
+        return None
+
+    dim = struct.unpack(endian + "8h", header[40:56])
+    datatype = struct.unpack(endian + "h", header[70:72])[0]
+    vox_offset = struct.unpack(endian + "f", header[108:112])[0]
+    slope, inter = struct.unpack(endian + "2f", header[112:120])
+    ndim = dim[0]
+    if datatype not in NIFTI_DTYPES or not 1 <= ndim <= 3:
+        return None
+    nx, ny, nz = (list(dim[1:1 + ndim]) + [1, 1])[:3]
+    dtype = np.dtype(endian + NIFTI_DTYPES[datatype])
+    return (nz, ny, nx), dtype, int(vox_offset), slope, inter
+
+
+def iter_volume_slabs(path, slab_size=16):
+    """
+    按 z 方向逐块读取体数据，每次产生形状为 (n, height, width) 的数组，峰值内存只有一个 slab。
+
+    NIfTI-1（包括 .nii.gz）直接顺序解析，压缩文件只需解压一遍；其它格式使用
+    SimpleITK.ImageFileReader 的区域提取功能。
+    """
+    with _open_maybe_gzip(path) as f:
+        info = read_nifti_header(f)
+        if info is not None:
+            (nz, ny, nx), dtype, vox_offset, slope, inter = info
+            f.read(max(vox_offset - 348, 0))
+            # 按 NIfTI 规范，scl_slope 为 0 或 NaN 时不做缩放
+            use_scaling = slope == slope and slope != 0.0 and (slope != 1.0 or inter != 0.0)
+            for z in range(0, nz, slab_size):
+                n = min(slab_size, nz - z)
+                start = time.perf_counter()
+                buf = f.read(n * ny * nx * dtype.itemsize)
+                slab = np.frombuffer(buf, dtype=dtype).reshape(n, ny, nx)
+                if use_scaling:
+                    slab = slab * slope + inter
+                METRICS.observe("decode_seconds", time.perf_counter() - start, kind="slab")
+                METRICS.inc("decode_bytes_total", slab.nbytes, kind="slab")
+                yield slab
+            return
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    size = reader.GetSize()
+    if len(size) != 3:
+        array = sitk.GetArrayFromImage(reader.Execute())
+        yield array.reshape((-1,) + array.shape[-2:])
+        return
+    nx, ny, nz = size
+    for z in range(0, nz, slab_size):
+        n = min(slab_size, nz - z)
+        reader.SetExtractIndex((0, 0, z))
+        reader.SetExtractSize((nx, ny, n))
+        yield sitk.GetArrayFromImage(reader.Execute())
+
+
+def decode_nifti_bytes(data):
+    """
+    从内存中的文件内容（可以是 gzip 压缩的）解码 NIfTI-1 体数据，返回 (depth, height, width) 数组；
+    不是受支持的 NIfTI 文件时返回 None。
+    """
+    with METRICS.timer("decode_seconds", kind="nifti_bytes"):
+        if data[:2] == b"\x1f\x8b":
+            data = gzip.decompress(data)
+        info = read_nifti_header(io.BytesIO(data))
+        if info is None:
+            return None
+        shape, dtype, vox_offset, slope, inter = info
+        volume = np.frombuffer(data, dtype=dtype, count=int(np.prod(shape)), offset=vox_offset).reshape(shape)
+        if slope == slope and slope != 0.0 and (slope != 1.0 or inter != 0.0):
+            volume = volume * slope + inter
+    METRICS.inc("decode_bytes_total", volume.nbytes, kind="nifti_bytes")
+    return volume
+
+
+def _resize_coords(in_size, out_size):
+    # 像素中心对齐（align_corners=False），与 torch interpolate(bilinear) 和 cv2.INTER_LINEAR 一致
+    x = (np.arange(out_size, dtype=np.float64) + 0.5) * (in_size / out_size) - 0.5
+    x = np.clip(x, 0, in_size - 1)
+    x0 = np.floor(x).astype(np.int64)
+    x1 = np.minimum(x0 + 1, in_size - 1)
+    return x0, x1, (x - x0).astype(np.float32)
+
+
+def resize_bilinear(images, target_shape):
+    """
+    对一批切片 (n, H, W)（或单张 (H, W)）做双线性缩放，target_shape 为 (height, width)，返回 float32。
+    """
+    images = np.asarray(images, dtype=np.float32)
+    single = images.ndim == 2
+    if single:
+        images = images[None]
+    height, width = images.shape[-2:]
+    y0, y1, fy = _resize_coords(height, target_shape[0])
+    x0, x1, fx = _resize_coords(width, target_shape[1])
+    rows = images[:, y0, :] * (1 - fy)[None, :, None] + images[:, y1, :] * fy[None, :, None]
+    resized = rows[:, :, x0] * (1 - fx) + rows[:, :, x1] * fx
+    return resized[0] if single else resized
+
+
+def sample_indices(depth, num_slices):
+    """
+    在 depth 张切片中均匀选取 num_slices 张的下标（与 notebook 中的 np.linspace 选取方式相同）。
+    """
+    return np.linspace(0, depth - 1, num_slices, dtype=int)
+
+
+class NiftiSliceSource:
+    """
+    按下标读取 NIfTI-1 文件中的单张切片。未压缩文件通过内存映射只读取所需切片所在的页；
+    .nii.gz 只能顺序解压，但同一时刻只保留一张切片。
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        (self.num_slices, self.height, self.width), self.dtype, self.vox_offset, slope, inter = header
+        self._scale = (slope, inter) if slope == slope and slope != 0.0 and (slope != 1.0 or inter != 0.0) else None
+        self._compressed = _is_gzip(path)
+
+    def _scaled(self, array):
+        if self._scale is None:
+            return np.array(array)
+        return array * self._scale[0] + self._scale[1]
+
+    def read(self, indices):
+        kind = "nifti_gz" if self._compressed else "nifti"
+        with METRICS.timer("decode_seconds", kind=kind):
+            slices = self._read(indices)
+        METRICS.inc("decode_bytes_total", slices.nbytes, kind=kind)
+        return slices
+
+    def _read(self, indices):
+        indices = [int(i) for i in indices]
+        if not self._compressed:
+            data = np.memmap(self.path, dtype=self.dtype, mode="r", offset=self.vox_offset,
+                             shape=(self.num_slices, self.height, self.width))
+            return self._scaled(data[indices])
+
+        slice_bytes = self.height * self.width * self.dtype.itemsize
+        wanted = sorted(set(indices))
+        slices = {}
+        with gzip.open(self.path, "rb") as f:
+            # 只能向前 seek（边解压边跳过），所以按下标从小到大读取
+            for index in wanted:
+                f.seek(self.vox_offset + index * slice_bytes)
+                slices[index] = np.frombuffer(f.read(slice_bytes), dtype=self.dtype).reshape(self.height, self.width)
+        return self._scaled(np.stack([slices[i] for i in indices]))
+
+
+class ItkSliceSource:
+    """
+    通过 SimpleITK.ImageFileReader 的区域提取逐张读取切片，适用于其它 ITK 支持的格式。
+    超过三维的图像（例如 4D 时间序列）只读取第一个 3D 体。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._reader = sitk.ImageFileReader()
+        self._reader.SetFileName(path)
+        self._reader.ReadImageInformation()
+        size = self._reader.GetSize()
+        self._size = size
+        self.num_slices = size[2] if len(size) >= 3 else 1
+
+    def read(self, indices):
+        with METRICS.timer("decode_seconds", kind="itk"):
+            slices = self._read(indices)
+        METRICS.inc("decode_bytes_total", slices.nbytes, kind="itk")
+        return slices
+
+    def _read(self, indices):
+        if len(self._size) < 3:
+            array = sitk.GetArrayFromImage(self._reader.Execute())
+            return np.stack([_first_plane(array) for _ in indices])
+        extra = (0,) * (len(self._size) - 3)
+        slices = []
+        for index in indices:
+            self._reader.SetExtractIndex((0, 0, int(index)) + extra)
+            self._reader.SetExtractSize((self._size[0], self._size[1], 1) + (1,) * len(extra))
+            slices.append(_first_plane(sitk.GetArrayFromImage(self._reader.Execute())))
+        return np.stack(slices)
+
+
+def _first_plane(array):
+    """
+    取数组最后两维组成的第一个 2D 平面（多帧 DICOM、4D 图像等只取第一帧）。
+    """
+    return array[(0,) * (array.ndim - 2)]
+
+
+class DicomSeriesSliceSource:
+    """
+    逐切片存储的 DICOM 序列：第 i 张切片就是排序后的第 i 个文件，只读取被请求的文件。
+    多帧文件只取第一帧。
+    """
+
+    def __init__(self, file_paths):
+        self.file_paths = list(file_paths)
+        self.num_slices = len(self.file_paths)
+
+    def read(self, indices):
+        slices = []
+        with METRICS.timer("decode_seconds", kind="dicom"):
+            for index in indices:
+                array = sitk.GetArrayFromImage(sitk.ReadImage(self.file_paths[int(index)]))
+                slices.append(_first_plane(array))
+            slices = np.stack(slices)
+        METRICS.inc("decode_bytes_total", slices.nbytes, kind="dicom")
+        return slices
+
+
+def open_slice_source(path):
+    """
+    为单文件体数据创建切片读取器：NIfTI-1 使用文件头直接定位，其它格式交给 ITK。
+    """
+    with _open_maybe_gzip(path) as f:
+        header = read_nifti_header(f)
+    if header is not None:
+        return NiftiSliceSource(path, header)
+    return ItkSliceSource(path)
+
+
+def read_slices(path, indices):
+    """
+    只读取体数据中指定下标的切片，返回 (len(indices), height, width) 的数组。
+    """
+    return open_slice_source(path).read(indices)
+
+
+def slice_sort_key(position, orientation, instance_number):
+    """
+    切片排序键：ImagePositionPatient 在切片法向量上的投影；缺少位置信息时退回 InstanceNumber。
+    """
+    if orientation and all(v is not None for v in position):
+        values = [float(v) for v in orientation.split("\\")]
+        normal = np.cross(values[:3], values[3:6])
+        return (0, float(np.dot(normal, position)), instance_number or 0)
+    return (1, instance_number or 0, 0)
+
+
+def series_signature(file_paths):
+    """
+    由所有切片文件的路径、大小和修改时间计算的签名，任一切片变化都会使签名改变。
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for file_path in file_paths:
+        st = os.stat(file_path)
+        h.update(f"{file_path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode("utf-8", "surrogateescape"))
+    return h.hexdigest()
+
+
+def read_series_volume(file_paths):
+    """
+    按给定顺序把切片堆叠成 3D 体数据；间距、原点和方向由 ITK 根据切片位置计算。
+    """
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(list(file_paths))
+    return reader.Execute()
+
+
+def _assemble_task(task):
+    series_uid, file_paths, cache_path, old_signature = task[:4]
+    try:
+        signature = series_signature(file_paths)
+        if signature == old_signature and os.path.exists(cache_path):
+            return series_uid, "skipped", signature, None
+        image = read_series_volume(file_paths)
+        # 先写临时文件再原子替换，避免留下写了一半的缓存（ITK 根据扩展名选择格式，所以加前缀）
+        tmp_path = os.path.join(os.path.dirname(cache_path), ".tmp-" + os.path.basename(cache_path))
+        sitk.WriteImage(image, tmp_path)
+        os.replace(tmp_path, cache_path)
+        return series_uid, "ok", signature, None
+    except Exception as e:
+        return series_uid, "error", None, str(e)
+
+
+def order_series_slices(rows, orientation):
+    """
+    rows 为 (file_path, x, y, z, instance_number)，返回 (按空间位置排序后的切片路径, 被舍弃的切片数)。
+
+    同一序列被复制到多个患者文件夹时会出现位置和 InstanceNumber 都相同的切片，这些副本只保留第一份，
+    不计入舍弃数。位置相同但 InstanceNumber 不同的切片属于多时相 / 多回波数据，无法组成一个 3D 体，
+    每个位置只保留 InstanceNumber 最小的一张（即第一个时相），其余计入舍弃数。
+    """
+    keyed = sorted(
+        (slice_sort_key((row[1], row[2], row[3]), orientation, row[4]), row[0]) for row in rows
+    )
+    paths = []
+    dropped = 0
+    for i, (key, path) in enumerate(keyed):
+        if i > 0 and key[:2] == keyed[i - 1][0][:2]:
+            if key != keyed[i - 1][0]:
+                dropped += 1
+            continue
+        paths.append(path)
+    return paths, dropped
+
+
+def series_slice_paths(conn, series_uid):
+    """
+    从 instance / series 表中查出一个序列的所有切片路径（已排序）。
+    """
+    row = conn.execute("SELECT orientation FROM series WHERE series_uid = ?", (series_uid,)).fetchone()
+    if row is None:
+        return []
+    rows = conn.execute('''
+        SELECT p.file_path, i.position_x, i.position_y, i.position_z, i.instance_number
+        FROM instance i JOIN patient_data p ON p.id = i.record_id
+        WHERE i.series_uid = ?
+    ''', (series_uid,)).fetchall()
+    return order_series_slices(rows, row[0])[0]
+
+
+def _series_tasks(conn, cache_dir, extension):
+    """
+    按序列分组读取切片（已按 series_uid 排序），在主进程中完成排序后生成组装任务；
+    任务的最后一项为排序时舍弃的多时相切片数。
+    """
+    cursor = conn.execute('''
+        SELECT i.series_uid, p.file_path, i.position_x, i.position_y, i.position_z, i.instance_number,
+               s.orientation, s.volume_signature
+        FROM instance i
+        JOIN patient_data p ON p.id = i.record_id
+        JOIN series s ON s.series_uid = i.series_uid
+        ORDER BY i.series_uid
+    ''')
+    for series_uid, rows in groupby(cursor, key=lambda row: row[0]):
+        rows = list(rows)
+        orientation, old_signature = rows[0][6], rows[0][7]
+        file_paths, dropped = order_series_slices([row[1:6] for row in rows], orientation)
+        cache_path = os.path.join(cache_dir, f"{series_uid}{extension}")
+        yield series_uid, file_paths, cache_path, old_signature, dropped
+
+
+def assemble_series_volumes(db_path, cache_dir, workers=None, compress=False):
+    """
+    将每个 DICOM 序列的切片按位置排序并组装为 3D 体数据，写入缓存目录（NIfTI），
+    并在 series 表中记录缓存路径和切片签名。签名未变化且缓存存在的序列会被跳过。
+    多时相 / 多回波序列只组装第一个时相，舍弃的切片会逐个序列打印并汇总计数。
+    返回组装失败的序列数。
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    extension = ".nii.gz" if compress else ".nii"
+    conn = sqlite3.connect(db_path)
+    # 读取任务使用单独的连接；WAL 模式下它的快照不受写入连接提交的影响
+    conn.execute("PRAGMA journal_mode=WAL")
+    read_conn = sqlite3.connect(db_path)
+    try:
+        gate_of = device_gate(lambda task: task[1][0], max_workers=workers)
+        workers = workers or default_workers()
+        total = conn.execute("SELECT COUNT(*) FROM series").fetchone()[0]
+        counts = {"ok": 0, "skipped": 0, "error": 0}
+        dropped_slices = 0
+        pending = []
+
+        def flush():
+            if pending:
+                with METRICS.transaction(conn, "assemble"):
+                    conn.executemany('''
+                        UPDATE series SET volume_path = ?, volume_signature = ?, volume_slices = ?,
+                                          volume_updated_at = ?
+                        WHERE series_uid = ?
+                    ''', pending)
+                pending.clear()
+
+        tasks = _series_tasks(read_conn, cache_dir, extension)
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+                tqdm(total=total, desc="组装序列", unit="序列") as pbar:
+            for task, (series_uid, status, signature, error) in imap_instrumented(
+                    executor, _assemble_task, tasks, workers * 2, stage="assemble", gate_of=gate_of):
+                counts[status] += 1
+                if task[4]:
+                    dropped_slices += task[4]
+                    if status == "ok":
+                        tqdm.write(f"序列 {series_uid} 含多个时相 / 回波，只组装第一个，舍弃 {task[4]} 张切片。")
+                if status == "ok":
+                    pending.append((task[2], signature, len(task[1]), datetime.now().isoformat(), series_uid))
+                elif status == "error":
+                    tqdm.write(f"组装序列 {series_uid} 时出错: {error}")
+                pbar.update(1)
+                METRICS.inc("files_total", len(task[1]), stage="assemble")
+                if len(pending) >= 100:
+                    flush()
+            flush()
+
+        print(f"序列组装完成：新生成 {counts['ok']} 个，未变化跳过 {counts['skipped']} 个，出错 {counts['error']} 个。")
+        if dropped_slices:
+            print(f"多时相 / 多回波序列中共有 {dropped_slices} 张切片未组装。")
+        METRICS.inc("slices_dropped_total", dropped_slices, stage="assemble")
+        METRICS.inc("errors_total", counts["error"], stage="assemble")
+        return counts["error"]
+    finally:
+        read_conn.close()
+        conn.close()